@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from models import BaseProduct
+from repositories import BaseProductRepository
+from tracing import in_current_context
+
+
+class AsyncProductRepository:
+    """Async counterpart of BaseProductRepository
+
+    The blocking repository calls run on a bounded thread pool so the event
+    loop keeps serving other requests while one waits on MySQL or on the
+    JSON file. A single shared repository (like the in-memory ones) is used
+    by one call at a time; with a repository_factory every worker thread
+    builds its own repository, and connection, so up to max_concurrency
+    calls run in parallel.
+    """
+
+    def __init__(
+        self,
+        repository: BaseProductRepository | None = None,
+        repository_factory=None,
+        max_concurrency: int | None = None,
+    ):
+        if (repository is None) == (repository_factory is None):
+            raise ValueError("Give either a repository or a repository_factory")
+        if max_concurrency is None:
+            max_concurrency = 1 if repository is not None else 8
+        self.repository = repository
+        self.repository_factory = repository_factory
+        self.max_concurrency = max_concurrency
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="repository"
+        )
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _get_repository(self) -> BaseProductRepository:
+        if self.repository is not None:
+            return self.repository
+        repository = getattr(self._local, "repository", None)
+        if repository is None:
+            repository = self._local.repository = self.repository_factory()
+        return repository
+
+    def _call(self, method_name: str, *args, **kwargs):
+        return getattr(self._get_repository(), method_name)(*args, **kwargs)
+
+    async def _run(self, method_name: str, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor,
+                partial(in_current_context(self._call), method_name, *args, **kwargs),
+            )
+
+    async def add(self, product: BaseProduct):
+        return await self._run("add", product)
+
+    async def get(self, product_id: int | str) -> BaseProduct | None:
+        return await self._run("get", product_id)
+
+    async def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        return await self._run("get_many", list(product_ids))
+
+    async def list(self) -> dict[str, BaseProduct]:
+        return await self._run("list")
+
+    async def update(self, product: BaseProduct, expected_version: int | None = None):
+        return await self._run("update", product, expected_version)
+
+    async def delete(self, product_id: int | str):
+        return await self._run("delete", product_id)
+
+    async def find(self, **filters) -> dict[str, BaseProduct]:
+        return await self._run("find", **filters)
+
+    async def search(
+        self, query: str, limit: int | None = 10
+    ) -> dict[str, BaseProduct]:
+        return await self._run("search", query, limit)
+
+    async def expiring_between(self, start, end, limit: int | None = None):
+        return await self._run("expiring_between", start, end, limit)
+
+    async def inventory_stats(self) -> dict:
+        return await self._run("inventory_stats")
+
+    async def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        return await self._run("low_stock", limit)
+
+    async def update_where(self, criteria: dict, changes: dict) -> int:
+        return await self._run("update_where", criteria, changes)
+
+    async def delete_where(self, criteria: dict) -> int:
+        return await self._run("delete_where", criteria)
+
+    def get_product_types(self):
+        return BaseProductRepository.get_product_types()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    from models import Product
+    from repositories import DictProductRepository, ListProductRepository
+    from services import AsyncProductService, ProductService
+
+    def run_scenario(service):
+        """Run the same operations through a sync or an async service"""
+        results = []
+        for code in ("1", "2", "3"):
+            results.append(service.add(Product(code, f"Product {code}", 10)))
+        results.append(service.get("2"))
+        results.append(service.get_many(["1", "2", "9"]))
+        results.append(service.update(Product("2", "Updated", 20, stock=4)))
+        results.append(service.delete("3"))
+        results.append(service.list())
+        results.append(service.search("updated"))
+        results.append(service.find(stock_below=1))
+        results.append(service.get("3"))
+        return results
+
+    async def run_async_scenario(service):
+        results = []
+        for code in ("1", "2", "3"):
+            results.append(await service.add(Product(code, f"Product {code}", 10)))
+        results.append(await service.get("2"))
+        results.append(await service.get_many(["1", "2", "9"]))
+        results.append(await service.update(Product("2", "Updated", 20, stock=4)))
+        results.append(await service.delete("3"))
+        results.append(await service.list())
+        results.append(await service.search("updated"))
+        results.append(await service.find(stock_below=1))
+        results.append(await service.get("3"))
+        return results
+
+    def comparable(result):
+        if isinstance(result, BaseProduct):
+            return result.to_dict()
+        if isinstance(result, dict):
+            return {code: comparable(value) for code, value in result.items()}
+        return result
+
+    class TestParity(unittest.IsolatedAsyncioTestCase):
+        async def check_parity(self, repository_class):
+            expected = run_scenario(ProductService(repository_class()))
+            service = AsyncProductService(AsyncProductRepository(repository_class()))
+            results = await run_async_scenario(service)
+            self.assertEqual(
+                [comparable(result) for result in results],
+                [comparable(result) for result in expected],
+            )
+            service.product_repository.close()
+
+        async def test_dict_repository(self):
+            await self.check_parity(DictProductRepository)
+
+        async def test_list_repository(self):
+            await self.check_parity(ListProductRepository)
+
+        async def test_concurrent_calls(self):
+            repository = AsyncProductRepository(DictProductRepository())
+            await asyncio.gather(
+                *(repository.add(Product(str(i), "Product", 1)) for i in range(50))
+            )
+            self.assertEqual(len(await repository.list()), 50)
+            repository.close()
+
+        async def test_repository_per_thread(self):
+            repositories = []
+
+            def factory():
+                repositories.append(DictProductRepository())
+                return repositories[-1]
+
+            repository = AsyncProductRepository(
+                repository_factory=factory, max_concurrency=4
+            )
+            await asyncio.gather(*(repository.list() for _ in range(20)))
+            self.assertLessEqual(len(repositories), 4)
+            repository.close()
+
+    unittest.main()
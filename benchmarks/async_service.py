@@ -0,0 +1,97 @@
+"""Throughput of ProductService against AsyncProductService
+
+The repository answers after a fixed delay that stands in for a MySQL
+round trip, so the benchmark runs without a database server:
+
+    python -m benchmarks.async_service --clients 100 --requests 20
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+from async_repositories import AsyncProductRepository
+from models import Product
+from repositories import DictProductRepository
+from services import AsyncProductService, ProductService
+
+
+class SlowRepository:
+    """Proxy adding a blocking delay to every call, like a network round trip"""
+
+    def __init__(self, repository, latency: float, lock: threading.Lock):
+        self.repository = repository
+        self.latency = latency
+        self.lock = lock
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self.latency)
+            with self.lock:
+                return method(*args, **kwargs)
+
+        return call
+
+
+def build_repository(products: int) -> DictProductRepository:
+    repository = DictProductRepository()
+    for code in range(products):
+        repository.add(Product(str(code), f"Product {code}", 10, stock=5))
+    return repository
+
+
+def run_sync(repository, latency, clients, requests) -> float:
+    service = ProductService(SlowRepository(repository, latency, threading.Lock()))
+    started = time.perf_counter()
+    for client in range(clients):
+        for request in range(requests):
+            service.get(str((client * requests + request) % 1000))
+    return clients * requests / (time.perf_counter() - started)
+
+
+async def run_async(repository, latency, clients, requests, concurrency) -> float:
+    lock = threading.Lock()
+    async_repository = AsyncProductRepository(
+        repository_factory=lambda: SlowRepository(repository, latency, lock),
+        max_concurrency=concurrency,
+    )
+    service = AsyncProductService(async_repository)
+
+    async def client(number):
+        for request in range(requests):
+            await service.get(str((number * requests + request) % 1000))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    elapsed = time.perf_counter() - started
+    async_repository.close()
+    return clients * requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    repository = build_repository(1000)
+    sync_rate = run_sync(repository, args.latency, args.clients, args.requests)
+    async_rate = asyncio.run(
+        run_async(
+            repository, args.latency, args.clients, args.requests, args.concurrency
+        )
+    )
+    print(f"clients={args.clients} latency={args.latency * 1000:.1f}ms")
+    print(f"ProductService (blocking):  {sync_rate:10.0f} requests/s")
+    print(
+        f"AsyncProductService ({args.concurrency} workers): "
+        f"{async_rate:10.0f} requests/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
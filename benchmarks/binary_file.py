@@ -0,0 +1,94 @@
+"""File size and load time of the JSON and binary file repositories
+
+python -m benchmarks.binary_file --products 100000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from binary_repository import BinaryFileProductRepository
+from models import FoodProduct, Product
+from repositories import JsonProductRepository
+
+
+def build_products(count: int):
+    for code in range(count):
+        if code % 2:
+            yield FoodProduct(
+                str(code),
+                f"Food {code}",
+                code % 100,
+                f"Description of food {code}",
+                stock=code % 30,
+                product_type="food",
+                expiration_date="2030-01-01",
+            )
+        else:
+            yield Product(
+                str(code), f"Product {code}", code % 100, f"Product {code}", stock=3
+            )
+
+
+def measure(open_repository, filename: str, products: int, lookups: int) -> dict:
+    repository = open_repository(filename)
+    repository.add_many(build_products(products))
+    repository.close()
+    size = os.path.getsize(filename)
+    if os.path.exists(f"{filename}.idx"):
+        size += os.path.getsize(f"{filename}.idx")
+
+    started = time.perf_counter()
+    repository = open_repository(filename)
+    repository.get("0")
+    opened = time.perf_counter() - started
+
+    codes = [str(random.randrange(products)) for _ in range(lookups)]
+    started = time.perf_counter()
+    for code in codes:
+        repository.get(code)
+    get_time = (time.perf_counter() - started) / lookups
+
+    started = time.perf_counter()
+    repository.list()
+    list_time = time.perf_counter() - started
+    repository.close()
+    return {"size": size, "open": opened, "get": get_time, "list": list_time}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--slot-sizes", type=int, nargs="+", default=[256, 128])
+    args = parser.parse_args()
+    print(f"products={args.products}")
+    with tempfile.TemporaryDirectory() as directory:
+        repositories = [("json", JsonProductRepository)] + [
+            (
+                f"binary {slot_size}",
+                lambda filename, slot_size=slot_size: BinaryFileProductRepository(
+                    filename, slot_size=slot_size
+                ),
+            )
+            for slot_size in args.slot_sizes
+        ]
+        for name, open_repository in repositories:
+            results = measure(
+                open_repository,
+                os.path.join(directory, f"products.{name.replace(' ', '')}"),
+                args.products,
+                args.lookups,
+            )
+            print(
+                f"{name:>10}: {results['size'] / 2**20:7.1f} MiB, "
+                f"open + first get {results['open'] * 1000:8.1f} ms, "
+                f"get {results['get'] * 1e6:8.1f} us, "
+                f"list {results['list']:6.2f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Throughput of the CSV import of manage.py
+
+Generates a CSV file of mixed products and imports it into an in-memory
+repository, so the numbers are those of reading, validating and batching:
+
+    python -m benchmarks.catalog_import --rows 1000000 --workers 0 2
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+from catalog_io import CSV_FIELDS, CatalogImporter
+from repositories import DictProductRepository
+
+
+def write_catalog(filename: str, rows: int):
+    with open(filename, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for code in range(rows):
+            row = {
+                "code": str(code),
+                "name": f"Product {code}",
+                "price": f"{code % 500}.99",
+                "stock": str(code % 40),
+                "available": "yes",
+            }
+            if code % 3 == 1:
+                row.update(product_type="food", expiration_date="2030-01-01")
+            elif code % 3 == 2:
+                row.update(product_type="clothing", size="M", color="red")
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "catalog.csv")
+        write_catalog(filename, args.rows)
+        print(f"rows={args.rows} chunk_size={args.chunk_size} cpus={os.cpu_count()}")
+        for workers in args.workers:
+            importer = CatalogImporter(
+                DictProductRepository(), chunk_size=args.chunk_size, workers=workers
+            )
+            started = time.perf_counter()
+            summary = importer.run(filename)
+            elapsed = time.perf_counter() - started
+            print(
+                f"workers={workers}: {summary['imported']} imported in "
+                f"{elapsed:.1f}s, {summary['imported'] / elapsed:10.0f} rows/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Memory and speed of the in-memory repositories with compact rows
+
+Loads the same products, decoded from JSON like a catalog read from a
+file, into a DictProductRepository storing dictionaries and one storing
+compact rows, then times get, list and a ListProductRepository get:
+
+    python -m benchmarks.compact_rows --products 1000000
+"""
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from collections.abc import MutableSequence
+
+from repositories import DictProductRepository, ListProductRepository
+from row_codec import CompactRowDict, CompactRowList
+
+SIZES = ("XS", "S", "M", "L", "XL")
+COLORS = ("red", "green", "blue", "black", "white", "grey", "navy", "pink")
+
+
+def make_row(number: int) -> dict:
+    row = {
+        "code": str(number),
+        "name": f"Product {number}",
+        "price": round(1 + number % 1000 / 10, 2),
+        "description": None,
+        "stock": number % 300,
+        "available": number % 10 != 0,
+        "product_type": ("product", "electronic", "food", "clothing")[number % 4],
+    }
+    if row["product_type"] == "electronic":
+        row["warranty"] = 12 + number % 3 * 12
+    elif row["product_type"] == "food":
+        row["expiration_date"] = f"2030-{1 + number % 12:02}-{1 + number % 28:02}"
+    elif row["product_type"] == "clothing":
+        row["size"] = SIZES[number % len(SIZES)]
+        row["color"] = COLORS[number % len(COLORS)]
+    row["version"] = 0
+    return row
+
+
+def iter_rows(products: int, chunk_size: int = 10000):
+    """Yield the rows as json.loads returns them, every value its own copy"""
+    for start in range(0, products, chunk_size):
+        chunk = [
+            make_row(number)
+            for number in range(start, min(products, start + chunk_size))
+        ]
+        yield from json.loads(json.dumps(chunk))
+
+
+def load(storage, products: int) -> tuple[object, int]:
+    """Fill storage, return it with the bytes it holds"""
+    gc.collect()
+    tracemalloc.start()
+    if isinstance(storage, MutableSequence):
+        storage.extend(iter_rows(products))
+    else:
+        for row in iter_rows(products):
+            storage[row["code"]] = row
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return storage, size
+
+
+def time_gets(repository, codes) -> float:
+    started = time.perf_counter()
+    for code in codes:
+        repository.get(code)
+    return (time.perf_counter() - started) / len(codes) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--gets", type=int, default=100_000)
+    parser.add_argument("--list-gets", type=int, default=20)
+    args = parser.parse_args()
+    codes = [str(random.randrange(args.products)) for _ in range(args.gets)]
+    print(f"products={args.products}")
+    for name, storage in (("dict", {}), ("compact", CompactRowDict())):
+        storage, size = load(storage, args.products)
+        started = time.perf_counter()
+        repository = DictProductRepository(storage, compact=name == "compact")
+        opened = time.perf_counter() - started
+        get = time_gets(repository, codes)
+        started = time.perf_counter()
+        repository.list()
+        listed = time.perf_counter() - started
+        print(
+            f"DictProductRepository {name:7}: {size / 2**20:7.1f} MiB, "
+            f"{size / args.products:5.0f} B/product, open {opened:5.1f} s, "
+            f"get {get:5.2f} µs, list() {listed:5.2f} s"
+        )
+        if name == "compact":
+            print(f"  {storage.codec.stats()}")
+        del repository, storage
+    for name, storage in (("list", []), ("compact", CompactRowList())):
+        storage, size = load(storage, args.products)
+        repository = ListProductRepository(storage, compact=name == "compact")
+        get = time_gets(repository, codes[: args.list_gets]) / 1000
+        print(
+            f"ListProductRepository {name:7}: {size / 2**20:7.1f} MiB, "
+            f"get {get:5.1f} ms"
+        )
+        del repository, storage
+
+
+if __name__ == "__main__":
+    main()
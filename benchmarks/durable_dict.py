@@ -0,0 +1,77 @@
+"""Write throughput and startup time of DurableDictProductRepository
+
+Runs the same adds with every fsync policy from a few threads, then
+reopens a repository with a snapshot and a log tail:
+
+    python -m benchmarks.durable_dict --writes 5000 --threads 1 16
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from durable_repository import FSYNC_POLICIES, DurableDictProductRepository
+from models import Product
+
+
+def write_products(repository, writes: int, threads: int) -> float:
+    def writer(worker):
+        for number in range(worker, writes, threads):
+            repository.add(Product(str(number), f"Product {number}", number % 500))
+
+    workers = [
+        threading.Thread(target=writer, args=(worker,)) for worker in range(threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=5000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--tail", type=int, default=100_000)
+    args = parser.parse_args()
+    print(f"writes={args.writes} cpus={os.cpu_count()}")
+    for policy in FSYNC_POLICIES:
+        for threads in args.threads:
+            with tempfile.TemporaryDirectory() as directory:
+                repository = DurableDictProductRepository(
+                    directory, fsync=policy, snapshot_interval=None
+                )
+                elapsed = write_products(repository, args.writes, threads)
+                syncs = repository.wal.syncs
+                repository.close(snapshot=False)
+            print(
+                f"fsync={policy:8} threads={threads:2}: "
+                f"{args.writes / elapsed:8.0f} writes/s, {syncs} fsyncs"
+            )
+
+    with tempfile.TemporaryDirectory() as directory:
+        repository = DurableDictProductRepository(
+            directory, fsync="interval", snapshot_interval=None
+        )
+        write_products(repository, args.products, 1)
+        repository.save_snapshot()
+        for number in range(args.tail):
+            repository.add(Product(f"tail-{number}", "Product", 1))
+        repository.close(snapshot=False)
+        started = time.perf_counter()
+        repository = DurableDictProductRepository(directory, snapshot_interval=None)
+        elapsed = time.perf_counter() - started
+        print(
+            f"startup: {len(repository.storage)} products from a snapshot of "
+            f"{args.products} and a log tail of {args.tail} in {elapsed:.2f}s"
+        )
+        repository.close(snapshot=False)
+
+
+if __name__ == "__main__":
+    main()
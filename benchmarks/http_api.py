@@ -0,0 +1,120 @@
+"""Requests per second and latency of the HTTP JSON API
+
+Serves a DictProductRepository from another process and keeps --clients
+keep-alive connections busy for --seconds with a mix of GETs, conditional
+GETs answered 304, list pages and searches:
+
+    python -m benchmarks.http_api --clients 32 --seconds 10
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+
+from async_repositories import AsyncProductRepository
+from http_api import KeepAliveClient, ProductAPIServer
+from models import Product
+from repositories import DictProductRepository
+from services import AsyncProductService
+from workload import percentile
+
+# kind -> share of the requests
+MIX = {"get": 0.5, "get_304": 0.3, "list_page": 0.1, "search": 0.1}
+
+
+def serve(products: int, workers: int, ports):
+    repository = DictProductRepository(thread_safe=True)
+    repository.add_many(
+        Product(str(code), f"Product {code}", 1 + code % 100, stock=code % 50)
+        for code in range(products)
+    )
+    service = AsyncProductService(
+        AsyncProductRepository(repository, max_concurrency=workers)
+    )
+
+    async def run():
+        server = ProductAPIServer(service, port=0)
+        await server.start()
+        ports.put(server.port)
+        await server.serve_forever()
+
+    asyncio.run(run())
+
+
+async def client(port: int, products: int, deadline: float, latencies: dict):
+    connection = KeepAliveClient("127.0.0.1", port)
+    etags = {}
+    kinds = list(MIX)
+    weights = list(MIX.values())
+    while time.perf_counter() < deadline:
+        kind = random.choices(kinds, weights)[0]
+        code = str(random.randrange(products))
+        headers = None
+        if kind == "get_304":
+            headers = {"If-None-Match": etags.get(code, '"0"')}
+        path = {
+            "get": f"/products/{code}",
+            "get_304": f"/products/{code}",
+            "list_page": f"/products?offset={random.randrange(1000)}&limit=20",
+            "search": f"/search?q=product+{code}",
+        }[kind]
+        started = time.perf_counter()
+        status, response_headers, _ = await connection.request(
+            "GET", path, headers=headers
+        )
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        if kind == "get":
+            etags[code] = response_headers.get("etag")
+        elif kind == "get_304" and status != 304:
+            raise AssertionError(f"Expected 304, got {status}")
+    await connection.close()
+
+
+async def load(port: int, products: int, clients: int, seconds: float) -> dict:
+    latencies: dict[str, list[float]] = {}
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(
+        *(client(port, products, deadline, latencies) for _ in range(clients))
+    )
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument(
+        "--workers", type=int, default=4, help="repository threads of the server"
+    )
+    args = parser.parse_args()
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(args.products, args.workers, ports), daemon=True
+    )
+    server.start()
+    port = ports.get(timeout=60)
+    # Warm up the connections and caches
+    asyncio.run(load(port, args.products, args.clients, 1))
+    latencies = asyncio.run(load(port, args.products, args.clients, args.seconds))
+    server.terminate()
+    everything = sorted(value for values in latencies.values() for value in values)
+    print(
+        f"clients={args.clients} workers={args.workers} products={args.products}: "
+        f"{len(everything) / args.seconds:.0f} requests/s, "
+        f"p50 {percentile(everything, 0.5) * 1000:.2f} ms, "
+        f"p99 {percentile(everything, 0.99) * 1000:.2f} ms"
+    )
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        print(
+            f"  {kind:9}: {len(values) / args.seconds:7.0f} requests/s, "
+            f"p50 {percentile(values, 0.5) * 1000:6.2f} ms, "
+            f"p99 {percentile(values, 0.99) * 1000:6.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Latency of the MySQL repository with and without the statement cache
+
+Runs get, update and adjust_stock through MySQLProductRepository against a
+local stand-in for the server that spends a round trip per packet, a parse
+per statement text it receives and a handshake per connection; prepared
+statements are parsed once but, like mysql-connector does, reset before
+every execution, which costs a round trip:
+
+    python -m benchmarks.statement_cache --operations 2000 --rtt 100 --parse 60
+"""
+
+import argparse
+import time
+
+from db.connectors import MySqlConnector
+from models import FoodProduct
+from repositories import MySQLProductRepository
+
+ROW = {
+    "code": "1",
+    "name": "Milk",
+    "price": 2.0,
+    "description": None,
+    "stock": 100,
+    "available": 1,
+    "product_type": "food",
+    "version": 0,
+}
+
+
+def spin(microseconds: float):
+    """Wait without sleeping, sleeps are too coarse for a few microseconds"""
+    until = time.perf_counter() + microseconds / 1e6
+    while time.perf_counter() < until:
+        pass
+
+
+class StandInServer:
+    def __init__(self, rtt: float, parse: float, connect: float):
+        self.rtt = rtt
+        self.parse = parse
+        self.connect_cost = connect
+        self.connections = 0
+        self.parses = 0
+
+    def connect(self, **options):
+        self.connections += 1
+        spin(self.connect_cost)
+        return StandInConnection(self)
+
+
+class StandInCursor:
+    def __init__(self, server: StandInServer, prepared: bool):
+        self.server = server
+        self.prepared = prepared
+        self._statement = None
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        server = self.server
+        if self.prepared:
+            if query is not self._statement:
+                spin(server.rtt + server.parse)
+                server.parses += 1
+                self._statement = query
+            spin(2 * server.rtt)
+        else:
+            spin(server.rtt + server.parse)
+            server.parses += 1
+        if query.startswith("SELECT * FROM food"):
+            self.rows = [{"code": "1", "expiration_date": "2030-01-01"}]
+        elif query.startswith("SELECT"):
+            self.rows = [dict(ROW)]
+        self.rowcount = 1
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    def __init__(self, server: StandInServer):
+        self.server = server
+        self.connected = True
+
+    def cursor(self, prepared=False, dictionary=False):
+        return StandInCursor(self.server, prepared)
+
+    def is_connected(self):
+        return self.connected
+
+    def commit(self):
+        spin(self.server.rtt)
+
+    def rollback(self):
+        spin(self.server.rtt)
+
+    def close(self):
+        self.connected = False
+
+
+def run(args, cache_size: int) -> dict:
+    server = StandInServer(args.rtt, args.parse, args.connect)
+    settings = {"DB_NAME": "products", "DB_PORT": 3306}
+    connector = MySqlConnector(
+        lambda option, default=None: settings.get(option, default),
+        connect=server.connect,
+        statement_cache_size=cache_size,
+    )
+    repository = MySQLProductRepository(connector)
+    product = FoodProduct(
+        "1", "Milk", 2, stock=100, product_type="food", expiration_date="2030-01-01"
+    )
+    timings = {"get": 0.0, "update": 0.0, "adjust_stock": 0.0}
+    for number in range(args.operations):
+        started = time.perf_counter()
+        repository.get("1")
+        timings["get"] += time.perf_counter() - started
+        started = time.perf_counter()
+        product.stock = number
+        repository.update(product)
+        timings["update"] += time.perf_counter() - started
+        started = time.perf_counter()
+        repository.adjust_stock("1", 1)
+        timings["adjust_stock"] += time.perf_counter() - started
+    result = {name: total / args.operations * 1e6 for name, total in timings.items()}
+    result.update(
+        connections=server.connections,
+        parses=server.parses,
+        stats=connector.statement_stats(),
+    )
+    connector.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--operations", type=int, default=2000)
+    parser.add_argument("--rtt", type=float, default=100, help="µs per round trip")
+    parser.add_argument("--parse", type=float, default=60, help="µs per parse")
+    parser.add_argument(
+        "--connect", type=float, default=1000, help="µs per new connection"
+    )
+    parser.add_argument("--cache-size", type=int, default=64)
+    args = parser.parse_args()
+    print(
+        f"operations={args.operations} rtt={args.rtt}µs parse={args.parse}µs "
+        f"connect={args.connect}µs"
+    )
+    for cache_size in (0, args.cache_size):
+        result = run(args, cache_size)
+        print(
+            f"cache={cache_size:3}: get {result['get']:6.0f}µs, "
+            f"update {result['update']:6.0f}µs, "
+            f"adjust_stock {result['adjust_stock']:6.0f}µs, "
+            f"{result['connections']} connections, {result['parses']} parses"
+        )
+        if result["stats"]:
+            print(f"           {result['stats']}")
+
+
+if __name__ == "__main__":
+    main()
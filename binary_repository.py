@@ -0,0 +1,540 @@
+import datetime
+import hashlib
+import mmap
+import os
+import struct
+
+from models import BaseProduct, ProductFactory
+from repositories import (
+    BaseProductRepository,
+    ProductNotFoundError,
+    VersionConflictError,
+)
+
+PRODUCT_TYPES = tuple(BaseProduct.get_product_types())
+
+# Data file: a header, then slots of slot_size bytes holding one product each
+DATA_MAGIC = b"PRDB"
+FORMAT_VERSION = 1
+# magic, format version, slot size, slots in the file, slots ever used,
+# first free slot (-1 for none), products stored
+DATA_HEADER = struct.Struct("<4sHIQQqQ")
+DATA_HEADER_SIZE = 64
+# status (FREE or USED) and length of the record
+SLOT_HEADER = struct.Struct("<BH")
+FREE, USED = 0, 1
+# Next slot of the free list, in the record of a free slot
+FREE_LINK = struct.Struct("<q")
+# price, stock, available, product type, version
+RECORD_FIELDS = struct.Struct("<dqBBI")
+TEXT_LENGTH = struct.Struct("<H")
+NO_TEXT = 0xFFFF
+INTEGER = struct.Struct("<q")
+
+# Index file: a header, then an open addressing table of (hash, slot + 1)
+INDEX_MAGIC = b"PRIX"
+# magic, buckets, products indexed, buckets used (products and tombstones)
+INDEX_HEADER = struct.Struct("<4sQQQ")
+INDEX_HEADER_SIZE = 32
+BUCKET = struct.Struct("<QQ")
+EMPTY, TOMBSTONE = 0, 2**64 - 1
+MAX_LOAD = 0.7
+
+
+def code_hash(code: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(code.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def _pack_text(value: str | None) -> bytes:
+    if value is None:
+        return TEXT_LENGTH.pack(NO_TEXT)
+    data = value.encode("utf-8")
+    if len(data) >= NO_TEXT:
+        raise ValueError("Text too long to be stored")
+    return TEXT_LENGTH.pack(len(data)) + data
+
+
+def _unpack_text(buffer, offset: int) -> tuple[str | None, int]:
+    (length,) = TEXT_LENGTH.unpack_from(buffer, offset)
+    offset += TEXT_LENGTH.size
+    if length == NO_TEXT:
+        return None, offset
+    return bytes(buffer[offset : offset + length]).decode("utf-8"), offset + length
+
+
+def pack_product(product_data: dict) -> bytes:
+    """Encode a product dictionary, with its version, as a record"""
+    product_type = product_data.get("product_type", "product")
+    record = [
+        _pack_text(product_data["code"]),
+        RECORD_FIELDS.pack(
+            product_data["price"],
+            product_data["stock"],
+            product_data["available"],
+            PRODUCT_TYPES.index(product_type),
+            product_data.get("version", 0),
+        ),
+        _pack_text(product_data["name"]),
+        _pack_text(product_data["description"]),
+    ]
+    if product_type == "electronic":
+        record.append(INTEGER.pack(product_data["warranty"]))
+    elif product_type == "food":
+        expiration_date = product_data["expiration_date"]
+        record.append(
+            INTEGER.pack(
+                datetime.date.fromisoformat(expiration_date).toordinal()
+                if expiration_date
+                else 0
+            )
+        )
+    elif product_type == "clothing":
+        record.append(_pack_text(product_data["size"]))
+        record.append(_pack_text(product_data["color"]))
+    return b"".join(record)
+
+
+def unpack_product(buffer, offset: int = 0) -> dict:
+    """Decode a record back into the dictionary given to pack_product"""
+    code, offset = _unpack_text(buffer, offset)
+    price, stock, available, type_number, version = RECORD_FIELDS.unpack_from(
+        buffer, offset
+    )
+    offset += RECORD_FIELDS.size
+    name, offset = _unpack_text(buffer, offset)
+    description, offset = _unpack_text(buffer, offset)
+    product_type = PRODUCT_TYPES[type_number]
+    product_data = {
+        "code": code,
+        "name": name,
+        "price": price,
+        "description": description,
+        "stock": stock,
+        "available": bool(available),
+        "product_type": product_type,
+        "version": version,
+    }
+    if product_type == "electronic":
+        (product_data["warranty"],) = INTEGER.unpack_from(buffer, offset)
+    elif product_type == "food":
+        (ordinal,) = INTEGER.unpack_from(buffer, offset)
+        product_data["expiration_date"] = (
+            datetime.date.fromordinal(ordinal).isoformat() if ordinal else None
+        )
+    elif product_type == "clothing":
+        product_data["size"], offset = _unpack_text(buffer, offset)
+        product_data["color"], offset = _unpack_text(buffer, offset)
+    return product_data
+
+
+class BinaryFileProductRepository(BaseProductRepository):
+    """Repository that stores products in fixed size slots of a binary file
+
+    Every product takes one slot of slot_size bytes, so it is found at
+    header + slot * slot_size. A second file, "<filename>.idx", is a
+    memory mapped hash table from the codes to their slots: get, update and
+    delete read or write one slot and never the rest of the file. Deleted
+    slots go to a free list reused by the next adds; compact() rewrites the
+    file without them. The files are meant for a single process.
+    """
+
+    def __init__(
+        self, filename: str, slot_size: int = 256, event_bus=None, index_buckets=1024
+    ):
+        self.filename = filename
+        self.index_filename = f"{filename}.idx"
+        self.event_bus = event_bus
+        self._data_file = None
+        self._data = None
+        self._index_file = None
+        self._index = None
+        self._open_data(slot_size)
+        self._open_index(index_buckets)
+
+    # Data file
+
+    def _open_data(self, slot_size: int):
+        exists = os.path.exists(self.filename) and os.path.getsize(self.filename)
+        self._data_file = open(self.filename, "r+b" if exists else "w+b")
+        if exists:
+            self._data = mmap.mmap(self._data_file.fileno(), 0)
+            magic, version, slot_size, *_ = DATA_HEADER.unpack_from(self._data)
+            if magic != DATA_MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"{self.filename} is not a product file")
+        else:
+            self._data_file.truncate(DATA_HEADER_SIZE)
+            self._data = mmap.mmap(self._data_file.fileno(), 0)
+            self._write_header(slot_size, 0, 0, -1, 0)
+        self.slot_size = slot_size
+
+    def _read_header(self) -> tuple[int, int, int, int]:
+        """Return the slots in the file, slots used, free slot and count"""
+        return DATA_HEADER.unpack_from(self._data)[3:]
+
+    def _write_header(self, slot_size, slots, used, free, count):
+        DATA_HEADER.pack_into(
+            self._data,
+            0,
+            DATA_MAGIC,
+            FORMAT_VERSION,
+            slot_size,
+            slots,
+            used,
+            free,
+            count,
+        )
+
+    def _update_header(self, **values):
+        slots, used, free, count = self._read_header()
+        current = {"slots": slots, "used": used, "free": free, "count": count}
+        current.update(values)
+        self._write_header(self.slot_size, **current)
+
+    def _slot_offset(self, slot: int) -> int:
+        return DATA_HEADER_SIZE + slot * self.slot_size
+
+    def _read_slot(self, slot: int) -> dict | None:
+        offset = self._slot_offset(slot)
+        status, _ = SLOT_HEADER.unpack_from(self._data, offset)
+        if status != USED:
+            return None
+        return unpack_product(self._data, offset + SLOT_HEADER.size)
+
+    def _read_slot_code(self, slot: int) -> str | None:
+        offset = self._slot_offset(slot)
+        status, _ = SLOT_HEADER.unpack_from(self._data, offset)
+        if status != USED:
+            return None
+        return _unpack_text(self._data, offset + SLOT_HEADER.size)[0]
+
+    def _write_slot(self, slot: int, record: bytes):
+        if SLOT_HEADER.size + len(record) > self.slot_size:
+            raise ValueError(
+                f"Product takes {len(record)} bytes, more than the "
+                f"{self.slot_size - SLOT_HEADER.size} of a slot"
+            )
+        offset = self._slot_offset(slot)
+        SLOT_HEADER.pack_into(self._data, offset, USED, len(record))
+        start = offset + SLOT_HEADER.size
+        self._data[start : start + len(record)] = record
+
+    def _grow_data(self, slots: int):
+        self._data.flush()
+        self._data.close()
+        self._data_file.truncate(self._slot_offset(slots))
+        self._data = mmap.mmap(self._data_file.fileno(), 0)
+        self._update_header(slots=slots)
+
+    def _allocate_slot(self) -> int:
+        slots, used, free, _ = self._read_header()
+        if free >= 0:
+            (next_free,) = FREE_LINK.unpack_from(
+                self._data, self._slot_offset(free) + SLOT_HEADER.size
+            )
+            self._update_header(free=next_free)
+            return free
+        if used == slots:
+            self._grow_data(slots + max(64, slots // 4))
+        self._update_header(used=used + 1)
+        return used
+
+    def _release_slot(self, slot: int):
+        _, _, free, _ = self._read_header()
+        offset = self._slot_offset(slot)
+        SLOT_HEADER.pack_into(self._data, offset, FREE, FREE_LINK.size)
+        FREE_LINK.pack_into(self._data, offset + SLOT_HEADER.size, free)
+        self._update_header(free=slot)
+
+    # Index file
+
+    def _open_index(self, buckets: int):
+        if os.path.exists(self.index_filename):
+            self._index_file = open(self.index_filename, "r+b")
+            self._index = mmap.mmap(self._index_file.fileno(), 0)
+            magic, _, count, _ = INDEX_HEADER.unpack_from(self._index)
+            if magic == INDEX_MAGIC and count == self._read_header()[3]:
+                return
+            # Left behind by a crash, build it again from the data file
+            self._index.close()
+            self._index_file.close()
+        self._rebuild_index(max(buckets, int(self._read_header()[3] / MAX_LOAD) + 1))
+
+    def _rebuild_index(self, buckets: int):
+        """Write a new index of the given number of buckets from the slots"""
+        if self._index is not None and not self._index.closed:
+            self._index.close()
+            self._index_file.close()
+        temp_filename = f"{self.index_filename}.tmp"
+        with open(temp_filename, "w+b") as file:
+            file.truncate(INDEX_HEADER_SIZE + buckets * BUCKET.size)
+        os.replace(temp_filename, self.index_filename)
+        self._index_file = open(self.index_filename, "r+b")
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, buckets, 0, 0)
+        _, used, _, _ = self._read_header()
+        for slot in range(used):
+            code = self._read_slot_code(slot)
+            if code is not None:
+                bucket, _ = self._find(code)
+                self._set_bucket(bucket, code_hash(code), slot + 1, new=True)
+
+    def _bucket_offset(self, bucket: int) -> int:
+        return INDEX_HEADER_SIZE + bucket * BUCKET.size
+
+    def _find(self, code: str) -> tuple[int, int | None]:
+        """Return the bucket of the code and its slot, or the bucket where to
+        insert it and None"""
+        _, buckets, _, _ = INDEX_HEADER.unpack_from(self._index)
+        hashed = code_hash(code)
+        bucket = hashed % buckets
+        tombstone = None
+        while True:
+            bucket_hash, reference = BUCKET.unpack_from(
+                self._index, self._bucket_offset(bucket)
+            )
+            if reference == EMPTY:
+                return (bucket if tombstone is None else tombstone), None
+            if reference == TOMBSTONE:
+                if tombstone is None:
+                    tombstone = bucket
+            elif bucket_hash == hashed and self._read_slot_code(reference - 1) == code:
+                return bucket, reference - 1
+            bucket = (bucket + 1) % buckets
+
+    def _set_bucket(self, bucket: int, hashed: int, reference: int, new: bool):
+        magic, buckets, count, used = INDEX_HEADER.unpack_from(self._index)
+        _, previous = BUCKET.unpack_from(self._index, self._bucket_offset(bucket))
+        BUCKET.pack_into(self._index, self._bucket_offset(bucket), hashed, reference)
+        if new:
+            count += 1
+            used += previous == EMPTY
+        elif reference == TOMBSTONE:
+            count -= 1
+        INDEX_HEADER.pack_into(self._index, 0, magic, buckets, count, used)
+
+    def _index_slot(self, code: str, slot: int):
+        _, buckets, _, used = INDEX_HEADER.unpack_from(self._index)
+        if used + 1 > buckets * MAX_LOAD:
+            # The rebuilt index already holds the slot
+            self._rebuild_index(buckets * 2)
+        bucket, indexed_slot = self._find(code)
+        if indexed_slot is None:
+            self._set_bucket(bucket, code_hash(code), slot + 1, new=True)
+
+    # Repository
+
+    def add(self, product: BaseProduct):
+        _, slot = self._find(product.code)
+        if slot is not None:
+            return
+        product_data = {**product.to_dict(), "version": 0}
+        record = pack_product(product_data)
+        slot = self._allocate_slot()
+        try:
+            self._write_slot(slot, record)
+        except ValueError:
+            self._release_slot(slot)
+            raise
+        _, _, _, count = self._read_header()
+        self._update_header(count=count + 1)
+        self._index_slot(product.code, slot)
+        self._publish_change(None, product_data)
+
+    def get(self, product_id: int | str) -> BaseProduct | None:
+        _, slot = self._find(str(product_id))
+        if slot is None:
+            return None
+        return self._deserialize_product(self._read_slot(slot))
+
+    def list(self) -> dict[str, BaseProduct]:
+        return {
+            product_data["code"]: self._deserialize_product(product_data)
+            for product_data in self._iter_product_data()
+        }
+
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        _, slot = self._find(product.code)
+        if slot is None:
+            raise ProductNotFoundError(f"Product with code {product.code} not found")
+        old_data = self._read_slot(slot)
+        if expected_version is not None and old_data["version"] != expected_version:
+            raise VersionConflictError(
+                f"Product with code {product.code} is at version "
+                f"{old_data['version']}, not {expected_version}"
+            )
+        product_data = {**product.to_dict(), "version": old_data["version"] + 1}
+        self._write_slot(slot, pack_product(product_data))
+        self._publish_change(old_data, product_data)
+
+    def delete(self, product_id: int | str):
+        bucket, slot = self._find(str(product_id))
+        if slot is None:
+            raise ValueError(f"Product with code {product_id} not found")
+        old_data = self._read_slot(slot)
+        self._set_bucket(bucket, 0, TOMBSTONE, new=False)
+        self._release_slot(slot)
+        _, _, _, count = self._read_header()
+        self._update_header(count=count - 1)
+        self._publish_change(old_data, None)
+        return True
+
+    def _iter_product_data(self):
+        _, used, _, _ = self._read_header()
+        for slot in range(used):
+            product_data = self._read_slot(slot)
+            if product_data is not None:
+                yield product_data
+
+    def compact(self) -> dict[str, int]:
+        """Rewrite the file without the free slots, return its size before
+        and after"""
+        size_before = os.path.getsize(self.filename)
+        _, _, _, count = self._read_header()
+        temp_filename = f"{self.filename}.tmp"
+        with open(temp_filename, "w+b") as file:
+            file.truncate(self._slot_offset(count))
+            compacted = mmap.mmap(file.fileno(), 0)
+            DATA_HEADER.pack_into(
+                compacted,
+                0,
+                DATA_MAGIC,
+                FORMAT_VERSION,
+                self.slot_size,
+                count,
+                count,
+                -1,
+                count,
+            )
+            _, used, _, _ = self._read_header()
+            position = self._slot_offset(0)
+            for slot in range(used):
+                offset = self._slot_offset(slot)
+                status, _ = SLOT_HEADER.unpack_from(self._data, offset)
+                if status == USED:
+                    compacted[position : position + self.slot_size] = self._data[
+                        offset : offset + self.slot_size
+                    ]
+                    position += self.slot_size
+            compacted.flush()
+            compacted.close()
+        self._data.close()
+        self._data_file.close()
+        os.replace(temp_filename, self.filename)
+        self._open_data(self.slot_size)
+        self._rebuild_index(max(1024, int(count / MAX_LOAD) + 1))
+        return {"before": size_before, "after": os.path.getsize(self.filename)}
+
+    def flush(self):
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        for mapping, file in (
+            (self._data, self._data_file),
+            (self._index, self._index_file),
+        ):
+            if mapping is not None and not mapping.closed:
+                mapping.flush()
+                mapping.close()
+            if file is not None:
+                file.close()
+
+    def __str__(self):
+        return f"BinaryFileProductRepository({self.filename})"
+
+    def _deserialize_product(self, product_data: dict):
+        return ProductFactory().create_product(**product_data)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+
+    from models import ClothingProduct, ElectronicProduct, FoodProduct, Product
+
+    class TestBinaryFileProductRepository(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+            self.filename = os.path.join(self.directory.name, "products.bin")
+            self.repository = BinaryFileProductRepository(self.filename)
+
+        def tearDown(self):
+            self.repository.close()
+            self.directory.cleanup()
+
+        def reopen(self) -> BinaryFileProductRepository:
+            self.repository.close()
+            self.repository = BinaryFileProductRepository(self.filename)
+            return self.repository
+
+        def test_round_trip_every_type(self):
+            products = [
+                Product("1", "Product", 10.5, "Ñandú", stock=3),
+                ElectronicProduct(
+                    "2", "Phone", 300, warranty=24, product_type="electronic"
+                ),
+                FoodProduct(
+                    "3", "Milk", 1, product_type="food", expiration_date="2030-01-01"
+                ),
+                FoodProduct("4", "Salt", 1, product_type="food"),
+                ClothingProduct("5", "Shirt", 20, size="M", product_type="clothing"),
+            ]
+            for product in products:
+                self.repository.add(product)
+            repository = self.reopen()
+            for product in products:
+                self.assertEqual(
+                    repository.get(product.code).to_dict(), product.to_dict()
+                )
+            self.assertEqual(len(repository.list()), 5)
+
+        def test_update_and_delete(self):
+            self.repository.add(Product("1", "Product", 10))
+            self.repository.update(Product("1", "Updated", 20), expected_version=0)
+            with self.assertRaises(VersionConflictError):
+                self.repository.update(Product("1", "Stale", 20), expected_version=0)
+            self.assertEqual(self.repository.get("1").name, "Updated")
+            self.repository.delete("1")
+            self.assertIsNone(self.repository.get("1"))
+            with self.assertRaises(ValueError):
+                self.repository.delete("1")
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.update(Product("1", "Gone", 1))
+
+        def test_free_slots_are_reused_and_compacted(self):
+            for code in range(100):
+                self.repository.add(Product(str(code), f"Product {code}", code))
+            for code in range(0, 100, 2):
+                self.repository.delete(str(code))
+            size = os.path.getsize(self.filename)
+            for code in range(100, 150):
+                self.repository.add(Product(str(code), f"Product {code}", code))
+            self.assertEqual(os.path.getsize(self.filename), size)
+            for code in range(100, 150):
+                self.repository.delete(str(code))
+            sizes = self.repository.compact()
+            self.assertLess(sizes["after"], sizes["before"])
+            repository = self.reopen()
+            self.assertEqual(
+                sorted(repository.list(), key=int), [str(c) for c in range(1, 100, 2)]
+            )
+            self.assertEqual(repository.get("51").price, 51)
+
+        def test_index_grows_and_is_rebuilt(self):
+            for code in range(3000):
+                self.repository.add(Product(str(code), "Product", 1))
+            self.repository.close()
+            os.remove(f"{self.filename}.idx")
+            repository = self.reopen()
+            self.assertEqual(repository.get("2999").code, "2999")
+            self.assertIsNone(repository.get("3000"))
+
+        def test_too_large_product(self):
+            with self.assertRaises(ValueError):
+                self.repository.add(Product("1", "Product", 1, "x" * 1000))
+            self.repository.add(Product("2", "Product", 1))
+            self.assertEqual(list(self.repository.list()), ["2"])
+
+    unittest.main()
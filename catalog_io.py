@@ -0,0 +1,366 @@
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from itertools import islice
+
+from loggers import logger
+from models import (
+    BaseProduct,
+    ClothingProduct,
+    ElectronicProduct,
+    FoodProduct,
+    ProductFactory,
+    convert_product_data,
+)
+from repositories import BaseProductRepository
+
+FORMATS = ("csv", "jsonl")
+
+# Columns of the CSV files, the fields of every product type
+CSV_FIELDS = tuple(
+    dict.fromkeys(
+        BaseProduct.get_field_names()
+        + ElectronicProduct.get_field_names()
+        + FoodProduct.get_field_names()
+        + ClothingProduct.get_field_names()
+    )
+)
+
+
+def guess_format(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lstrip(".").lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown file format: {filename}, use csv or jsonl")
+    return extension
+
+
+def read_rows(filename: str, file_format: str, skip: int = 0):
+    """Yield (number, row) for the rows of a file, one at a time
+
+    CSV rows are dictionaries, JSONL rows the text of the line, parsed later
+    by the validation workers. Rows are numbered from 1, the first skip are
+    not yielded.
+    """
+    with open(filename, newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            rows = csv.DictReader(file)
+        else:
+            rows = (line for line in file)
+        for number, row in enumerate(rows, start=1):
+            if number <= skip:
+                continue
+            if isinstance(row, str) and not row.strip():
+                continue
+            yield number, row
+
+
+def parse_row(row: dict | str) -> dict:
+    """Return the product data of a row, typed like the products expect"""
+    if isinstance(row, str):
+        row = json.loads(row)
+        if not isinstance(row, dict):
+            raise ValueError("A line must hold a JSON object")
+    # Blank cells take the default value of the field
+    data = {key: value for key, value in row.items() if value not in ("", None)}
+    return convert_product_data(data)
+
+
+def validate_rows(rows: list[tuple[int, dict | str]]):
+    """Build the products of a chunk of rows, in a worker process
+
+    Return the (number, product) pairs of the valid rows and the
+    (number, row, error) triples of the others.
+    """
+    products = []
+    rejects = []
+    factory = ProductFactory()
+    for number, row in rows:
+        try:
+            products.append((number, factory.create_product(**parse_row(row))))
+        except (ValueError, TypeError, KeyError) as error:
+            rejects.append((number, row, str(error)))
+    return products, rejects
+
+
+class InlineExecutor(Executor):
+    """Executor running the work in the calling thread, for workers=0"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
+
+
+class CatalogImporter:
+    """Load a CSV or JSONL file of products into a repository
+
+    The file is read in chunks of chunk_size rows, validated by a pool of
+    workers processes and written with one add_many per chunk. After every
+    chunk the number of the last row written is saved to the checkpoint
+    file, and an interrupted import started again goes on from there. Rows
+    that can't be turned into products, or written, go to the rejects file
+    as JSON lines with their error.
+    """
+
+    def __init__(
+        self,
+        repository: BaseProductRepository,
+        chunk_size: int = 1000,
+        workers: int | None = None,
+        progress=None,
+    ):
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be positive")
+        self.repository = repository
+        self.chunk_size = chunk_size
+        self.workers = os.cpu_count() if workers is None else workers
+        self.progress = progress
+
+    def run(
+        self,
+        filename: str,
+        file_format: str | None = None,
+        checkpoint_filename: str | None = None,
+        rejects_filename: str | None = None,
+    ) -> dict:
+        """Import the file, return the counts of imported and rejected rows"""
+        file_format = file_format or guess_format(filename)
+        checkpoint_filename = checkpoint_filename or f"{filename}.checkpoint"
+        rejects_filename = rejects_filename or f"{filename}.rejects.jsonl"
+        checkpoint = self.load_checkpoint(checkpoint_filename, filename)
+        summary = {
+            "imported": checkpoint.get("imported", 0),
+            "rejected": checkpoint.get("rejected", 0),
+            "resumed_after": checkpoint.get("row", 0),
+        }
+        started = time.perf_counter()
+        rows = read_rows(filename, file_format, skip=summary["resumed_after"])
+        chunks = iter(lambda: list(islice(rows, self.chunk_size)), [])
+        rejects_mode = "a" if checkpoint else "w"
+        executor = (
+            ProcessPoolExecutor(self.workers) if self.workers else InlineExecutor()
+        )
+        with executor, open(
+            rejects_filename, rejects_mode, encoding="utf-8"
+        ) as rejects:
+            # Only a few chunks are in flight, the file is never read whole
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk[-1][0], executor.submit(validate_rows, chunk)))
+                if len(pending) > max(self.workers, 1) * 2:
+                    self._write_chunk(*pending.popleft(), rejects, summary)
+                    self.save_checkpoint(checkpoint_filename, filename, summary)
+            while pending:
+                self._write_chunk(*pending.popleft(), rejects, summary)
+                self.save_checkpoint(checkpoint_filename, filename, summary)
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+        summary["seconds"] = round(time.perf_counter() - started, 3)
+        logger.info("Import of %s finished: %s", filename, summary)
+        return summary
+
+    def _write_chunk(self, last_row: int, future, rejects, summary: dict):
+        products, rejected = future.result()
+        imported = len(products)
+        try:
+            self.repository.add_many(product for _, product in products)
+        except Exception:
+            # Find the culprits one product at a time
+            for number, product in products:
+                try:
+                    self.repository.add_many([product])
+                except Exception as error:
+                    rejected.append((number, product.to_dict(), str(error)))
+                    imported -= 1
+        for number, row, error in sorted(rejected, key=lambda reject: reject[0]):
+            record = {"row": number, "error": error, "data": row}
+            rejects.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        rejects.flush()
+        summary["imported"] += imported
+        summary["rejected"] += len(rejected)
+        summary["row"] = last_row
+        if self.progress is not None:
+            self.progress(summary)
+
+    @staticmethod
+    def load_checkpoint(checkpoint_filename: str, filename: str) -> dict:
+        try:
+            with open(checkpoint_filename, encoding="utf-8") as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return {}
+        if checkpoint.get("source") != os.path.abspath(filename):
+            raise ValueError(
+                f"Checkpoint {checkpoint_filename} belongs to {checkpoint.get('source')}"
+            )
+        return checkpoint
+
+    @staticmethod
+    def save_checkpoint(checkpoint_filename: str, filename: str, summary: dict):
+        checkpoint = {
+            "source": os.path.abspath(filename),
+            "row": summary["row"],
+            "imported": summary["imported"],
+            "rejected": summary["rejected"],
+        }
+        temp_filename = f"{checkpoint_filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as file:
+            json.dump(checkpoint, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, checkpoint_filename)
+
+
+def export_products(
+    repository: BaseProductRepository,
+    filename: str,
+    file_format: str | None = None,
+    batch_size: int = 1000,
+) -> int:
+    """Write every product to a CSV or JSONL file, return how many"""
+    file_format = file_format or guess_format(filename)
+    exported = 0
+    with open(filename, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+        for products in repository.iter_batches(batch_size):
+            for product in products:
+                if file_format == "csv":
+                    writer.writerow(product.to_dict())
+                else:
+                    file.write(json.dumps(product.to_dict(), ensure_ascii=False))
+                    file.write("\n")
+            exported += len(products)
+    return exported
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+
+    from models import Product
+    from repositories import DictProductRepository, JsonProductRepository
+
+    class TestCatalogImport(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+
+        def tearDown(self):
+            self.directory.cleanup()
+
+        def path(self, name: str) -> str:
+            return os.path.join(self.directory.name, name)
+
+        def write_csv(self, name: str, rows: list[dict]) -> str:
+            filename = self.path(name)
+            with open(filename, "w", newline="", encoding="utf-8") as file:
+                writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            return filename
+
+        def read_rejects(self, filename: str) -> list[dict]:
+            with open(f"{filename}.rejects.jsonl", encoding="utf-8") as file:
+                return [json.loads(line) for line in file]
+
+        def test_import_csv(self):
+            filename = self.write_csv(
+                "products.csv",
+                [
+                    {
+                        "code": "1",
+                        "name": "Milk",
+                        "price": "1.5",
+                        "stock": "3",
+                        "product_type": "food",
+                        "expiration_date": "2030-01-01",
+                    },
+                    {
+                        "code": "2",
+                        "name": "Phone",
+                        "price": "abc",
+                        "product_type": "electronic",
+                    },
+                    {
+                        "code": "3",
+                        "name": "Shirt",
+                        "price": "20",
+                        "stock": "1",
+                        "available": "no",
+                        "product_type": "clothing",
+                        "size": "M",
+                    },
+                ],
+            )
+            repository = DictProductRepository()
+            summary = CatalogImporter(repository, chunk_size=2, workers=2).run(filename)
+            self.assertEqual((summary["imported"], summary["rejected"]), (2, 1))
+            self.assertEqual(repository.get("1").expiration_date, "2030-01-01")
+            self.assertFalse(repository.get("3").available)
+            self.assertEqual(self.read_rejects(filename)[0]["row"], 2)
+            self.assertFalse(os.path.exists(f"{filename}.checkpoint"))
+
+        def test_export_and_import_jsonl(self):
+            source = DictProductRepository()
+            for code in range(25):
+                source.add(Product(str(code), f"Product {code}", code, stock=1))
+            filename = self.path("products.jsonl")
+            self.assertEqual(export_products(source, filename, batch_size=10), 25)
+            with open(filename, "a", encoding="utf-8") as file:
+                file.write("not json\n")
+            target = JsonProductRepository(self.path("products.json"))
+            summary = CatalogImporter(target, chunk_size=10, workers=0).run(filename)
+            self.assertEqual((summary["imported"], summary["rejected"]), (25, 1))
+            self.assertEqual(
+                {code: p.to_dict() for code, p in target.list().items()},
+                {code: p.to_dict() for code, p in source.list().items()},
+            )
+            target.close()
+
+        def test_resume_from_checkpoint(self):
+            filename = self.write_csv(
+                "products.csv",
+                [
+                    {"code": str(code), "name": "Product", "price": "1"}
+                    for code in range(10)
+                ],
+            )
+            repository = DictProductRepository()
+            CatalogImporter.save_checkpoint(
+                f"{filename}.checkpoint",
+                filename,
+                {"row": 6, "imported": 6, "rejected": 0},
+            )
+            summary = CatalogImporter(repository, chunk_size=3, workers=0).run(filename)
+            self.assertEqual(sorted(repository.list()), ["6", "7", "8", "9"])
+            self.assertEqual(summary["imported"], 10)
+
+        def test_failed_write_rejects_the_culprit(self):
+            class PickyRepository(DictProductRepository):
+                def add_many(self, products):
+                    products = list(products)
+                    if any(product.code == "bad" for product in products):
+                        raise ValueError("Duplicate entry")
+                    return super().add_many(products)
+
+            filename = self.write_csv(
+                "products.csv",
+                [
+                    {"code": code, "name": "Product", "price": "1"}
+                    for code in ("1", "bad", "3")
+                ],
+            )
+            repository = PickyRepository()
+            summary = CatalogImporter(repository, workers=0).run(filename)
+            self.assertEqual(sorted(repository.list()), ["1", "3"])
+            self.assertEqual(summary["rejected"], 1)
+            self.assertEqual(self.read_rejects(filename)[0]["data"]["code"], "bad")
+
+    unittest.main()
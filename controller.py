@@ -1,11 +1,14 @@
-from datetime import datetime
-
+from models import convert_product_data
 from repositories import (BaseProductRepository, ProductFactory,
-                          ProductNotFoundError)
+                          ProductNotFoundError, VersionConflictError)
+from tracing import span, traced
 from views import CLIView
 
 
 class Controller:
+    # Times an update is applied again over a product changed meanwhile
+    update_retries = 3
+
     def __init__(
         self,
         repository: BaseProductRepository,
@@ -16,25 +19,11 @@ class Controller:
         self.view = view
         self.product_factory = product_factory
 
+    @traced()
     def convert_data(self, data: dict):
-        for key, value in data.items():
-            if key == "price":
-                data[key] = float(value)
-            if key == "stock":
-                data[key] = int(value)
-            if key == "available":
-                if value is not None:
-                    if isinstance(value, str):
-                        value = value.lower() in ("true", "yes", "1", "si", "sí")
-                        data[key] = value
-                else:
-                    data[key] = False
-            if key == "warranty":
-                data[key] = int(value)
-            if key == "expiration_date":
-                data[key] = datetime.strptime(value, "%Y-%m-%d")
-        return data
+        return convert_product_data(data)
 
+    @traced()
     def add_product(self):
         product_types = self.repository.get_product_types()
         while True:
@@ -55,16 +44,20 @@ class Controller:
             return
         try:
             product_data = self.convert_data(product_data)
-            new_product = self.product_factory.create_product(**product_data)
+            with span("ProductFactory.create_product"):
+                new_product = self.product_factory.create_product(**product_data)
             self.repository.add(new_product)
         except Exception as ex:
             self.view.show_message("Error adding product:", ex)
             self.view.wait_for_user()
 
+    @traced()
     def list_products(self):
-        products = self.repository.list()
-        return self.view.list_products(products)
+        # Read a page from the repository only when the view shows it
+        pages = self.repository.iter_batches(self.view.page_size)
+        return self.view.browse_products(pages)
 
+    @traced()
     def show_product_details(self):
         product_code = self.view.search_product()
         product = self.repository.get(product_code)
@@ -74,8 +67,23 @@ class Controller:
             return
         self.view.show_product_details(product)
 
+    @traced()
+    def search_products(self, limit: int = 20):
+        if self.view.interactive:
+            return self.view.search_as_you_type(
+                lambda query: self.repository.search(query, limit=limit)
+            )
+        query = self.view.search_products()
+        if not query:
+            self.view.show_message("No search terms entered")
+            self.view.wait_for_user()
+            return
+        products = self.repository.search(query, limit=limit)
+        return self.view.list_products(products)
+
+    @traced()
     def update_product(self):
-        product_code = input("Enter the product code to update: ")
+        product_code = self.view.prompt("Enter the product code to update: ")
         if not product_code:
             self.view.show_message("No code entered")
             self.view.wait_for_user()
@@ -101,17 +109,32 @@ class Controller:
             self.view.show_message("No changes made")
             self.view.wait_for_user()
             return
-        original_data.update(updated_data)
-        try:
-            product_data = self.convert_data(original_data)
-            updated_product = self.product_factory.create_product(**product_data)
-            self.repository.update(updated_product)
+        for _ in range(self.update_retries + 1):
+            try:
+                product_data = self.convert_data({**product.to_dict(), **updated_data})
+                with span("ProductFactory.create_product"):
+                    updated_product = self.product_factory.create_product(**product_data)
+                self.repository.update(updated_product, expected_version=product.version)
+            except VersionConflictError:
+                # Saved by someone else meanwhile, keep their changes to the
+                # other fields and apply ours again over them
+                product = self.repository.get(product_code)
+                if product is None:
+                    self.view.show_message("Product not found")
+                    self.view.wait_for_user()
+                    return
+                continue
+            except Exception as ex:
+                self.view.show_message("Error updating product: ", product_code, ex)
+                self.view.wait_for_user()
+                return
             self.view.show_message("Product updated")
             self.view.wait_for_user()
-        except Exception as ex:
-            self.view.show_message("Error updating product: ", product_code, ex)
-            self.view.wait_for_user()
+            return
+        self.view.show_message("Product is being changed by someone else: ", product_code)
+        self.view.wait_for_user()
 
+    @traced()
     def delete_product(self):
         product_code = self.view.delete_product()
         if product_code:
@@ -147,3 +170,5 @@ class Controller:
                 self.update_product()
             elif main_menu_selected_option == "5":
                 self.delete_product()
+            elif main_menu_selected_option == "6":
+                self.search_products()
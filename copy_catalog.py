@@ -0,0 +1,226 @@
+import hashlib
+import json
+import queue
+import threading
+import time
+
+from loggers import logger
+from repositories import BaseProductRepository
+
+# Marks the end of the batches read from the source
+_DONE = object()
+
+
+def product_checksum(product_data: dict) -> int:
+    """Hash of every field of a product, the same in every backend"""
+    text = json.dumps(product_data, sort_keys=True, default=str)
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big")
+
+
+class CatalogSummary:
+    """Count and checksum of the products of every type, in any order"""
+
+    def __init__(self):
+        self.by_type: dict[str, dict] = {}
+
+    def add(self, product_data: dict):
+        totals = self.by_type.setdefault(
+            product_data["product_type"], {"count": 0, "checksum": 0}
+        )
+        totals["count"] += 1
+        checksum = totals["checksum"] + product_checksum(product_data)
+        totals["checksum"] = checksum % 2**64
+
+    def as_dict(self) -> dict:
+        return {
+            product_type: dict(totals)
+            for product_type, totals in sorted(self.by_type.items())
+        }
+
+
+def _put(batches: queue.Queue, item, stop: threading.Event):
+    """Wait for room in the queue, unless the copy was given up"""
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_batches(source, batch_size, batches, stop):
+    try:
+        for batch in source.iter_batches(batch_size):
+            if not _put(batches, batch, stop):
+                return
+        _put(batches, _DONE, stop)
+    except BaseException as error:
+        _put(batches, error, stop)
+
+
+def migrate(
+    source_repo: BaseProductRepository,
+    target_repo: BaseProductRepository,
+    batch_size: int = 1000,
+    queue_size: int = 4,
+    progress=None,
+    verify: bool = True,
+) -> dict:
+    """Copy every product of source_repo to target_repo
+
+    A thread reads the source in batches while this one writes them with
+    add_many; the queue between them holds at most queue_size batches, so
+    a slow target holds the reader back instead of filling the memory.
+    progress, when given, is called after every batch with the number of
+    products copied and the rows per second. With verify the products are
+    read back from the target, and the counts and checksums per type of
+    both sides are compared.
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_read_batches,
+        args=(source_repo, batch_size, batches, stop),
+        name="migrate-reader",
+        daemon=True,
+    )
+    source_summary = CatalogSummary()
+    target_summary = CatalogSummary()
+    copied = 0
+    started = time.perf_counter()
+    reader.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            target_repo.add_many(batch)
+            copied += len(batch)
+            if verify:
+                for product in batch:
+                    source_summary.add(product.to_dict())
+                written = target_repo.get_many([product.code for product in batch])
+                for product in written.values():
+                    target_summary.add(product.to_dict())
+            if progress is not None:
+                elapsed = time.perf_counter() - started
+                progress({"copied": copied, "rows_per_second": copied / elapsed})
+    finally:
+        stop.set()
+        reader.join()
+    elapsed = time.perf_counter() - started
+    report = {
+        "copied": copied,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(copied / elapsed) if elapsed else 0,
+    }
+    if verify:
+        report["source"] = source_summary.as_dict()
+        report["target"] = target_summary.as_dict()
+        report["verified"] = report["source"] == report["target"]
+        if not report["verified"]:
+            logger.warning(
+                "Copy to %s differs from the source: %s != %s",
+                target_repo,
+                report["target"],
+                report["source"],
+            )
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import unittest
+
+    from models import FoodProduct, Product
+    from repositories import DictProductRepository, JsonProductRepository
+
+    def build_source(products: int) -> DictProductRepository:
+        source = DictProductRepository()
+        for code in range(products):
+            if code % 2:
+                source.add(
+                    FoodProduct(
+                        str(code),
+                        f"Food {code}",
+                        code,
+                        stock=1,
+                        product_type="food",
+                        expiration_date="2030-01-01",
+                    )
+                )
+            else:
+                source.add(Product(str(code), f"Product {code}", code))
+        return source
+
+    class TestMigrate(unittest.TestCase):
+        def test_copy_and_verify(self):
+            with tempfile.TemporaryDirectory() as directory:
+                target = JsonProductRepository(os.path.join(directory, "copy.json"))
+                updates = []
+                report = migrate(
+                    build_source(250), target, batch_size=100, progress=updates.append
+                )
+                self.assertTrue(report["verified"])
+                self.assertEqual(report["copied"], 250)
+                self.assertEqual(report["source"]["food"]["count"], 125)
+                self.assertEqual(
+                    [update["copied"] for update in updates], [100, 200, 250]
+                )
+                self.assertEqual(len(target.list()), 250)
+                target.close()
+
+        def test_detects_differences(self):
+            class LossyRepository(DictProductRepository):
+                def add_many(self, products):
+                    return super().add_many(p for p in products if p.code != "7")
+
+            report = migrate(build_source(20), LossyRepository(), batch_size=6)
+            self.assertFalse(report["verified"])
+            self.assertEqual(report["target"]["food"]["count"], 9)
+
+        def test_bounded_queue(self):
+            read = []
+
+            class CountingSource(DictProductRepository):
+                def iter_batches(self, batch_size=1000):
+                    for batch in super().iter_batches(batch_size):
+                        read.append(len(batch))
+                        yield batch
+
+            class SlowTarget(DictProductRepository):
+                def add_many(self, products):
+                    time.sleep(0.01)
+                    # Ahead by the queue, the batch waiting to get in it and
+                    # the one being written
+                    self.ahead = max(getattr(self, "ahead", 0), len(read) - written)
+                    return super().add_many(products)
+
+            source = CountingSource()
+            for code in range(50):
+                source.add(Product(str(code), "Product", 1))
+            target = SlowTarget()
+            written = 0
+
+            def count_written(update):
+                nonlocal written
+                written = update["copied"]
+
+            migrate(source, target, batch_size=1, queue_size=2, progress=count_written)
+            self.assertLessEqual(target.ahead, 4)
+            self.assertEqual(len(target.list()), 50)
+
+        def test_source_errors_are_raised(self):
+            class BrokenSource(DictProductRepository):
+                def iter_batches(self, batch_size=1000):
+                    yield [Product("1", "Product", 1)]
+                    raise IOError("Connection lost")
+
+            with self.assertRaises(IOError):
+                migrate(BrokenSource(), DictProductRepository())
+
+    unittest.main()
@@ -6,13 +6,21 @@ CREATE TABLE `products` (
   `stock` int NOT NULL,
   `available` tinyint(1) NOT NULL DEFAULT '1',
   `product_type` varchar(100) NOT NULL DEFAULT 'product',
-  PRIMARY KEY (`code`)
+  `version` int NOT NULL DEFAULT '0',
+  `reorder_threshold` int DEFAULT NULL,
+  PRIMARY KEY (`code`),
+  KEY `idx_products_type_available` (`product_type`,`available`),
+  KEY `idx_products_price` (`price`),
+  KEY `idx_products_stock` (`stock`),
+  KEY `idx_products_reorder_threshold` (`reorder_threshold`),
+  FULLTEXT KEY `idx_products_fulltext` (`name`,`description`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 CREATE TABLE `food` (
   `code` varchar(100) NOT NULL,
   `expiration_date` date DEFAULT NULL,
   PRIMARY KEY (`code`),
+  KEY `idx_food_expiration_date` (`expiration_date`),
   CONSTRAINT `fk_food_code` FOREIGN KEY (`code`) REFERENCES `products` (`code`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
@@ -1,4 +1,5 @@
 from .connectors import MySqlConnector
+from .migrations import MIGRATIONS
 from .table_definitions import TABLES
 
-__all__ = ["MySqlConnector", "TABLES"]
+__all__ = ["MySqlConnector", "MIGRATIONS", "TABLES"]
@@ -1,8 +1,24 @@
+import time
+
 import mysql.connector
 from decouple import config
 from mysql.connector import errorcode
 
+from db.migrations import MIGRATIONS, SCHEMA_MIGRATIONS_TABLE
+from db.replicas import Replica, ReplicaSet, parse_replica_hosts
+from db.statements import StatementCache
 from loggers import logger
+from tracing import traced
+
+READ_QUERIES = ("SELECT", "select", "SHOW", "show")
+
+
+def _query_attributes(connector, query, *args, **kwargs) -> dict:
+    return {"sql": query}
+
+
+def _run_many_attributes(connector, query, rows, commit=True) -> dict:
+    return {"sql": query, "rows": len(rows)}
 
 
 class InvalidCredentialsError(Exception):
@@ -14,7 +30,32 @@ class NonExistingDatabaseError(Exception):
 
 
 class MySqlConnector:
-    def __init__(self, conf, table_definitions=None):
+    """Connection to the primary database, and optionally to read replicas
+
+    Replicas come from the `replicas` argument, a list of "host[:port]"
+    strings or of dicts of connection options, or else from the
+    DB_REPLICAS setting. SELECT and SHOW queries go to a replica, except
+    inside a transaction and during read_after_write_window seconds after a
+    write, so a session always reads its own writes.
+
+    With a statement_cache_size, or the DB_STATEMENT_CACHE_SIZE setting,
+    the connection stays open until close() and the queries with arguments
+    run as server-side prepared statements, kept in a StatementCache of
+    that many statements. That connection autocommits, so its reads see
+    the writes of the other connections, and the commit=False statements
+    start a transaction that lasts until commit() or rollback().
+    """
+
+    def __init__(
+        self,
+        conf,
+        table_definitions=None,
+        replicas=None,
+        replica_selection="round_robin",
+        read_after_write_window=1.0,
+        connect=None,
+        statement_cache_size=None,
+    ):
         self.__connection = None
         self.__cursor = None
         if table_definitions is None:
@@ -25,6 +66,62 @@ class MySqlConnector:
         self.database = conf("DB_NAME")
         self.port = conf("DB_PORT")
         self.table_definitions = table_definitions
+        self._connect = connect or mysql.connector.connect
+        if replicas is None:
+            replicas = parse_replica_hosts(conf("DB_REPLICAS", default=""), self.port)
+        self.replica_set = (
+            ReplicaSet(
+                [self._create_replica(replica) for replica in replicas],
+                selection=replica_selection,
+            )
+            if replicas
+            else None
+        )
+        self.read_after_write_window = read_after_write_window
+        self._last_write_at = None
+        self._in_transaction = False
+        if statement_cache_size is None:
+            statement_cache_size = int(conf("DB_STATEMENT_CACHE_SIZE", default=0))
+        self.statement_cache = (
+            StatementCache(statement_cache_size) if statement_cache_size else None
+        )
+
+    def _create_replica(self, replica: str | dict) -> Replica:
+        if isinstance(replica, str):
+            replica = parse_replica_hosts(replica, self.port)[0]
+        options = {
+            "host": self.host,
+            "user": self.user,
+            "password": self.password,
+            "database": self.database,
+            "port": self.port,
+            **replica,
+        }
+        return Replica(self._connect, **options)
+
+    def _should_read_from_replica(self, query, commit):
+        if self.replica_set is None or not commit or self._in_transaction:
+            return False
+        if not query.lstrip().startswith(READ_QUERIES):
+            return False
+        return (
+            self._last_write_at is None
+            or time.monotonic() - self._last_write_at >= self.read_after_write_window
+        )
+
+    def _run_on_replica(self, query, *args, **kwargs):
+        """Return the rows read from a replica, None if none could answer"""
+        replica = self.replica_set.choose()
+        if replica is None:
+            return None
+        try:
+            return replica.run_select(query, *args, **kwargs)
+        except (mysql.connector.Error, IOError) as err:
+            logger.warning(
+                "Replica %s failed, reading from the primary: %s", replica, err
+            )
+            self.replica_set.mark_down(replica)
+            return None
 
     def get_existing_connection_and_cursor(self):
         """Return the existing connection object"""
@@ -35,13 +132,16 @@ class MySqlConnector:
         try:
             if self.__connection and self.__connection.is_connected():
                 return self.__connection
-            conn = mysql.connector.connect(
+            conn = self._connect(
                 host=self.host,
                 user=self.user,
                 password=self.password,
                 database=self.database,
                 port=self.port,
             )
+            if self.statement_cache is not None:
+                # Else the first read would open a transaction never ended
+                conn.autocommit = True
             self.__connection = conn
             return conn
         except (mysql.connector.Error, IOError) as err:
@@ -58,22 +158,38 @@ class MySqlConnector:
             print("Unexpected error connecting to database: ", str(ex))
             raise ex
 
+    @traced(attributes=_query_attributes)
     def run_query(self, query, *args, commit=True, **kwargs):
+        if self._should_read_from_replica(query, commit):
+            rows = self._run_on_replica(query, *args, **kwargs)
+            if rows is not None:
+                return rows
+        if not query.lstrip().startswith(READ_QUERIES):
+            self._last_write_at = time.monotonic()
+        if not commit:
+            self._in_transaction = True
         conn = self.get_connection()
-        if conn and conn.is_connected():
-            cursor = conn.cursor(dictionary=True)
-        else:
-            return None
-
-        try:
-            cursor.execute("USE " + self.database)
-        except mysql.connector.Error as err:
-            if err.errno == errorcode.ER_BAD_DB_ERROR:
-                print("Database does not exist")
+        if not (conn and conn.is_connected()):
             return None
+        if not commit:
+            self._begin(conn)
+        prepared = self.statement_cache is not None and bool(args) and not kwargs
+        if prepared:
+            cursor = None
+        else:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("USE " + self.database)
+            except mysql.connector.Error as err:
+                if err.errno == errorcode.ER_BAD_DB_ERROR:
+                    print("Database does not exist")
+                return None
 
         try:
-            cursor.execute(query, *args, **kwargs)
+            if prepared:
+                cursor = self.statement_cache.execute(conn, query, args[0])
+            else:
+                cursor.execute(query, *args, **kwargs)
         except mysql.connector.Error as ex:
             print("Error executing query: ", ex)
             return None
@@ -87,11 +203,15 @@ class MySqlConnector:
             elif query.startswith(("UPDATE", "update", "DELETE", "delete")):
                 if commit:
                     conn.commit()
-                    return cursor.rowcount
-            elif query.startswith(("CREATE", "create")):
+                return cursor.rowcount
+            elif query.startswith(("CREATE", "create", "ALTER", "alter")):
                 return True
         finally:
-            if not commit:
+            if self.statement_cache is not None:
+                # The connection stays open for its prepared statements
+                if cursor is not None and not prepared:
+                    cursor.close()
+            elif not commit:
                 self.__cursor = cursor
                 self.__connection = conn
             else:
@@ -102,9 +222,42 @@ class MySqlConnector:
                 self.__connection = None
         return None
 
+    @traced(attributes=_run_many_attributes)
+    def run_many(self, query, rows, commit=True):
+        """Run a statement once per row of arguments, like a bulk INSERT
+
+        Unlike run_query the errors are raised, so a failed batch can't pass
+        for a written one. Return the number of affected rows.
+        """
+        self._last_write_at = time.monotonic()
+        if not commit:
+            self._in_transaction = True
+        conn = self.get_connection()
+        if not commit:
+            self._begin(conn)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("USE " + self.database)
+            cursor.executemany(query, rows)
+            if commit:
+                conn.commit()
+            return cursor.rowcount
+        finally:
+            if self.statement_cache is not None:
+                cursor.close()
+            elif not commit:
+                self.__cursor = cursor
+                self.__connection = conn
+            else:
+                cursor.close()
+                if conn.is_connected():
+                    conn.close()
+                self.__cursor = None
+                self.__connection = None
+
     def create_database(self, database_name):
         query = f"CREATE DATABASE IF NOT EXISTS {database_name}"
-        conn = mysql.connector.connect(
+        conn = self._connect(
             host=self.host, user=self.user, password=self.password, port=self.port
         )
         cursor = conn.cursor()
@@ -118,16 +271,61 @@ class MySqlConnector:
         for table_name, table_definition in table_definitions.items():
             self.run_query(table_definition)
 
+    def run_migrations(self, migrations=None):
+        """Apply the pending schema migrations, return the names applied"""
+        if migrations is None:
+            migrations = MIGRATIONS
+        self.run_query(SCHEMA_MIGRATIONS_TABLE)
+        applied_rows = self.run_query("SELECT name FROM schema_migrations") or []
+        already_applied = {row["name"] for row in applied_rows}
+        applied = []
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("USE " + self.database)
+            for name, statements in migrations:
+                if name in already_applied:
+                    continue
+                for statement in statements:
+                    try:
+                        cursor.execute(statement)
+                    except mysql.connector.Error as err:
+                        # Objects created by create_tables.sql already exist
+                        if err.errno not in (
+                            errorcode.ER_DUP_KEYNAME,
+                            errorcode.ER_DUP_FIELDNAME,
+                        ):
+                            logger.error("Error applying migration %s: %s", name, err)
+                            raise err
+                cursor.execute(
+                    "INSERT INTO schema_migrations (name) VALUES (%s)", (name,)
+                )
+                conn.commit()
+                applied.append(name)
+                logger.info("Migration applied: %s", name)
+        finally:
+            cursor.close()
+            conn.close()
+        return applied
+
+    def _begin(self, conn):
+        """Start the transaction of a commit=False statement on the
+        autocommitting connection of the statement cache"""
+        if self.statement_cache is not None and not conn.in_transaction:
+            conn.start_transaction()
+
     def start_transaction(self):
+        self._in_transaction = True
         conn = self.get_connection()
         if conn and conn.is_connected():
             conn.start_transaction()
         return None
 
     def commit(self, close=True):
+        self._in_transaction = False
         if self.__connection and self.__connection.is_connected():
             self.__connection.commit()
-        if close:
+        if close and self.statement_cache is None:
             if self.__cursor:
                 self.__cursor.close()
             if self.__connection:
@@ -135,16 +333,34 @@ class MySqlConnector:
         return None
 
     def rollback(self, close=True):
+        self._in_transaction = False
         conn = self.get_connection()
         if conn and conn.is_connected():
             conn.rollback()
-        if not close:
+        if not close or self.statement_cache is not None:
             return None
         if self.__cursor:
             self.__cursor.close()
         if conn:
             conn.close()
 
+    def statement_stats(self) -> dict | None:
+        """Return the counters of the statement cache, None without one"""
+        if self.statement_cache is None:
+            return None
+        return self.statement_cache.stats()
+
+    def close(self):
+        """Close the connection and its prepared statements"""
+        if self.statement_cache is not None:
+            self.statement_cache.clear()
+        if self.__cursor:
+            self.__cursor.close()
+        if self.__connection and self.__connection.is_connected():
+            self.__connection.close()
+        self.__cursor = None
+        self.__connection = None
+
 
 if __name__ == "__main__":
     import sys
@@ -172,6 +388,7 @@ if __name__ == "__main__":
 
     if connection and connection.is_connected():
         connector.create_tables()
+        connector.run_migrations()
         print("Connected to database")
     else:
         print("Failed to connect to database")
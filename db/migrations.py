@@ -0,0 +1,47 @@
+# Schema migrations, applied in order by MySqlConnector.run_migrations.
+# Each migration is a (name, statements) pair; applied names are recorded in
+# the `schema_migrations` table so every migration runs only once.
+
+SCHEMA_MIGRATIONS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS `schema_migrations` ("
+    "  `name` varchar(100) NOT NULL,"
+    "  `applied_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+    "  PRIMARY KEY (`name`)"
+    ") ENGINE=InnoDB"
+)
+
+MIGRATIONS = [
+    (
+        "0001_secondary_indexes",
+        (
+            "CREATE INDEX `idx_products_type_available` "
+            "ON `products` (`product_type`, `available`)",
+            "CREATE INDEX `idx_products_price` ON `products` (`price`)",
+            "CREATE INDEX `idx_products_stock` ON `products` (`stock`)",
+            "CREATE INDEX `idx_food_expiration_date` ON `food` (`expiration_date`)",
+        ),
+    ),
+    (
+        "0002_products_fulltext",
+        (
+            "ALTER TABLE `products` "
+            "ADD FULLTEXT INDEX `idx_products_fulltext` (`name`, `description`)",
+        ),
+    ),
+    (
+        "0003_products_version",
+        (
+            "ALTER TABLE `products` "
+            "ADD COLUMN `version` int NOT NULL DEFAULT 0 AFTER `product_type`",
+        ),
+    ),
+    (
+        "0004_products_reorder_threshold",
+        (
+            "ALTER TABLE `products` "
+            "ADD COLUMN `reorder_threshold` int NULL DEFAULT NULL AFTER `version`",
+            "CREATE INDEX `idx_products_reorder_threshold` "
+            "ON `products` (`reorder_threshold`)",
+        ),
+    ),
+]
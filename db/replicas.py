@@ -0,0 +1,261 @@
+import itertools
+import threading
+import time
+
+# Weight of the last query in the moving average of a replica's latency
+LATENCY_SMOOTHING = 0.2
+
+
+def parse_replica_hosts(value: str, default_port) -> list[dict]:
+    """Parse a "host[:port],host[:port]" list, like the DB_REPLICAS setting"""
+    replicas = []
+    for address in value.split(","):
+        address = address.strip()
+        if not address:
+            continue
+        host, _, port = address.partition(":")
+        replicas.append({"host": host, "port": port or default_port})
+    return replicas
+
+
+class Replica:
+    """Read-only connection to one replica, kept open between queries
+
+    The connection autocommits, so every read sees the rows replicated
+    since the previous one instead of the snapshot of a transaction left
+    open by the first.
+    """
+
+    def __init__(self, connect, **connection_options):
+        self.connect = connect
+        self.connection_options = connection_options
+        self.connection = None
+        self.latency: float | None = None
+        self.down_until = 0.0
+
+    def __str__(self):
+        return f"{self.connection_options['host']}:{self.connection_options['port']}"
+
+    def get_connection(self):
+        if self.connection is None or not self.connection.is_connected():
+            self.connection = self.connect(**self.connection_options)
+            self.connection.autocommit = True
+        return self.connection
+
+    def run_select(self, query, *args, **kwargs) -> list[dict]:
+        started = time.perf_counter()
+        cursor = self.get_connection().cursor(dictionary=True)
+        try:
+            cursor.execute(query, *args, **kwargs)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        elapsed = time.perf_counter() - started
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+        return rows
+
+    def close(self):
+        if self.connection is not None and self.connection.is_connected():
+            self.connection.close()
+        self.connection = None
+
+
+class ReplicaSet:
+    """Pick the replica for the next read
+
+    "round_robin" rotates over the replicas, "least_latency" prefers the one
+    with the lowest moving average (replicas never measured go first). A
+    replica that fails is skipped for retry_after seconds.
+    """
+
+    SELECTIONS = ("round_robin", "least_latency")
+
+    def __init__(
+        self,
+        replicas: list[Replica],
+        selection: str = "round_robin",
+        retry_after: float = 30.0,
+    ):
+        if selection not in self.SELECTIONS:
+            raise ValueError(f"Unknown replica selection: {selection}")
+        self.replicas = replicas
+        self.selection = selection
+        self.retry_after = retry_after
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self) -> Replica | None:
+        now = time.monotonic()
+        healthy = [replica for replica in self.replicas if replica.down_until <= now]
+        if not healthy:
+            return None
+        if self.selection == "least_latency":
+            return min(
+                healthy,
+                key=lambda replica: -1 if replica.latency is None else replica.latency,
+            )
+        with self._lock:
+            turn = next(self._turns)
+        return healthy[turn % len(healthy)]
+
+    def mark_down(self, replica: Replica):
+        replica.down_until = time.monotonic() + self.retry_after
+        replica.close()
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+
+
+if __name__ == "__main__":
+    # Run from the root folder: python -m db.replicas
+    import unittest
+
+    from db.connectors import MySqlConnector
+
+    class StandInCursor:
+        def __init__(self, connection):
+            self.connection = connection
+            self.lastrowid = 1
+            self.rowcount = 1
+
+        def execute(self, query, *args, **kwargs):
+            if self.connection.failing:
+                raise IOError("Connection lost")
+            self.connection.queries.append(query)
+
+        def fetchall(self):
+            return [{"host": self.connection.host}]
+
+        def close(self):
+            pass
+
+    class StandInConnection:
+        """Local stand-in for a MySQL server, answering with its own host"""
+
+        def __init__(self, host, failing=False, **options):
+            self.host = host
+            self.failing = failing
+            self.queries = []
+
+        def cursor(self, dictionary=False):
+            return StandInCursor(self)
+
+        def is_connected(self):
+            return True
+
+        def commit(self):
+            pass
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+        def start_transaction(self):
+            pass
+
+    settings = {
+        "DB_HOST": "primary",
+        "DB_USER": "user",
+        "DB_PASSWORD": "password",
+        "DB_NAME": "products",
+        "DB_PORT": 3306,
+    }
+
+    def conf(option, default=None):
+        return settings.get(option, default)
+
+    class TestReadReplicas(unittest.TestCase):
+        def create_connector(self, replicas, **kwargs):
+            return MySqlConnector(
+                conf, replicas=replicas, connect=StandInConnection, **kwargs
+            )
+
+        def read_host(self, connector):
+            return connector.run_query("SELECT 1")[0]["host"]
+
+        def test_round_robin(self):
+            connector = self.create_connector(["replica-1", "replica-2"])
+            hosts = [self.read_host(connector) for _ in range(4)]
+            self.assertEqual(hosts, ["replica-1", "replica-2"] * 2)
+
+        def test_reads_own_writes_on_primary(self):
+            connector = self.create_connector(["replica-1"])
+            connector.run_query("UPDATE products SET stock = 1")
+            self.assertEqual(self.read_host(connector), "primary")
+            connector.read_after_write_window = 0
+            self.assertEqual(self.read_host(connector), "replica-1")
+
+        def test_transaction_reads_on_primary(self):
+            connector = self.create_connector(["replica-1"], read_after_write_window=0)
+            connector.start_transaction()
+            self.assertEqual(self.read_host(connector), "primary")
+            connector.commit()
+            self.assertEqual(self.read_host(connector), "replica-1")
+
+        def test_failed_replica_falls_back(self):
+            connector = self.create_connector(
+                [{"host": "replica-1", "failing": True}, "replica-2"]
+            )
+            hosts = {self.read_host(connector) for _ in range(4)}
+            self.assertEqual(hosts, {"primary", "replica-2"})
+            self.assertGreater(connector.replica_set.replicas[0].down_until, 0)
+
+        def test_least_latency(self):
+            connector = self.create_connector(
+                ["replica-1", "replica-2"], replica_selection="least_latency"
+            )
+            fast, slow = connector.replica_set.replicas
+            fast.latency, slow.latency = 0.001, 0.010
+            self.assertEqual(self.read_host(connector), "replica-1")
+
+        def test_replica_reads_see_newer_rows(self):
+            server = {"stock": 1}
+
+            class SnapshotCursor(StandInCursor):
+                """Reads like InnoDB's REPEATABLE READ: without autocommit,
+                the first read begins a transaction that sees a snapshot"""
+
+                def execute(self, query, *args, **kwargs):
+                    super().execute(query, *args, **kwargs)
+                    connection = self.connection
+                    if connection.autocommit:
+                        self.rows = [dict(server)]
+                        return
+                    if connection.snapshot is None:
+                        connection.snapshot = dict(server)
+                    self.rows = [dict(connection.snapshot)]
+
+                def fetchall(self):
+                    return self.rows
+
+            class SnapshotConnection(StandInConnection):
+                autocommit = False
+                snapshot = None
+
+                def cursor(self, dictionary=False):
+                    return SnapshotCursor(self)
+
+            replica = Replica(SnapshotConnection, host="replica-1", port=3306)
+            query = "SELECT stock FROM products WHERE code = %s"
+            self.assertEqual(replica.run_select(query, ("1",)), [{"stock": 1}])
+            server["stock"] = 5
+            self.assertEqual(replica.run_select(query, ("1",)), [{"stock": 5}])
+
+        def test_replicas_from_settings(self):
+            settings["DB_REPLICAS"] = "replica-1:3307, replica-2"
+            try:
+                connector = MySqlConnector(conf, connect=StandInConnection)
+            finally:
+                del settings["DB_REPLICAS"]
+            self.assertEqual(
+                [str(replica) for replica in connector.replica_set.replicas],
+                ["replica-1:3307", "replica-2:3306"],
+            )
+
+    unittest.main()
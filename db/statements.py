@@ -0,0 +1,284 @@
+from collections import OrderedDict
+
+
+class StatementCache:
+    """Server-side prepared statements of one connection, by SQL text
+
+    Every statement gets a prepared cursor of its own, which the server
+    parses once; past max_size statements the least recently used one is
+    closed. The statements belong to a connection: using the cache with
+    another one, after a reconnection, closes them first. hits, misses and
+    evictions add up over the connections.
+    """
+
+    def __init__(self, max_size: int = 64):
+        if max_size < 1:
+            raise ValueError("The cache needs room for one statement at least")
+        self.max_size = max_size
+        self.connection = None
+        # SQL text -> (the same text, as executed, and its cursor)
+        self._statements: OrderedDict[str, tuple[str, object]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _cursor_for(self, connection, query: str):
+        if connection is not self.connection:
+            self.clear()
+            self.connection = connection
+        statement = self._statements.get(query)
+        if statement is not None:
+            self.hits += 1
+            self._statements.move_to_end(query)
+            return statement
+        self.misses += 1
+        if len(self._statements) >= self.max_size:
+            _, (_, cursor) = self._statements.popitem(last=False)
+            self.evictions += 1
+            cursor.close()
+        statement = (query, connection.cursor(prepared=True, dictionary=True))
+        self._statements[query] = statement
+        return statement
+
+    def execute(self, connection, query: str, params=()):
+        """Run query on its prepared cursor, return the cursor"""
+        query, cursor = self._cursor_for(connection, query)
+        try:
+            # The cursor only reuses its statement for the very same string
+            cursor.execute(query, params)
+        except Exception:
+            self.discard(query)
+            raise
+        return cursor
+
+    def discard(self, query: str):
+        statement = self._statements.pop(query, None)
+        if statement is not None:
+            statement[1].close()
+
+    def clear(self):
+        for _, cursor in self._statements.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass  # The connection is gone with its statements
+        self._statements.clear()
+        self.connection = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._statements),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._statements)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class StandInCursor:
+        def __init__(self, connection):
+            self.connection = connection
+            self.prepared = None
+            self.closed = False
+
+        def execute(self, query, params=()):
+            self.connection.executed.append(query)
+            if query is not self.prepared:
+                if "error" in query:
+                    raise ValueError("You have an error in your SQL syntax")
+                self.connection.prepared.append(query)
+                self.prepared = query
+
+        def fetchall(self):
+            return [{"code": "1"}]
+
+        @property
+        def rowcount(self):
+            return 1
+
+        def close(self):
+            self.closed = True
+
+    class StandInConnection:
+        """Local stand-in for a MySQL server, recording the statements"""
+
+        cursor_class = StandInCursor
+
+        def __init__(self, **options):
+            self.prepared = []
+            self.executed = []
+            self.cursors = []
+            self.connected = True
+            self.commits = 0
+            self.autocommit = False
+            self.in_transaction = False
+
+        def cursor(self, prepared=False, dictionary=False):
+            self.cursors.append(self.cursor_class(self))
+            return self.cursors[-1]
+
+        def is_connected(self):
+            return self.connected
+
+        def start_transaction(self):
+            self.in_transaction = True
+
+        def commit(self):
+            self.commits += 1
+            self.in_transaction = False
+
+        def rollback(self):
+            self.in_transaction = False
+
+        def close(self):
+            self.connected = False
+
+    class TestStatementCache(unittest.TestCase):
+        def test_reuses_statements(self):
+            cache = StatementCache()
+            connection = StandInConnection()
+            table = "products"
+            for code in range(3):
+                # A new string every time
+                query = f"SELECT * FROM {table} WHERE code = %s"
+                cache.execute(connection, query, (str(code),))
+            self.assertEqual(len(connection.prepared), 1)
+            self.assertEqual(cache.stats()["hits"], 2)
+            self.assertEqual(cache.stats()["misses"], 1)
+
+        def test_evicts_least_recently_used(self):
+            cache = StatementCache(max_size=2)
+            connection = StandInConnection()
+            cache.execute(connection, "SELECT 1")
+            cache.execute(connection, "SELECT 2")
+            cache.execute(connection, "SELECT 1")
+            cache.execute(connection, "SELECT 3")
+            self.assertTrue(connection.cursors[1].closed)
+            self.assertEqual(cache.evictions, 1)
+            cache.execute(connection, "SELECT 1")
+            self.assertEqual(cache.hits, 2)
+
+        def test_new_connection_starts_over(self):
+            cache = StatementCache()
+            first = StandInConnection()
+            cache.execute(first, "SELECT 1")
+            second = StandInConnection()
+            cache.execute(second, "SELECT 1")
+            self.assertTrue(first.cursors[0].closed)
+            self.assertEqual(second.prepared, ["SELECT 1"])
+            self.assertEqual(cache.misses, 2)
+
+        def test_failed_statement_is_dropped(self):
+            cache = StatementCache()
+            connection = StandInConnection()
+            with self.assertRaises(ValueError):
+                cache.execute(connection, "SELECT error")
+            self.assertEqual(len(cache), 0)
+
+    class TestConnectorStatementCache(unittest.TestCase):
+        def setUp(self):
+            from db.connectors import MySqlConnector
+
+            settings = {"DB_NAME": "products", "DB_PORT": 3306}
+            self.connections = []
+
+            def connect(**options):
+                self.connections.append(StandInConnection(**options))
+                return self.connections[-1]
+
+            self.connector = MySqlConnector(
+                lambda option, default=None: settings.get(option, default),
+                connect=connect,
+                statement_cache_size=8,
+            )
+
+        def test_keeps_the_connection_and_its_statements(self):
+            for code in ("1", "2"):
+                rows = self.connector.run_query(
+                    "SELECT * FROM products WHERE code = %s", (code,)
+                )
+                self.assertEqual(rows, [{"code": "1"}])
+                self.connector.run_query(
+                    "UPDATE products SET stock = stock + %s WHERE code = %s",
+                    (1, code),
+                )
+            self.assertEqual(len(self.connections), 1)
+            self.assertEqual(len(self.connections[0].prepared), 2)
+            self.assertNotIn("USE products", self.connections[0].executed)
+            self.assertEqual(self.connections[0].commits, 2)
+            stats = self.connector.statement_stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+            self.connector.close()
+            self.assertFalse(self.connections[0].connected)
+            self.assertEqual(stats["size"], 2)
+            self.assertEqual(self.connector.statement_stats()["size"], 0)
+
+        def test_reconnection_prepares_again(self):
+            self.connector.run_query("SELECT * FROM products WHERE code = %s", ("1",))
+            self.connections[0].connected = False
+            self.connector.run_query("SELECT * FROM products WHERE code = %s", ("1",))
+            self.assertEqual(len(self.connections), 2)
+            self.assertEqual(self.connector.statement_stats()["misses"], 2)
+
+        def test_reads_see_the_writes_of_other_connections(self):
+            from db.connectors import MySqlConnector
+
+            server = {"stock": 1}
+
+            class SnapshotCursor(StandInCursor):
+                """Reads like InnoDB's REPEATABLE READ: a transaction, begun
+                by its first statement without autocommit, sees a snapshot"""
+
+                def execute(self, query, params=()):
+                    super().execute(query, params)
+                    connection = self.connection
+                    if not (connection.autocommit or connection.in_transaction):
+                        connection.in_transaction = True
+                    if not connection.in_transaction:
+                        connection.snapshot = None
+                    elif connection.snapshot is None:
+                        connection.snapshot = dict(server)
+                    if query.startswith("UPDATE"):
+                        server["stock"] = params[0]
+                    self.rows = [dict(connection.snapshot or server)]
+
+                def fetchall(self):
+                    return self.rows
+
+            class SnapshotConnection(StandInConnection):
+                cursor_class = SnapshotCursor
+                snapshot = None
+
+                def commit(self):
+                    super().commit()
+                    self.snapshot = None
+
+            settings = {"DB_NAME": "products", "DB_PORT": 3306}
+            reader, writer = (
+                MySqlConnector(
+                    lambda option, default=None: settings.get(option, default),
+                    connect=SnapshotConnection,
+                    statement_cache_size=8,
+                )
+                for _ in range(2)
+            )
+            query = "SELECT stock FROM products WHERE code = %s"
+            self.assertEqual(reader.run_query(query, ("1",)), [{"stock": 1}])
+            writer.run_query("UPDATE products SET stock = %s WHERE code = %s", (5, "1"))
+            self.assertEqual(reader.run_query(query, ("1",)), [{"stock": 5}])
+            # commit=False statements run in a transaction until commit()
+            reader.run_query(query, ("1",), commit=False)
+            connection, _ = reader.get_existing_connection_and_cursor()
+            self.assertTrue(connection.in_transaction)
+            reader.commit()
+            self.assertFalse(connection.in_transaction)
+            self.assertTrue(connection.connected)
+
+    unittest.main()
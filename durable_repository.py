@@ -0,0 +1,458 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from events import EventBus
+from loggers import logger
+from repositories import DictProductRepository
+
+FSYNC_POLICIES = ("always", "batch", "interval")
+
+# Every log record: payload length, CRC32 of the payload, log sequence number
+RECORD_HEADER = struct.Struct("<IIQ")
+SNAPSHOT_MAGIC = b"PSNP"
+# magic, sequence number of the last record included, size of the products
+# that follow as one JSON array
+SNAPSHOT_HEADER = struct.Struct("<4sQQ")
+
+
+def _encode_record(lsn: int, record: dict) -> bytes:
+    payload = json.dumps(record, ensure_ascii=False).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload), lsn) + payload
+
+
+def read_log_segment(filename: str) -> tuple[list[tuple[int, dict]], int]:
+    """Return the (lsn, record) pairs of a log file and the size of its valid
+    part; a record torn by a crash, and what follows, is left out"""
+    records = []
+    with open(filename, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum, lsn = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append((lsn, json.loads(payload)))
+        offset = start + length
+    return records, offset
+
+
+def _fsync_directory(directory: str):
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(filename: str, lsn: int, rows: list[dict]):
+    """Write the products as of log record lsn, replacing the file atomically"""
+    payload = json.dumps(rows, ensure_ascii=False).encode("utf-8")
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, "wb") as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, lsn, len(payload)))
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+    _fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+
+def read_snapshot(filename: str) -> tuple[int, dict[str, dict]]:
+    """Return the lsn of a snapshot and its products, by code; the file is
+    memory mapped and decoded in a single pass"""
+    if not os.path.exists(filename) or not os.path.getsize(filename):
+        return 0, {}
+    with open(filename, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        magic, lsn, size = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{filename} is not a snapshot")
+        rows = json.loads(data[SNAPSHOT_HEADER.size : SNAPSHOT_HEADER.size + size])
+    return lsn, {row["code"]: row for row in rows}
+
+
+class WriteAheadLog:
+    """Append-only log of the writes, in segments "wal-<first lsn>.log"
+
+    fsync decides when a record is on disk: "always" syncs every append;
+    "batch" makes the appends wait for a sync shared by every append
+    pending at that moment (group commit); "interval" returns right away
+    and a background thread syncs every sync_interval seconds, so a crash
+    loses at most that much.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        last_lsn: int = 0,
+        fsync: str = "batch",
+        sync_interval: float = 0.05,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+        self.sync_interval = sync_interval
+        self.last_lsn = last_lsn
+        self.durable_lsn = last_lsn
+        self.syncs = 0
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._pending: list[bytes] = []
+        self._syncing = False
+        self._error: BaseException | None = None
+        self._closed = threading.Event()
+        self._file = None
+        self._open_segment()
+        self._sync_thread = None
+        if fsync == "interval":
+            self._sync_thread = threading.Thread(
+                target=self._sync_loop, name="wal-sync", daemon=True
+            )
+            self._sync_thread.start()
+
+    @staticmethod
+    def segment_filenames(directory: str) -> list[str]:
+        return sorted(glob.glob(os.path.join(directory, "wal-*.log")))
+
+    def _open_segment(self):
+        self.segment_filename = os.path.join(
+            self.directory, f"wal-{self.last_lsn + 1:020d}.log"
+        )
+        self._file = open(self.segment_filename, "ab")
+        _fsync_directory(self.directory)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.syncs += 1
+
+    def append(self, record: dict) -> int:
+        """Log a record, return its lsn once the fsync policy allows"""
+        with self._lock:
+            if self._error is not None:
+                raise IOError("The write-ahead log failed") from self._error
+            self.last_lsn += 1
+            lsn = self.last_lsn
+            frame = _encode_record(lsn, record)
+            if self.fsync != "batch":
+                self._file.write(frame)
+                if self.fsync == "always":
+                    self._sync()
+                    self.durable_lsn = lsn
+                return lsn
+            self._pending.append(frame)
+            while self.durable_lsn < lsn:
+                if self._error is not None:
+                    raise IOError("The write-ahead log failed") from self._error
+                if self._syncing:
+                    self._synced.wait()
+                    continue
+                self._sync_pending()
+            return lsn
+
+    def _sync_pending(self):
+        """Write and sync every pending record, with the lock held on entry;
+        other appends queue up meanwhile for the next sync"""
+        self._syncing = True
+        frames, self._pending = self._pending, []
+        last_lsn = self.last_lsn
+        self._lock.release()
+        try:
+            self._file.write(b"".join(frames))
+            self._sync()
+        except BaseException as error:
+            self._error = error
+            raise
+        finally:
+            self._lock.acquire()
+            self._syncing = False
+            self._synced.notify_all()
+        self.durable_lsn = last_lsn
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            with self._lock:
+                if self.durable_lsn < self.last_lsn:
+                    try:
+                        self._sync()
+                    except OSError as error:
+                        logger.error("Error syncing the write-ahead log: %s", error)
+                        continue
+                    self.durable_lsn = self.last_lsn
+
+    def _wait_idle(self):
+        while self._syncing:
+            self._synced.wait()
+        if self._pending:
+            self._sync_pending()
+
+    def rotate(self) -> str:
+        """Sync the current segment and start a new one, return the new
+        segment's filename"""
+        with self._lock:
+            self._wait_idle()
+            self._sync()
+            self.durable_lsn = self.last_lsn
+            self._file.close()
+            self._open_segment()
+            return self.segment_filename
+
+    def remove_segments_before(self, segment_filename: str):
+        for filename in self.segment_filenames(self.directory):
+            if filename < segment_filename:
+                os.remove(filename)
+
+    def close(self):
+        self._closed.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+        with self._lock:
+            self._wait_idle()
+            self._sync()
+            self.durable_lsn = self.last_lsn
+            self._file.close()
+
+
+class DurableDictProductRepository(DictProductRepository):
+    """DictProductRepository that survives restarts
+
+    Every write is appended to a write-ahead log in directory before the
+    call returns (see WriteAheadLog for the fsync policies), and a
+    background thread saves a snapshot of the products every
+    snapshot_interval seconds, after which the older log segments are
+    removed. Opening the repository reads the memory mapped snapshot and
+    replays the log written after it. Always thread safe.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync: str = "batch",
+        sync_interval: float = 0.05,
+        snapshot_interval: float | None = 60.0,
+        lock_stripes: int = 16,
+        event_bus: EventBus | None = None,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshot_filename = os.path.join(directory, "snapshot.bin")
+        self.snapshot_lsn, storage = read_snapshot(self.snapshot_filename)
+        last_lsn = self._replay_log(storage)
+        super().__init__(
+            storage,
+            thread_safe=True,
+            lock_stripes=lock_stripes,
+            event_bus=event_bus,
+        )
+        self.wal = WriteAheadLog(directory, last_lsn, fsync, sync_interval)
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_interval:
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_loop, name="snapshot", daemon=True
+            )
+            self._snapshot_thread.start()
+
+    def _replay_log(self, storage: dict[str, dict]) -> int:
+        """Apply the logged writes newer than the snapshot, return the last
+        lsn found"""
+        last_lsn = self.snapshot_lsn
+        for filename in WriteAheadLog.segment_filenames(self.directory):
+            records, valid_size = read_log_segment(filename)
+            if valid_size < os.path.getsize(filename):
+                logger.warning("Truncating torn write-ahead log tail: %s", filename)
+                with open(filename, "r+b") as file:
+                    file.truncate(valid_size)
+            for lsn, record in records:
+                if lsn <= self.snapshot_lsn:
+                    continue
+                if record["op"] == "put":
+                    storage[record["data"]["code"]] = record["data"]
+                else:
+                    storage.pop(record["code"], None)
+                last_lsn = lsn
+        return last_lsn
+
+    def _apply_change(self, old_data: dict | None, new_data: dict | None):
+        # Called with the write lock of the product held, after the storage
+        # was changed: undo that change if it can't be logged
+        if new_data is not None:
+            record = {"op": "put", "data": new_data}
+        else:
+            record = {"op": "delete", "code": old_data["code"]}
+        try:
+            self.wal.append(record)
+        except BaseException:
+            code = (new_data or old_data)["code"]
+            if old_data is None:
+                self.storage.pop(code, None)
+            else:
+                self.storage[code] = old_data
+            raise
+        super()._apply_change(old_data, new_data)
+
+    def save_snapshot(self) -> int:
+        """Write a snapshot of the products now, return its lsn"""
+        with self._snapshot_lock:
+            with self._locks.read_all():
+                rows = list(self.storage.values())
+                lsn = self.wal.last_lsn
+                segment_filename = self.wal.rotate()
+            write_snapshot(self.snapshot_filename, lsn, rows)
+            self.snapshot_lsn = lsn
+            self.wal.remove_segments_before(segment_filename)
+        logger.info("Snapshot of %s products saved at lsn %s", len(rows), lsn)
+        return lsn
+
+    def _snapshot_loop(self):
+        while not self._closed.wait(self.snapshot_interval):
+            if self.wal.last_lsn != self.snapshot_lsn:
+                try:
+                    self.save_snapshot()
+                except OSError as error:
+                    logger.error("Error saving a snapshot: %s", error)
+
+    def close(self, snapshot: bool = True):
+        """Stop the background threads and sync the log; with snapshot, save
+        one so the next start has no log to replay"""
+        self._closed.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if snapshot and self.wal.last_lsn != self.snapshot_lsn:
+            self.save_snapshot()
+        self.wal.close()
+
+    def __str__(self):
+        return f"DurableDictProductRepository({self.directory})"
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+    from unittest import mock
+
+    from models import FoodProduct, Product
+
+    class TestDurableDictProductRepository(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+
+        def tearDown(self):
+            self.directory.cleanup()
+
+        def open(self, **kwargs) -> DurableDictProductRepository:
+            kwargs.setdefault("snapshot_interval", None)
+            return DurableDictProductRepository(self.directory.name, **kwargs)
+
+        def fill(self, repository):
+            for code in range(10):
+                repository.add(Product(str(code), f"Product {code}", code))
+            repository.update(Product("3", "Updated", 30))
+            repository.delete("4")
+            repository.add(
+                FoodProduct(
+                    "food", "Milk", 1, product_type="food", expiration_date="2030-01-01"
+                )
+            )
+
+        def check(self, repository):
+            self.assertEqual(len(repository.list()), 10)
+            self.assertEqual(repository.get("3").name, "Updated")
+            self.assertEqual(repository.get("3").version, 1)
+            self.assertIsNone(repository.get("4"))
+            self.assertEqual(repository.get("food").expiration_date, "2030-01-01")
+            self.assertEqual(list(repository.search("updated")), ["3"])
+
+        def test_replay_log_without_snapshot(self):
+            for policy in FSYNC_POLICIES:
+                with self.subTest(policy=policy):
+                    self.directory.cleanup()
+                    os.makedirs(self.directory.name)
+                    repository = self.open(fsync=policy)
+                    self.fill(repository)
+                    repository.close(snapshot=False)
+                    self.assertFalse(os.path.exists(repository.snapshot_filename))
+                    repository = self.open()
+                    self.check(repository)
+                    repository.close()
+
+        def test_snapshot_and_log_tail(self):
+            repository = self.open()
+            self.fill(repository)
+            repository.save_snapshot()
+            repository.add(Product("tail", "After the snapshot", 1))
+            repository.close(snapshot=False)
+            self.assertEqual(
+                len(WriteAheadLog.segment_filenames(self.directory.name)), 1
+            )
+            repository = self.open()
+            self.assertEqual(repository.get("tail").name, "After the snapshot")
+            self.assertEqual(len(repository.list()), 11)
+            repository.close()
+
+        def test_torn_tail_is_dropped(self):
+            repository = self.open()
+            self.fill(repository)
+            repository.close(snapshot=False)
+            segment = WriteAheadLog.segment_filenames(self.directory.name)[-1]
+            with open(segment, "ab") as file:
+                file.write(_encode_record(99, {"op": "delete", "code": "1"})[:-3])
+            repository = self.open()
+            self.check(repository)
+            repository.add(Product("new", "Product", 1))
+            repository.close(snapshot=False)
+            repository = self.open()
+            self.assertEqual(repository.get("new").code, "new")
+            repository.close()
+
+        def test_group_commit_shares_syncs(self):
+            repository = self.open(fsync="batch")
+            original_fsync = os.fsync
+
+            def slow_fsync(fd):
+                threading.Event().wait(0.005)
+                original_fsync(fd)
+
+            def writer(worker):
+                for number in range(20):
+                    repository.add(Product(f"{worker}-{number}", "Product", 1))
+
+            with mock.patch("os.fsync", slow_fsync):
+                threads = [
+                    threading.Thread(target=writer, args=(worker,))
+                    for worker in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(repository.wal.durable_lsn, 160)
+            self.assertLess(repository.wal.syncs, 160 / 2)
+            repository.close(snapshot=False)
+            repository = self.open()
+            self.assertEqual(len(repository.list()), 160)
+            repository.close()
+
+        def test_background_snapshots(self):
+            repository = self.open(snapshot_interval=0.05)
+            self.fill(repository)
+            threading.Event().wait(0.3)
+            self.assertEqual(repository.snapshot_lsn, repository.wal.last_lsn)
+            repository.close()
+            lsn, storage = read_snapshot(repository.snapshot_filename)
+            self.assertEqual(len(storage), 10)
+
+    unittest.main()
@@ -0,0 +1,261 @@
+import json
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+from loggers import logger
+
+
+@dataclass(frozen=True)
+class ProductEvent:
+    """Base class for the changes published by the repositories"""
+
+    code: str
+    timestamp: float = field(default_factory=time.time)
+
+    event_type = "event"
+
+    def to_dict(self) -> dict:
+        return {"event_type": self.event_type, **asdict(self)}
+
+    @staticmethod
+    def from_dict(event_data: dict) -> "ProductEvent":
+        event_data = dict(event_data)
+        event_class = EVENT_TYPES[event_data.pop("event_type")]
+        if "changes" in event_data:
+            event_data["changes"] = {
+                name: tuple(change) for name, change in event_data["changes"].items()
+            }
+        return event_class(**event_data)
+
+
+@dataclass(frozen=True)
+class ProductCreated(ProductEvent):
+    data: dict = field(default_factory=dict)
+
+    event_type = "created"
+
+
+@dataclass(frozen=True)
+class ProductUpdated(ProductEvent):
+    """changes maps every modified field to its (old, new) values"""
+
+    changes: dict = field(default_factory=dict)
+    data: dict = field(default_factory=dict)
+
+    event_type = "updated"
+
+
+@dataclass(frozen=True)
+class ProductDeleted(ProductEvent):
+    data: dict | None = None
+
+    event_type = "deleted"
+
+
+EVENT_TYPES = {
+    event_class.event_type: event_class
+    for event_class in (ProductCreated, ProductUpdated, ProductDeleted)
+}
+
+
+def make_change_event(
+    old_data: dict | None, new_data: dict | None
+) -> ProductEvent | None:
+    """Return the event describing a write, None if nothing changed"""
+    if old_data is None and new_data is not None:
+        return ProductCreated(code=new_data["code"], data=dict(new_data))
+    if new_data is None and old_data is not None:
+        return ProductDeleted(code=old_data["code"], data=dict(old_data))
+    if old_data is None or new_data is None:
+        return None
+    changes = {
+        name: (old_data.get(name), value)
+        for name, value in new_data.items()
+        if name != "version" and old_data.get(name) != value
+    }
+    if not changes:
+        return None
+    return ProductUpdated(code=new_data["code"], changes=changes, data=dict(new_data))
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", callback, event_types=None):
+        self.bus = bus
+        self.callback = callback
+        self.event_types = tuple(event_types) if event_types else None
+
+    def accepts(self, event: ProductEvent) -> bool:
+        return self.event_types is None or isinstance(event, self.event_types)
+
+    def deliver(self, event: ProductEvent):
+        try:
+            self.callback(event)
+        except Exception as ex:
+            logger.error("Error handling %s: %s", event, ex, exc_info=True)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class QueuedSubscription(Subscription):
+    """Subscription whose callback runs in its own thread, so a slow
+    subscriber never delays the writes that publish the events"""
+
+    _STOP = object()
+
+    def __init__(self, bus: "EventBus", callback, event_types=None, maxsize=0):
+        super().__init__(bus, callback, event_types)
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def deliver(self, event: ProductEvent):
+        self.queue.put(event)
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                if event is self._STOP:
+                    return
+                super().deliver(event)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until every queued event has been handled"""
+        self.queue.join()
+
+    def close(self):
+        super().close()
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+
+class EventBus:
+    """In-process publish/subscribe of product change events"""
+
+    def __init__(self):
+        self._subscriptions: list[Subscription] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback, event_types=None, queued=False, maxsize=0):
+        """Call callback with every published event of the given types
+
+        Synchronous subscribers run inside publish(); queued subscribers get
+        their own thread and a queue of at most maxsize pending events.
+        """
+        if queued:
+            subscription = QueuedSubscription(self, callback, event_types, maxsize)
+        else:
+            subscription = Subscription(self, callback, event_types)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions = [
+                other for other in self._subscriptions if other is not subscription
+            ]
+
+    def publish(self, event: ProductEvent):
+        for subscription in self._subscriptions:
+            if subscription.accepts(event):
+                subscription.deliver(event)
+
+    def join(self):
+        """Wait until the queued subscribers are idle"""
+        for subscription in self._subscriptions:
+            if isinstance(subscription, QueuedSubscription):
+                subscription.join()
+
+    def close(self):
+        for subscription in list(self._subscriptions):
+            subscription.close()
+
+
+class JournalWriter:
+    """Subscriber appending every event as a JSON line to a journal file"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._file = open(filename, "a", encoding="utf-8")
+
+    def __call__(self, event: ProductEvent):
+        line = json.dumps(event.to_dict(), ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class JournalTailer:
+    """Read the events appended to a journal file since the last poll
+
+    The byte offset of the next unread line is kept in `offset`, so a
+    consumer in another process can persist it and resume from there.
+    """
+
+    def __init__(self, filename: str, offset: int = 0):
+        self.filename = filename
+        self.offset = offset
+
+    def poll(self) -> list[ProductEvent]:
+        try:
+            with open(self.filename, "rb") as file:
+                file.seek(self.offset)
+                chunk = file.read()
+        except FileNotFoundError:
+            return []
+        # A writer may be in the middle of a line, leave it for the next poll
+        complete = chunk[: chunk.rfind(b"\n") + 1]
+        self.offset += len(complete)
+        return [
+            ProductEvent.from_dict(json.loads(line))
+            for line in complete.decode("utf-8").splitlines()
+            if line
+        ]
+
+    def follow(self, interval: float = 0.5, stop: threading.Event | None = None):
+        """Yield the events as they are appended, until stop is set"""
+        while stop is None or not stop.is_set():
+            events = self.poll()
+            if not events:
+                time.sleep(interval)
+            yield from events
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import unittest
+
+    class TestJournal(unittest.TestCase):
+        def setUp(self):
+            directory = tempfile.mkdtemp()
+            self.filename = os.path.join(directory, "journal.jsonl")
+
+        def test_tail_events(self):
+            writer = JournalWriter(self.filename)
+            tailer = JournalTailer(self.filename)
+            writer(ProductCreated(code="1", data={"code": "1", "price": 1.0}))
+            self.assertEqual([event.code for event in tailer.poll()], ["1"])
+            writer(ProductUpdated(code="1", changes={"price": (1.0, 2.0)}))
+            with open(self.filename, "a") as file:
+                file.write('{"event_type": "deleted", "co')
+            events = tailer.poll()
+            self.assertEqual(events[0].changes, {"price": (1.0, 2.0)})
+            self.assertEqual(len(events), 1)
+            with open(self.filename, "a") as file:
+                file.write('de": "1", "timestamp": 0}\n')
+            self.assertEqual(tailer.poll(), [ProductDeleted(code="1", timestamp=0)])
+            writer.close()
+
+    unittest.main()
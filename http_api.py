@@ -0,0 +1,678 @@
+"""HTTP/1.1 JSON API over AsyncProductService, on asyncio streams
+
+    GET    /products?offset=0&limit=100&product_type=food&available=true
+           &price_between=1,10&stock_below=5&order_by=-price
+    POST   /products                  body: a product
+    GET    /products/<code>           ETag, If-None-Match answers 304
+    PUT    /products/<code>           body: the product, If-Match: its ETag
+    DELETE /products/<code>
+    POST   /get-many                  body: {"codes": [...]}
+    GET    /search?q=<query>&limit=10
+
+Connections are kept alive between requests, HTTP/1.1 by default, and
+the repository calls run on the bounded executor of AsyncProductRepository
+so the event loop never blocks on MySQL or a file.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+from loggers import logger
+from models import BaseProduct, ProductFactory
+from repositories import ProductNotFoundError, VersionConflictError
+from services import AsyncProductService
+from tracing import span
+
+MAX_BODY_SIZE = 1 << 20
+MAX_HEADERS = 100
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str | None = None, headers=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+        self.headers = headers or {}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    query: dict[str, list[str]]
+    # Names in lowercase
+    headers: dict[str, str]
+    body: bytes = b""
+    version: str = "HTTP/1.1"
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def param(self, name: str, default=None):
+        values = self.query.get(name)
+        return values[-1] if values else default
+
+    def int_param(self, name: str, default: int, maximum: int | None = None) -> int:
+        value = self.param(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise HTTPError(400, f"{name} must be an integer")
+        if value < 0 or (maximum is not None and value > maximum):
+            raise HTTPError(400, f"{name} must be between 0 and {maximum}")
+        return value
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, "The body must be JSON")
+
+
+@dataclass
+class Response:
+    status: int = 200
+    # Sent as JSON, nothing when None
+    body: object = None
+    headers: dict[str, str] = field(default_factory=dict)
+
+    def encode(self, keep_alive: bool) -> bytes:
+        payload = b""
+        headers = dict(self.headers)
+        if self.body is not None:
+            payload = json.dumps(self.body, default=str).encode()
+            headers["Content-Type"] = "application/json"
+        if self.status not in (204, 304):
+            headers["Content-Length"] = str(len(payload))
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        head = f"HTTP/1.1 {self.status} {HTTPStatus(self.status).phrase}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        return (head + "\r\n").encode("latin-1") + payload
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request | None:
+    """Read the next request of a connection, None once the client closed it"""
+    try:
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        if not version.startswith("HTTP/1."):
+            raise HTTPError(505)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                return None
+            if line in (b"\r\n", b"\n"):
+                break
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise HTTPError(400, "Malformed header")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > MAX_HEADERS:
+                raise HTTPError(431)
+    except ValueError:
+        # A line longer than the limit of the reader
+        raise HTTPError(431)
+    if "transfer-encoding" in headers:
+        raise HTTPError(501, "Chunked request bodies are not supported")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413)
+    body = await reader.readexactly(length) if length else b""
+    target = urlsplit(target)
+    return Request(
+        method=method.upper(),
+        path=unquote(target.path),
+        query=parse_qs(target.query),
+        headers=headers,
+        body=body,
+        version=version,
+    )
+
+
+def product_json(product: BaseProduct) -> dict:
+    return {**product.to_dict(), "version": product.version}
+
+
+def product_etag(product: BaseProduct) -> str:
+    """Return the version and a digest of the product: every write moves
+    the version forward, but it starts again at 0 when a deleted code is
+    added again, and the digest tells the two products apart"""
+    data = json.dumps(product_json(product), sort_keys=True, default=str)
+    digest = hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+    return f'"{product.version}-{digest}"'
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    """Whether an If-None-Match or If-Match header lists etag, or is *"""
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def expected_version(header: str) -> int:
+    """Return the version an If-Match header holds the ETag of"""
+    try:
+        version, _ = header.strip().removeprefix("W/").strip('"').split("-", 1)
+        return int(version)
+    except ValueError:
+        raise HTTPError(400, "If-Match must be the ETag of the product")
+
+
+class ProductAPI:
+    """Routes of the JSON API, answering a Request with a Response"""
+
+    def __init__(self, service: AsyncProductService):
+        self.service = service
+        # Code -> lock of the POSTs adding it, and how many are waiting on it
+        self._adding: dict[str, tuple[asyncio.Lock, int]] = {}
+        self.routes = [
+            ("/products", {"GET": self.list_products, "POST": self.add_product}),
+            (
+                re.compile(r"/products/(?P<code>[^/]+)"),
+                {
+                    "GET": self.get_product,
+                    "PUT": self.update_product,
+                    "DELETE": self.delete_product,
+                },
+            ),
+            ("/get-many", {"POST": self.get_many}),
+            ("/search", {"GET": self.search}),
+        ]
+
+    def _route(self, request: Request):
+        for path, handlers in self.routes:
+            if isinstance(path, str):
+                params = {} if request.path == path else None
+            else:
+                match = path.fullmatch(request.path)
+                params = match.groupdict() if match else None
+            if params is None:
+                continue
+            if request.method not in handlers:
+                raise HTTPError(405, headers={"Allow": ", ".join(handlers)})
+            return handlers[request.method], params
+        raise HTTPError(404)
+
+    async def handle(self, request: Request) -> Response:
+        try:
+            handler, params = self._route(request)
+            with span(f"HTTP {request.method} {handler.__name__}", path=request.path):
+                return await handler(request, **params)
+        except HTTPError as error:
+            return Response(error.status, {"error": str(error)}, error.headers)
+        except Exception as ex:
+            logger.error("Error answering %s %s: %s", request.method, request.path, ex)
+            logger.debug("Traceback", exc_info=True)
+            return Response(500, {"error": "Internal server error"})
+
+    def _product_from(self, data, code: str | None = None) -> BaseProduct:
+        if not isinstance(data, dict):
+            raise HTTPError(400, "The body must be a JSON object")
+        if code is not None:
+            if data.setdefault("code", code) != code:
+                raise HTTPError(400, "The code of the body is not the one of the URL")
+        data.pop("version", None)
+        try:
+            return ProductFactory().create_product(**data)
+        except (TypeError, ValueError) as ex:
+            raise HTTPError(400, str(ex))
+
+    async def list_products(self, request: Request) -> Response:
+        """One page of the products matching the filters, in code order by
+        default; the repository skips the products before it"""
+        offset = request.int_param("offset", 0)
+        limit = request.int_param("limit", DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        filters = {"order_by": request.param("order_by") or "code"}
+        if request.param("product_type"):
+            filters["product_type"] = request.param("product_type")
+        if request.param("available"):
+            filters["available"] = request.param("available").lower() == "true"
+        if request.param("price_between"):
+            try:
+                low, high = map(float, request.param("price_between").split(","))
+            except ValueError:
+                raise HTTPError(400, "price_between must be two numbers, like 1,10")
+            filters["price_between"] = (low, high)
+        if request.param("stock_below"):
+            filters["stock_below"] = request.int_param("stock_below", 0)
+        try:
+            products = await self.service.find(**filters, offset=offset, limit=limit)
+        except ValueError as ex:
+            raise HTTPError(400, str(ex))
+        page = list(products.values())
+        next_page = None
+        if len(page) == limit:
+            query = {name: values[-1] for name, values in request.query.items()}
+            query.update(offset=offset + limit, limit=limit)
+            next_page = f"/products?{urlencode(query)}"
+        return Response(
+            body={
+                "products": [product_json(product) for product in page],
+                "offset": offset,
+                "limit": limit,
+                "next": next_page,
+            }
+        )
+
+    async def add_product(self, request: Request) -> Response:
+        """Add a product, 409 if its code exists; the POSTs of a code are
+        checked and added one at a time, the repositories' add() may replace
+        a product rather than fail"""
+        product = self._product_from(request.json())
+        lock, waiting = self._adding.get(product.code, (asyncio.Lock(), 0))
+        self._adding[product.code] = (lock, waiting + 1)
+        try:
+            async with lock:
+                await self._add_new(product)
+        finally:
+            lock, waiting = self._adding[product.code]
+            if waiting == 1:
+                del self._adding[product.code]
+            else:
+                self._adding[product.code] = (lock, waiting - 1)
+        product = await self.service.get(product.code) or product
+        return Response(
+            201,
+            product_json(product),
+            {
+                "Location": f"/products/{quote(product.code, safe='')}",
+                "ETag": product_etag(product),
+            },
+        )
+
+    async def _add_new(self, product: BaseProduct):
+        exists = HTTPError(409, f"Product with code {product.code} already exists")
+        if await self.service.get(product.code) is not None:
+            raise exists
+        try:
+            await self.service.add(product)
+        except ValueError as ex:
+            # Added meanwhile by another process, to a repository that refuses
+            # duplicates like WriteBehindRepository
+            if await self.service.get(product.code) is not None:
+                raise exists from ex
+            raise HTTPError(400, str(ex))
+
+    async def get_product(self, request: Request, code: str) -> Response:
+        product = await self.service.get(code)
+        if product is None:
+            raise HTTPError(404, f"Product with code {code} not found")
+        etag = product_etag(product)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(304, headers={"ETag": etag})
+        return Response(body=product_json(product), headers={"ETag": etag})
+
+    async def update_product(self, request: Request, code: str) -> Response:
+        """Replace a product; with If-Match only if it is still at that ETag"""
+        product = self._product_from(request.json(), code)
+        if_match = request.headers.get("if-match")
+        version = None
+        if if_match and if_match.strip() != "*":
+            version = expected_version(if_match)
+            current = await self.service.get(code)
+            if current is not None and not etag_matches(
+                if_match, product_etag(current)
+            ):
+                # Changed, or deleted and added again at the same version
+                raise HTTPError(412, f"Product with code {code} has changed")
+        try:
+            await self.service.update(product, version)
+        except VersionConflictError as ex:
+            raise HTTPError(412, str(ex))
+        except (ProductNotFoundError, ValueError) as ex:
+            # The in-memory repositories raise ValueError for a missing code
+            if await self.service.get(code) is None:
+                raise HTTPError(404, f"Product with code {code} not found")
+            raise HTTPError(400, str(ex))
+        product = await self.service.get(code) or product
+        return Response(
+            body=product_json(product), headers={"ETag": product_etag(product)}
+        )
+
+    async def delete_product(self, request: Request, code: str) -> Response:
+        try:
+            await self.service.delete(code)
+        except (ProductNotFoundError, ValueError):
+            raise HTTPError(404, f"Product with code {code} not found")
+        return Response(204)
+
+    async def get_many(self, request: Request) -> Response:
+        data = request.json()
+        codes = data.get("codes") if isinstance(data, dict) else None
+        if not isinstance(codes, list) or len(codes) > MAX_PAGE_SIZE:
+            raise HTTPError(400, f"codes must be a list of up to {MAX_PAGE_SIZE}")
+        products = await self.service.get_many([str(code) for code in codes])
+        return Response(
+            body={code: product_json(product) for code, product in products.items()}
+        )
+
+    async def search(self, request: Request) -> Response:
+        limit = request.int_param("limit", 10, MAX_PAGE_SIZE)
+        products = await self.service.search(request.param("q", ""), limit)
+        return Response(
+            body={"products": [product_json(product) for product in products.values()]}
+        )
+
+
+class ProductAPIServer:
+    """Serve a ProductAPI on a TCP port
+
+    Every connection is a task reading requests one after the other until
+    the client closes it, asks to, or stays idle keep_alive_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        service: AsyncProductService,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        keep_alive_timeout: float = 15,
+    ):
+        self.api = ProductAPI(service)
+        self.host = host
+        self.port = port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.server: asyncio.Server | None = None
+        self._connections: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        # Connections answering a request
+        self._busy: set[asyncio.Task] = set()
+        self._closing = False
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._serve_connection, self.host, self.port
+        )
+        # The port the system chose when port is 0
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        """Stop listening and end the connections, the idle ones at once and
+        the others after their current request"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self._closing = True
+        for task, writer in self._connections.items():
+            if task not in self._busy:
+                writer.transport.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(reader), self.keep_alive_timeout
+                    )
+                except HTTPError as error:
+                    response = Response(error.status, {"error": str(error)})
+                    writer.write(response.encode(keep_alive=False))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                self._busy.add(task)
+                try:
+                    response = await self.api.handle(request)
+                    keep_alive = request.keep_alive and not self._closing
+                    writer.write(response.encode(keep_alive))
+                    await writer.drain()
+                finally:
+                    self._busy.discard(task)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+
+class KeepAliveClient:
+    """Minimal HTTP/1.1 client sending requests on one kept alive connection"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def request(
+        self, method: str, path: str, body=None, headers: dict | None = None
+    ) -> tuple[int, dict[str, str], object]:
+        """Return the status, headers, lowercase, and decoded JSON body"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        payload = b"" if body is None else json.dumps(body).encode()
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        head += f"Content-Length: {len(payload)}\r\n\r\n"
+        self.writer.write(head.encode("latin-1") + payload)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        data = await self.reader.readexactly(length) if length else b""
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status, response_headers, json.loads(data) if data else None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+if __name__ == "__main__":
+    import time
+    import unittest
+    from unittest import mock
+
+    from async_repositories import AsyncProductRepository
+    from models import Product
+    from repositories import DictProductRepository
+
+    class TestProductAPI(unittest.IsolatedAsyncioTestCase):
+        async def asyncSetUp(self):
+            repository = DictProductRepository()
+            for code in range(1, 6):
+                repository.add(Product(str(code), f"Pen {code}", code, stock=code))
+            self.repository = AsyncProductRepository(repository)
+            self.server = ProductAPIServer(AsyncProductService(self.repository), port=0)
+            await self.server.start()
+            self.client = KeepAliveClient("127.0.0.1", self.server.port)
+
+        async def asyncTearDown(self):
+            await self.client.close()
+            await self.server.close()
+            self.repository.close()
+
+        async def test_conditional_get(self):
+            status, headers, body = await self.client.request("GET", "/products/2")
+            self.assertEqual((status, body["name"]), (200, "Pen 2"))
+            etag = headers["etag"]
+            status, headers, body = await self.client.request(
+                "GET", "/products/2", headers={"If-None-Match": etag}
+            )
+            self.assertEqual((status, body, headers["etag"]), (304, None, etag))
+            await self.client.request(
+                "PUT", "/products/2", {"name": "Pen", "price": 3, "stock": 1}
+            )
+            status, headers, _ = await self.client.request(
+                "GET", "/products/2", headers={"If-None-Match": etag}
+            )
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers["etag"], etag)
+
+        async def test_etag_changes_when_a_code_is_added_again(self):
+            _, headers, body = await self.client.request("GET", "/products/2")
+            etag = headers["etag"]
+            await self.client.request("DELETE", "/products/2")
+            status, headers, created = await self.client.request(
+                "POST", "/products", {"code": "2", "name": "Ink", "price": 4}
+            )
+            # At the version the deleted product had
+            self.assertEqual((status, created["version"]), (201, body["version"]))
+            self.assertNotEqual(headers["etag"], etag)
+            status, _, _ = await self.client.request(
+                "GET", "/products/2", headers={"If-None-Match": etag}
+            )
+            self.assertEqual(status, 200)
+            status, _, _ = await self.client.request(
+                "PUT", "/products/2", {"name": "Pen", "price": 1}, {"If-Match": etag}
+            )
+            self.assertEqual(status, 412)
+            self.assertEqual((await self.repository.get("2")).name, "Ink")
+
+        async def test_crud(self):
+            milk = {
+                "code": "m1",
+                "name": "Milk",
+                "price": 2,
+                "product_type": "food",
+                "expiration_date": "2030-01-01",
+            }
+            status, headers, body = await self.client.request("POST", "/products", milk)
+            self.assertEqual((status, headers["location"]), (201, "/products/m1"))
+            self.assertEqual(body["expiration_date"], "2030-01-01")
+            etag = headers["etag"]
+            status, _, _ = await self.client.request("POST", "/products", milk)
+            self.assertEqual(status, 409)
+            status, _, body = await self.client.request(
+                "PUT", "/products/m1", {**milk, "price": 2.5}, {"If-Match": etag}
+            )
+            self.assertEqual((status, body["price"], body["version"]), (200, 2.5, 1))
+            status, _, _ = await self.client.request(
+                "PUT", "/products/m1", milk, {"If-Match": etag}
+            )
+            self.assertEqual(status, 412)
+            status, _, _ = await self.client.request(
+                "PUT", "/products/m1", milk, {"If-Match": '"latest"'}
+            )
+            self.assertEqual(status, 400)
+            status, _, _ = await self.client.request("PUT", "/products/x", milk)
+            self.assertEqual(status, 400)
+            status, _, _ = await self.client.request(
+                "PUT", "/products/x", {"name": "X", "price": 1}
+            )
+            self.assertEqual(status, 404)
+            status, _, _ = await self.client.request("DELETE", "/products/m1")
+            self.assertEqual(status, 204)
+            status, _, _ = await self.client.request("DELETE", "/products/m1")
+            self.assertEqual(status, 404)
+            status, _, body = await self.client.request(
+                "POST", "/products", {"code": "b", "name": "Bad", "price": -1}
+            )
+            self.assertEqual((status, body["error"]), (400, "Price cannot be negative"))
+
+        async def test_pages_get_many_and_search(self):
+            status, _, page = await self.client.request("GET", "/products?limit=2")
+            self.assertEqual([p["code"] for p in page["products"]], ["1", "2"])
+            _, _, page = await self.client.request("GET", page["next"])
+            self.assertEqual([p["code"] for p in page["products"]], ["3", "4"])
+            _, _, page = await self.client.request("GET", page["next"])
+            self.assertEqual([p["code"] for p in page["products"]], ["5"])
+            self.assertIsNone(page["next"])
+            with mock.patch.object(
+                self.repository.repository,
+                "find",
+                wraps=self.repository.repository.find,
+            ) as find:
+                await self.client.request("GET", "/products?offset=4&limit=2")
+            self.assertEqual(find.call_args.kwargs["offset"], 4)
+            self.assertEqual(find.call_args.kwargs["limit"], 2)
+            _, _, page = await self.client.request(
+                "GET", "/products?stock_below=3&order_by=-price"
+            )
+            self.assertEqual([p["code"] for p in page["products"]], ["2", "1"])
+            _, _, products = await self.client.request(
+                "POST", "/get-many", {"codes": ["1", "3", "9"]}
+            )
+            self.assertEqual(sorted(products), ["1", "3"])
+            _, _, found = await self.client.request("GET", "/search?q=pen%204")
+            self.assertEqual([p["code"] for p in found["products"]], ["4"])
+
+        async def test_concurrent_posts_of_a_code(self):
+            repository = DictProductRepository()
+            add = repository.add
+
+            def slow_add(product):
+                time.sleep(0.05)
+                add(product)
+
+            repository.add = slow_add
+            async_repository = AsyncProductRepository(repository, max_concurrency=4)
+            server = ProductAPIServer(AsyncProductService(async_repository), port=0)
+            await server.start()
+            clients = [KeepAliveClient("127.0.0.1", server.port) for _ in range(4)]
+            responses = await asyncio.gather(
+                *(
+                    client.request(
+                        "POST", "/products", {"code": "p", "name": name, "price": 1}
+                    )
+                    for client, name in zip(clients, "ABCD")
+                )
+            )
+            statuses = sorted(status for status, _, _ in responses)
+            self.assertEqual(statuses, [201, 409, 409, 409])
+            winner = next(body for status, _, body in responses if status == 201)
+            self.assertEqual(repository.get("p").name, winner["name"])
+            self.assertEqual(server.api._adding, {})
+            for client in clients:
+                await client.close()
+            await server.close()
+            async_repository.close()
+
+        async def test_errors_and_keep_alive(self):
+            status, headers, _ = await self.client.request("PATCH", "/products/1")
+            self.assertEqual((status, headers["allow"]), (405, "GET, PUT, DELETE"))
+            status, _, _ = await self.client.request("GET", "/nothing")
+            self.assertEqual(status, 404)
+            status, _, _ = await self.client.request("GET", "/products?limit=x")
+            self.assertEqual(status, 400)
+            writer = self.client.writer
+            await self.client.request("GET", "/products/1")
+            self.assertIs(self.client.writer, writer)
+            status, headers, _ = await self.client.request(
+                "GET", "/products/1", headers={"Connection": "close"}
+            )
+            self.assertEqual((status, headers["connection"]), (200, "close"))
+            self.assertIsNone(self.client.writer)
+
+    unittest.main()
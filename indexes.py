@@ -0,0 +1,377 @@
+import datetime
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str | None) -> list[str]:
+    """Split a text in lowercase tokens without accents"""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return TOKEN_PATTERN.findall(text)
+
+
+def to_date_key(value: str | datetime.date) -> str:
+    """Return a date as an ISO string, which sorts like the date itself"""
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return datetime.date.fromisoformat(value).isoformat()
+
+
+class BaseIndex:
+    """Secondary index kept up to date by the in-memory repositories"""
+
+    def add(self, product_data: dict):
+        raise NotImplementedError
+
+    def remove(self, product_data: dict):
+        raise NotImplementedError
+
+    def update(self, old_data: dict, new_data: dict):
+        self.remove(old_data)
+        self.add(new_data)
+
+    def clear(self):
+        raise NotImplementedError
+
+    def rebuild(self, rows):
+        self.clear()
+        for product_data in rows:
+            self.add(product_data)
+
+
+class SearchIndex(BaseIndex):
+    """Inverted index over name and description with prefix lookups
+
+    Every term keeps a posting dictionary code -> weight, and the terms are
+    also kept in a sorted list so a prefix is resolved with two bisections.
+    """
+
+    NAME_WEIGHT = 3
+    DESCRIPTION_WEIGHT = 1
+    EXACT_MATCH_BONUS = 2
+
+    def __init__(self):
+        self.postings: dict[str, dict[str, int]] = {}
+        self.terms: list[str] = []
+        self.document_terms: dict[str, tuple[str, ...]] = {}
+
+    def _weighted_terms(self, product_data: dict) -> dict[str, int]:
+        weights = {}
+        for term in tokenize(product_data.get("name")):
+            weights[term] = weights.get(term, 0) + self.NAME_WEIGHT
+        for term in tokenize(product_data.get("description")):
+            weights[term] = weights.get(term, 0) + self.DESCRIPTION_WEIGHT
+        return weights
+
+    def add(self, product_data: dict):
+        code = product_data["code"]
+        if code in self.document_terms:
+            self.remove(product_data)
+        for term in self._add_postings(product_data):
+            insort(self.terms, term)
+
+    def _add_postings(self, product_data: dict) -> list[str]:
+        """Index the terms of a new product, return those new to the index"""
+        code = product_data["code"]
+        weights = self._weighted_terms(product_data)
+        new_terms = []
+        for term, weight in weights.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                new_terms.append(term)
+            posting[code] = weight
+        self.document_terms[code] = tuple(weights)
+        return new_terms
+
+    def rebuild(self, rows):
+        # Sort the terms once at the end instead of inserting them one by one
+        self.clear()
+        for product_data in rows:
+            if product_data["code"] in self.document_terms:
+                # Rare: remove needs the terms sorted
+                self.terms = sorted(self.postings)
+                self.remove(product_data)
+            self._add_postings(product_data)
+        self.terms = sorted(self.postings)
+
+    def remove(self, product_data: dict):
+        code = product_data["code"]
+        for term in self.document_terms.pop(code, ()):
+            posting = self.postings[term]
+            posting.pop(code, None)
+            if not posting:
+                del self.postings[term]
+                del self.terms[bisect_left(self.terms, term)]
+
+    def clear(self):
+        self.postings = {}
+        self.terms = []
+        self.document_terms = {}
+
+    def _prefix_range(self, prefix: str) -> tuple[int, int]:
+        start = bisect_left(self.terms, prefix)
+        return start, bisect_left(self.terms, prefix + "\U0010ffff", start)
+
+    def _token_scores(self, token: str, terms: list[str]) -> dict[str, int]:
+        scores: dict[str, int] = {}
+        for term in terms:
+            bonus = self.EXACT_MATCH_BONUS if term == token else 1
+            for code, weight in self.postings[term].items():
+                scores[code] = scores.get(code, 0) + weight * bonus
+        return scores
+
+    def _probe_scores(self, scores: dict[str, int], token: str) -> dict[str, int]:
+        probed = {}
+        for code, score in scores.items():
+            token_score = 0
+            for term in self.document_terms[code]:
+                if term.startswith(token):
+                    bonus = self.EXACT_MATCH_BONUS if term == token else 1
+                    token_score += self.postings[term][code] * bonus
+            if token_score:
+                probed[code] = score + token_score
+        return probed
+
+    def search(self, query: str, limit: int | None = 10) -> list[tuple[str, int]]:
+        """Return (code, score) pairs of the products matching every token
+
+        Every token matches the terms starting with it, exact matches and
+        matches in the name are ranked higher.
+        """
+        ranges = []
+        for token in dict.fromkeys(tokenize(query)):
+            start, end = self._prefix_range(token)
+            if start == end:
+                return []
+            ranges.append((end - start, token, start, end))
+        if not ranges:
+            return []
+        # Start from the token matching the fewest terms, then intersect
+        ranges.sort(key=lambda token_range: token_range[0])
+        _, token, start, end = ranges[0]
+        scores = self._token_scores(token, self.terms[start:end])
+        for term_count, token, start, end in ranges[1:]:
+            if not scores:
+                break
+            # Few candidates left: check their own terms instead of the postings
+            if len(scores) < term_count:
+                scores = self._probe_scores(scores, token)
+                continue
+            terms = self.terms[start:end]
+            if len(scores) < sum(len(self.postings[term]) for term in terms):
+                scores = self._probe_scores(scores, token)
+                continue
+            token_scores = self._token_scores(token, terms)
+            scores = {
+                code: score + token_scores[code]
+                for code, score in scores.items()
+                if code in token_scores
+            }
+        ranking_key = lambda item: (-item[1], item[0])  # noqa: E731
+        if limit is None:
+            return sorted(scores.items(), key=ranking_key)
+        return heapq.nsmallest(limit, scores.items(), key=ranking_key)
+
+
+class ExpirationIndex(BaseIndex):
+    """Food products sorted by expiration date
+
+    Entries are (ISO date, code) pairs kept sorted with bisect, so a date
+    window is answered without parsing any date.
+    """
+
+    def __init__(self):
+        self.entries: list[tuple[str, str]] = []
+
+    @staticmethod
+    def _entry(product_data: dict) -> tuple[str, str] | None:
+        if product_data.get("product_type") != "food":
+            return None
+        expiration_date = product_data.get("expiration_date")
+        if not expiration_date:
+            return None
+        return to_date_key(expiration_date), product_data["code"]
+
+    def add(self, product_data: dict):
+        entry = self._entry(product_data)
+        if entry is not None:
+            insort(self.entries, entry)
+
+    def remove(self, product_data: dict):
+        entry = self._entry(product_data)
+        if entry is None:
+            return
+        position = bisect_left(self.entries, entry)
+        if position < len(self.entries) and self.entries[position] == entry:
+            del self.entries[position]
+
+    def update(self, old_data: dict, new_data: dict):
+        if self._entry(old_data) != self._entry(new_data):
+            super().update(old_data, new_data)
+
+    def clear(self):
+        self.entries = []
+
+    def range(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        after: tuple[str, str] | None = None,
+        limit: int | None = None,
+    ) -> list[tuple[str, str]]:
+        """Return the entries between start and end, both included, that come
+        after the given entry"""
+        lower = bisect_left(self.entries, (to_date_key(start),))
+        if after is not None:
+            lower = max(lower, bisect_right(self.entries, after))
+        upper = bisect_right(self.entries, (to_date_key(end), "\U0010ffff"))
+        if limit is not None:
+            upper = min(upper, lower + limit)
+        return self.entries[lower:upper]
+
+
+class ProductTypeIndex(BaseIndex):
+    """Codes of the products of every type"""
+
+    def __init__(self):
+        self.codes: dict[str, set[str]] = {}
+
+    def add(self, product_data: dict):
+        product_type = product_data.get("product_type", "product")
+        self.codes.setdefault(product_type, set()).add(product_data["code"])
+
+    def remove(self, product_data: dict):
+        product_type = product_data.get("product_type", "product")
+        codes = self.codes.get(product_type)
+        if codes is None:
+            return
+        codes.discard(product_data["code"])
+        if not codes:
+            del self.codes[product_type]
+
+    def update(self, old_data: dict, new_data: dict):
+        if old_data.get("product_type") != new_data.get("product_type"):
+            super().update(old_data, new_data)
+
+    def clear(self):
+        self.codes = {}
+
+    def of_type(self, product_type: str) -> list[str]:
+        return list(self.codes.get(product_type, ()))
+
+
+class ReorderThresholds:
+    """Stock under which the products need reordering
+
+    A product's own threshold wins over the one of its type, which wins
+    over default. MySQLProductRepository keeps the thresholds of the
+    products in their reorder_threshold column, which rows carry, instead
+    of by_code.
+    """
+
+    def __init__(
+        self,
+        default: int = 0,
+        by_type: dict[str, int] | None = None,
+        by_code: dict[str, int] | None = None,
+    ):
+        self.default = default
+        self.by_type = dict(by_type or {})
+        self.by_code = dict(by_code or {})
+
+    def for_product(self, product_data: dict) -> int:
+        threshold = product_data.get("reorder_threshold")
+        if threshold is None:
+            threshold = self.by_code.get(product_data["code"])
+        if threshold is None:
+            threshold = self.by_type.get(product_data.get("product_type"), self.default)
+        return threshold
+
+    def is_low(self, product_data: dict) -> bool:
+        return product_data["stock"] < self.for_product(product_data)
+
+
+class LowStockIndex(BaseIndex):
+    """Products with less stock than their reorder threshold, lowest first
+
+    A heap of (stock, code) entries of the low products, so a write costs
+    O(log n). Removed entries stay in the heap until they outnumber the
+    live ones, then the heap is rebuilt from the live ones, in `stocks`.
+    """
+
+    def __init__(self, thresholds: ReorderThresholds):
+        self.thresholds = thresholds
+        self.heap: list[tuple[int, str]] = []
+        # Code -> stock of the live entries
+        self.stocks: dict[str, int] = {}
+
+    def _entry(self, product_data: dict) -> tuple[int, str] | None:
+        if not self.thresholds.is_low(product_data):
+            return None
+        return product_data["stock"], product_data["code"]
+
+    def _is_live(self, entry: tuple[int, str]) -> bool:
+        stock, code = entry
+        return self.stocks.get(code) == stock
+
+    def add(self, product_data: dict):
+        entry = self._entry(product_data)
+        if entry is not None:
+            self.stocks[entry[1]] = entry[0]
+            heapq.heappush(self.heap, entry)
+
+    def remove(self, product_data: dict):
+        entry = self._entry(product_data)
+        if entry is None or not self._is_live(entry):
+            return
+        del self.stocks[entry[1]]
+        if len(self.heap) > 2 * len(self.stocks) + 64:
+            self._compact()
+
+    def _compact(self):
+        self.heap = [(stock, code) for code, stock in self.stocks.items()]
+        heapq.heapify(self.heap)
+
+    def update(self, old_data: dict, new_data: dict):
+        if self._entry(old_data) != self._entry(new_data):
+            super().update(old_data, new_data)
+
+    def clear(self):
+        self.heap = []
+        self.stocks = {}
+
+    def rebuild(self, rows):
+        entries = (self._entry(row) for row in rows)
+        self.stocks = {code: stock for stock, code in filter(None, entries)}
+        self._compact()
+
+    def lowest(self, limit: int | None = None) -> list[tuple[int, str]]:
+        """The limit lowest live entries: the removed entries at the root are
+        popped, then the heap is walked from it in O(limit log limit) plus
+        the removed entries met"""
+        if limit is None:
+            return sorted((stock, code) for code, stock in self.stocks.items())
+        while self.heap and not self._is_live(self.heap[0]):
+            heapq.heappop(self.heap)
+        found = []
+        seen = set()
+        frontier = [(self.heap[0], 0)] if self.heap else []
+        while frontier and len(found) < limit:
+            entry, position = heapq.heappop(frontier)
+            # A code removed and added back at the same stock has two entries
+            if self._is_live(entry) and entry[1] not in seen:
+                seen.add(entry[1])
+                found.append(entry)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self.heap):
+                    heapq.heappush(frontier, (self.heap[child], child))
+        return found
@@ -0,0 +1,103 @@
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class ReadWriteLock:
+    """Many readers or a single writer; waiting writers block new readers so
+    a steady stream of reads cannot starve the writes"""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class StripedLock:
+    """A fixed set of read/write locks, chosen by the hash of a key
+
+    Operations on different keys rarely share a stripe, so they don't wait
+    for each other; read_all and write_all take every stripe, always in the
+    same order, for operations that need the whole storage still.
+    """
+
+    def __init__(self, stripes: int = 16):
+        self.stripes = [ReadWriteLock() for _ in range(stripes)]
+
+    def for_key(self, key) -> ReadWriteLock:
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    @contextmanager
+    def read_all(self):
+        with self._acquire_all("read"):
+            yield
+
+    @contextmanager
+    def write_all(self):
+        with self._acquire_all("write"):
+            yield
+
+    @contextmanager
+    def _acquire_all(self, mode: str):
+        acquired = []
+        try:
+            for stripe in self.stripes:
+                context = getattr(stripe, mode)()
+                context.__enter__()
+                acquired.append(context)
+            yield
+        finally:
+            for context in reversed(acquired):
+                context.__exit__(None, None, None)
+
+
+class _NullReadWriteLock:
+    def read(self):
+        return nullcontext()
+
+    def write(self):
+        return nullcontext()
+
+
+class NullStripedLock:
+    """Lock-free stand-in used when a repository is not shared by threads"""
+
+    _lock = _NullReadWriteLock()
+
+    def for_key(self, key):
+        return self._lock
+
+    def read_all(self):
+        return nullcontext()
+
+    def write_all(self):
+        return nullcontext()
@@ -4,7 +4,9 @@ from controller import Controller
 from db import TABLES, MySqlConnector
 from models import ProductFactory
 from repositories import MySQLProductRepository
+from tracing import tracer
 from views import CLIView
+from workload import RecordingRepository
 
 
 def main():
@@ -15,11 +17,24 @@ def main():
     connector = MySqlConnector(**connector_options)
     connector.create_database(config("DB_NAME"))  # Create database if it doesn't exist
     connector.create_tables()  # Create tables if they don't exist
+    connector.run_migrations()  # Add indexes and columns introduced later
     repository = MySQLProductRepository(connector)
+    record_file = config("RECORD_FILE", default="")
+    if record_file:
+        repository = RecordingRepository(repository, record_file)
     view = CLIView()
     product_factory = ProductFactory()
     controller = Controller(repository=repository, view=view, product_factory=product_factory)
-    controller.run()
+    trace_file = config("TRACE_FILE", default="")
+    if trace_file:
+        tracer.enable()
+    try:
+        controller.run()
+    finally:
+        if trace_file:
+            tracer.write(trace_file)
+        if record_file:
+            repository.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from decouple import config
+
+from async_repositories import AsyncProductRepository
+from catalog_io import FORMATS, CatalogImporter, export_products
+from copy_catalog import migrate
+from db import TABLES, MySqlConnector
+from http_api import ProductAPIServer
+from memory_report import BACKENDS, memory_report
+from repositories import MySQLProductRepository, RepositoryFactory
+from services import AsyncProductService
+from tracing import tracer
+from workload import read_workload, replay
+
+REPOSITORY_TYPES = ("mysql", "json", "binary")
+
+
+def get_repository(args, repository_type=None, filename=None):
+    repository_type = repository_type or args.repository
+    if repository_type == "json":
+        return RepositoryFactory.get_repository("json", filename or args.json_file)
+    if repository_type == "binary":
+        return RepositoryFactory.get_repository("binary", filename or args.binary_file)
+    connector = MySqlConnector(conf=config, table_definitions=TABLES)
+    connector.create_database(config("DB_NAME"))
+    connector.create_tables()
+    connector.run_migrations()
+    return MySQLProductRepository(connector)
+
+
+def show_progress(summary: dict):
+    print(
+        f"\rRow {summary['row']}: {summary['imported']} imported, "
+        f"{summary['rejected']} rejected",
+        end="",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def import_command(args):
+    repository = get_repository(args)
+    importer = CatalogImporter(
+        repository,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        progress=show_progress,
+    )
+    try:
+        summary = importer.run(
+            args.filename,
+            file_format=args.format,
+            checkpoint_filename=args.checkpoint,
+            rejects_filename=args.rejects,
+        )
+    finally:
+        repository.close()
+    print(file=sys.stderr)
+    print(
+        f"{summary['imported']} products imported, {summary['rejected']} rejected "
+        f"in {summary['seconds']} s"
+    )
+
+
+def export_command(args):
+    repository = get_repository(args)
+    try:
+        exported = export_products(
+            repository,
+            args.filename,
+            file_format=args.format,
+            batch_size=args.chunk_size,
+        )
+    finally:
+        repository.close()
+    print(f"{exported} products exported to {args.filename}")
+
+
+def show_copy_progress(update: dict):
+    print(
+        f"\r{update['copied']} products copied, "
+        f"{update['rows_per_second']:.0f} rows/s",
+        end="",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def copy_command(args):
+    source = get_repository(args)
+    target = get_repository(args, args.to, args.to_file)
+    try:
+        report = migrate(
+            source, target, batch_size=args.chunk_size, progress=show_copy_progress
+        )
+    finally:
+        source.close()
+        target.close()
+    print(file=sys.stderr)
+    print(
+        f"{report['copied']} products copied in {report['seconds']} s "
+        f"({report['rows_per_second']} rows/s)"
+    )
+    for product_type, totals in report["source"].items():
+        copied = report["target"].get(product_type, {"count": 0})
+        print(f"  {product_type}: {totals['count']} read, {copied['count']} written")
+    if not report["verified"]:
+        print("The copy differs from the source, see the counts above")
+        sys.exit(1)
+
+
+def compact_command(args):
+    if args.repository != "binary":
+        print("Only the binary repository needs compacting")
+        sys.exit(1)
+    repository = get_repository(args)
+    sizes = repository.compact()
+    repository.close()
+    print(f"{args.binary_file}: {sizes['before']} bytes before, {sizes['after']} after")
+
+
+def memory_command(args):
+    report = memory_report(args.products, args.backends, args.top)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def replay_command(args):
+    repository = get_repository(args)
+    try:
+        report = replay(
+            read_workload(args.filename),
+            repository,
+            speed=args.speed,
+            concurrency=args.concurrency,
+        )
+    finally:
+        repository.close()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    print(
+        f"{report['operations']} operations, {report['errors']} errors "
+        f"in {report['seconds']} s ({report['operations_per_second']} ops/s)"
+    )
+    for operation, replayed in report["replayed"].items():
+        recorded = report["recorded"][operation]
+        print(
+            f"  {operation}: {replayed['count']} calls, "
+            f"p50 {replayed['p50_ms']} ms, p90 {replayed['p90_ms']} ms, "
+            f"p99 {replayed['p99_ms']} ms (recorded p50 {recorded['p50_ms']} ms, "
+            f"p99 {recorded['p99_ms']} ms)"
+        )
+
+
+def serve_command(args):
+    repository = get_repository(args)
+    if args.repository == "mysql":
+        # A connection per worker thread, the schema is ready by now
+        async_repository = AsyncProductRepository(
+            repository_factory=lambda: MySQLProductRepository(
+                MySqlConnector(conf=config, table_definitions=TABLES)
+            ),
+            max_concurrency=args.workers,
+        )
+    else:
+        # The file repositories are used by one call at a time
+        async_repository = AsyncProductRepository(repository)
+    server = ProductAPIServer(
+        AsyncProductService(async_repository), host=args.host, port=args.port
+    )
+    print(f"Serving the products on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        async_repository.close()
+        repository.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the product catalog")
+    parser.add_argument(
+        "--repository",
+        choices=REPOSITORY_TYPES,
+        default="mysql",
+        help="where the products are stored, the database of the .env file "
+        "by default",
+    )
+    parser.add_argument(
+        "--json-file", default="products.json", help="file of the json repository"
+    )
+    parser.add_argument(
+        "--binary-file",
+        default="products.bin",
+        help="file of the binary repository",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write the spans of the command to FILE, as JSONL for a .jsonl "
+        "file and in the Chrome trace format else",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser(
+        "import", help="load products from a CSV or JSONL file"
+    )
+    import_parser.add_argument("filename")
+    import_parser.add_argument("--format", choices=FORMATS)
+    import_parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="rows written per commit"
+    )
+    import_parser.add_argument(
+        "--workers",
+        type=int,
+        help="validation processes, the number of CPUs by default, 0 for none",
+    )
+    import_parser.add_argument(
+        "--checkpoint", help="resume file, <filename>.checkpoint by default"
+    )
+    import_parser.add_argument(
+        "--rejects", help="file of the bad rows, <filename>.rejects.jsonl by default"
+    )
+    import_parser.set_defaults(handler=import_command)
+
+    export_parser = subparsers.add_parser(
+        "export", help="write every product to a CSV or JSONL file"
+    )
+    export_parser.add_argument("filename")
+    export_parser.add_argument("--format", choices=FORMATS)
+    export_parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="products read per query"
+    )
+    export_parser.set_defaults(handler=export_command)
+
+    copy_parser = subparsers.add_parser(
+        "copy", help="copy every product to another repository and verify it"
+    )
+    copy_parser.add_argument("--to", choices=REPOSITORY_TYPES, required=True)
+    copy_parser.add_argument(
+        "--to-file", help="file of the target json or binary repository"
+    )
+    copy_parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="products per batch"
+    )
+    copy_parser.set_defaults(handler=copy_command)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="reclaim the space of the deleted products"
+    )
+    compact_parser.set_defaults(handler=compact_command)
+
+    memory_parser = subparsers.add_parser(
+        "memory",
+        help="report the memory the repositories use for synthetic products, "
+        "as JSON",
+    )
+    memory_parser.add_argument("--products", type=int, default=10000)
+    memory_parser.add_argument(
+        "--backends", nargs="+", choices=list(BACKENDS), help="all by default"
+    )
+    memory_parser.add_argument(
+        "--top", type=int, default=10, help="allocation sites per step"
+    )
+    memory_parser.add_argument("--output", help="file of the report, stdout else")
+    memory_parser.set_defaults(handler=memory_command)
+
+    replay_parser = subparsers.add_parser(
+        "replay",
+        help="run the operations of a workload recorded with RECORD_FILE against "
+        "the repository and report their latency",
+    )
+    replay_parser.add_argument("filename")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        help="1 for the recorded pacing, 2 for twice as fast; as fast as "
+        "possible by default",
+    )
+    replay_parser.add_argument(
+        "--concurrency", type=int, default=1, help="threads running the operations"
+    )
+    replay_parser.add_argument("--output", help="file of the JSON report")
+    replay_parser.set_defaults(handler=replay_command)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="serve the products as an HTTP JSON API"
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="MySQL connections running the queries of the requests",
+    )
+    serve_parser.set_defaults(handler=serve_command)
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracer.enable()
+    try:
+        args.handler(args)
+    finally:
+        if args.trace:
+            tracer.write(args.trace)
+
+
+if __name__ == "__main__":
+    main()
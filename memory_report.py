@@ -0,0 +1,205 @@
+"""Memory use of the repositories, measured with tracemalloc
+
+Every backend gets the same synthetic products through add_many, then a
+list(); the file backends are opened again from their file. The report
+holds the memory kept per product, the peak of every step above the
+memory before it and the lines that allocated the most, as JSON.
+"""
+
+import datetime
+import linecache
+import os
+import platform
+import tempfile
+import tracemalloc
+
+from binary_repository import BinaryFileProductRepository
+from models import ClothingProduct, ElectronicProduct, FoodProduct, Product
+from repositories import (
+    DictProductRepository,
+    JsonProductRepository,
+    ListProductRepository,
+)
+
+# name -> function of a directory returning an empty, or reopened, repository
+BACKENDS = {
+    "list": lambda directory: ListProductRepository(),
+    "dict": lambda directory: DictProductRepository(),
+    "compact": lambda directory: DictProductRepository(compact=True),
+    "json": lambda directory: JsonProductRepository(
+        os.path.join(directory, "products.json")
+    ),
+    "binary": lambda directory: BinaryFileProductRepository(
+        os.path.join(directory, "products.bin")
+    ),
+}
+FILE_BACKENDS = ("json", "binary")
+
+# Allocations of the measurement itself
+IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def synthetic_products(count: int) -> list:
+    """Return count products, a quarter of every type"""
+    products = []
+    for number in range(count):
+        common = {
+            "code": str(number),
+            "name": f"Product {number}",
+            "price": round(1 + number % 1000 / 10, 2),
+            "stock": number % 300,
+            "available": number % 10 != 0,
+        }
+        kind = number % 4
+        if kind == 0:
+            products.append(Product(**common))
+        elif kind == 1:
+            products.append(
+                ElectronicProduct(
+                    **common, product_type="electronic", warranty=12 + number % 3 * 12
+                )
+            )
+        elif kind == 2:
+            expiration_date = datetime.date(2030, 1, 1) + datetime.timedelta(
+                days=number % 365
+            )
+            products.append(
+                FoodProduct(
+                    **common,
+                    product_type="food",
+                    expiration_date=expiration_date.isoformat(),
+                )
+            )
+        else:
+            products.append(
+                ClothingProduct(
+                    **common,
+                    product_type="clothing",
+                    size=("S", "M", "L", "XL")[number % 4],
+                    color=("red", "blue", "black")[number % 3],
+                )
+            )
+    return products
+
+
+def top_sites(snapshot, baseline, limit: int) -> list[dict]:
+    """Return the lines that allocated the most memory kept since baseline"""
+    snapshot = snapshot.filter_traces(IGNORED_TRACES)
+    baseline = baseline.filter_traces(IGNORED_TRACES)
+    sites = []
+    for statistic in snapshot.compare_to(baseline, "lineno"):
+        if statistic.size_diff <= 0:
+            continue
+        frame = statistic.traceback[0]
+        sites.append(
+            {
+                "file": os.path.relpath(frame.filename),
+                "line": frame.lineno,
+                "code": linecache.getline(frame.filename, frame.lineno).strip(),
+                "bytes": statistic.size_diff,
+                "blocks": statistic.count_diff,
+            }
+        )
+        if len(sites) == limit:
+            break
+    return sites
+
+
+class _Step:
+    """Measure the peak above the memory at the start, and the allocations
+    still alive at the end"""
+
+    def __init__(self, top: int):
+        self.top = top
+
+    def __enter__(self):
+        self.baseline = tracemalloc.take_snapshot()
+        self.start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        current, peak = tracemalloc.get_traced_memory()
+        self.kept = current - self.start
+        self.peak = peak - self.start
+        self.sites = top_sites(tracemalloc.take_snapshot(), self.baseline, self.top)
+        return False
+
+    def as_dict(self) -> dict:
+        return {"kept_bytes": self.kept, "peak_bytes": self.peak, "top": self.sites}
+
+
+def profile_backend(name: str, products: list, top: int = 10) -> dict:
+    """Return the memory report of one backend"""
+    factory = BACKENDS[name]
+    with tempfile.TemporaryDirectory() as directory:
+        tracemalloc.start()
+        try:
+            with _Step(top) as add_many:
+                repository = factory(directory)
+                repository.add_many(products)
+            with _Step(top) as listing:
+                listed = repository.list()
+            del listed
+            report = {
+                "bytes_per_product": round(add_many.kept / len(products), 1),
+                "add_many": add_many.as_dict(),
+                "list": listing.as_dict(),
+            }
+            if name in FILE_BACKENDS:
+                repository.close()
+                del repository
+                with _Step(top) as opening:
+                    repository = factory(directory)
+                    repository.get(products[0].code)
+                report["open"] = opening.as_dict()
+            if hasattr(repository, "close"):
+                repository.close()
+        finally:
+            tracemalloc.stop()
+    return report
+
+
+def memory_report(count: int, backends=None, top: int = 10) -> dict:
+    products = synthetic_products(count)
+    return {
+        "products": count,
+        "python": platform.python_version(),
+        "backends": {
+            name: profile_backend(name, products, top) for name in backends or BACKENDS
+        },
+    }
+
+
+if __name__ == "__main__":
+    import json
+    import unittest
+
+    class TestMemoryReport(unittest.TestCase):
+        def test_report(self):
+            report = memory_report(200, top=5)
+            self.assertEqual(set(report["backends"]), set(BACKENDS))
+            for name, backend in report["backends"].items():
+                self.assertGreater(backend["bytes_per_product"], 0, name)
+                self.assertGreaterEqual(
+                    backend["add_many"]["peak_bytes"], backend["add_many"]["kept_bytes"]
+                )
+                self.assertLessEqual(len(backend["list"]["top"]), 5)
+                self.assertEqual("open" in backend, name in FILE_BACKENDS)
+            json.dumps(report)
+
+        def test_sites_point_to_the_code(self):
+            backend = profile_backend("json", synthetic_products(200), top=20)
+            files = {site["file"] for site in backend["open"]["top"]}
+            self.assertIn(os.path.relpath(json.decoder.__file__), files)
+            site = backend["list"]["top"][0]
+            self.assertEqual(
+                site["code"],
+                linecache.getline(os.path.abspath(site["file"]), site["line"]).strip(),
+            )
+
+    unittest.main()
@@ -17,6 +17,7 @@ class BaseProduct:
         stock: int = 0,
         available: bool = True,
         product_type: str = "product",
+        version: int = 0,
     ):
         self.__code: str = self.validate_code(code)
         self.__name: str = self.validate_name(name)
@@ -25,6 +26,7 @@ class BaseProduct:
         self.__stock: int = self.validate_stock(stock)
         self.__available: bool = self.validate_available(available)
         self.__type: str = product_type
+        self.__version: int = self.validate_version(version)
 
     def __str__(self):
         return f"{self.code}) Product(code={self.code}), name={self.name}, type={self.type}, stock={self.stock}, price={self.price}"
@@ -64,6 +66,15 @@ class BaseProduct:
     def type(self, value: str):
         self.__type = value
 
+    @property
+    def version(self):
+        """Number of updates the stored product went through, not a field"""
+        return self.__version
+
+    @version.setter
+    def version(self, value: int):
+        self.__version = self.validate_version(value)
+
     @property
     def code(self):
         return self.__code
@@ -172,6 +183,16 @@ class BaseProduct:
             raise ValueError("Available must be a boolean")
         return value
 
+    @staticmethod
+    def validate_version(value: int):
+        try:
+            value = int(value)
+        except (ValueError, TypeError):
+            raise ValueError("Version must be an integer")
+        if value < 0:
+            raise ValueError("Version cannot be negative")
+        return value
+
     def to_dict(self):
         return {
             "code": self.code,
@@ -245,8 +266,15 @@ class FoodProduct(BaseProduct):
 
     @property
     def expiration_date(self):
+        if self.__expiration_date is None:
+            return None
         return self.__expiration_date.strftime("%Y-%m-%d")
 
+    @property
+    def expires_on(self) -> datetime.date | None:
+        """Expiration date as a date object, without formatting it"""
+        return self.__expiration_date
+
     @expiration_date.setter
     def expiration_date(self, value: str | datetime.date):
         self.__expiration_date = self.validate_expiration_date(value)
@@ -261,6 +289,8 @@ class FoodProduct(BaseProduct):
                 value = datetime.datetime.strptime(value, "%Y-%m-%d").date()
             except ValueError:
                 raise ValueError("Invalid date format")
+        elif isinstance(value, datetime.datetime):
+            value = value.date()
         return value
 
     def to_dict(self):
@@ -331,6 +361,29 @@ class ClothingProduct(BaseProduct):
         return ("size", "color")
 
 
+def convert_product_data(data: dict) -> dict:
+    """Convert, in place, the text values typed or read from a file to the
+    types the products expect"""
+    for key, value in data.items():
+        if key == "price":
+            data[key] = float(value)
+        if key == "stock":
+            data[key] = int(value)
+        if key == "available":
+            if value is not None:
+                if isinstance(value, str):
+                    value = value.lower() in ("true", "yes", "1", "si", "sí")
+                    data[key] = value
+            else:
+                data[key] = False
+        if key == "warranty":
+            data[key] = int(value)
+        if key == "expiration_date" and value is not None:
+            # None for the stored products that have no date
+            data[key] = datetime.datetime.strptime(value, "%Y-%m-%d")
+    return data
+
+
 class ProductFactory:
     """Factory class for creating products"""
 
@@ -395,6 +448,13 @@ if __name__ == "__main__":
             with self.assertRaises(ValueError):
                 product.stock = -10
 
+        def test_version(self):
+            product = BaseProduct("123", "Product", 10, version=2)
+            self.assertEqual(product.version, 2)
+            self.assertNotIn("version", product.to_dict())
+            with self.assertRaises(ValueError):
+                product.version = -1
+
         def test_available(self):
             product = BaseProduct("123", "Product", 10)
             self.assertEqual(product.available, True)
@@ -508,6 +568,14 @@ if __name__ == "__main__":
                 },
             )
 
+        def test_convert_product_data_without_expiration_date(self):
+            data = {**FoodProduct("123", "Product", 10).to_dict(), "stock": "5"}
+            data = convert_product_data(data)
+            self.assertEqual(data["stock"], 5)
+            self.assertIsNone(data["expiration_date"])
+            data = convert_product_data({"expiration_date": "2022-12-31"})
+            self.assertEqual(data["expiration_date"], datetime.datetime(2022, 12, 31))
+
     class TestClothingProduct(unittest.TestCase):
         def test_clothing_product(self):
             product = ClothingProduct("123", "Product", 10, size="M", color="blue")
@@ -1,18 +1,178 @@
+import datetime
+import functools
+import itertools
 import json
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:  # Windows, the JSON file can't be shared by processes there
+    fcntl = None
 
 from db.connectors import MySqlConnector
+from events import EventBus, make_change_event
+from indexes import (
+    ExpirationIndex,
+    LowStockIndex,
+    ProductTypeIndex,
+    ReorderThresholds,
+    SearchIndex,
+    to_date_key,
+    tokenize,
+)
+from locks import NullStripedLock, StripedLock
 from loggers import logger
 from models import BaseProduct, ProductFactory
+from row_codec import CompactRowDict, CompactRowList
+from stats import InventoryStats
+from tracing import traced
 
 
 class ProductNotFoundError(Exception):
     pass
 
 
+class VersionConflictError(Exception):
+    """The product was updated by someone else since it was read"""
+
+
+def parse_order_by(order_by: str | None) -> tuple[str, bool] | None:
+    """Return the (field, descending) pair of an order_by like "-price" """
+    if not order_by:
+        return None
+    field = order_by.lstrip("-")
+    if field not in BaseProduct.get_common_field_names():
+        raise ValueError(f"Cannot order by {field}")
+    return field, order_by.startswith("-")
+
+
+def none_last_key(value):
+    """Sort key that groups None values after the rest"""
+    return (True, 0) if value is None else (False, value)
+
+
+def filter_product_data(
+    rows,
+    product_type: str | None = None,
+    available: bool | None = None,
+    price_between: tuple[float, float] | None = None,
+    stock_below: int | None = None,
+    order_by: str | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+) -> list[dict]:
+    """Filter, sort and limit product dictionaries in memory, skipping the
+    first offset matches"""
+    matches = []
+    for row in rows:
+        if product_type is not None and row["product_type"] != product_type:
+            continue
+        if available is not None and bool(row["available"]) != available:
+            continue
+        if price_between is not None and not (
+            price_between[0] <= row["price"] <= price_between[1]
+        ):
+            continue
+        if stock_below is not None and not row["stock"] < stock_below:
+            continue
+        matches.append(row)
+    ordering = parse_order_by(order_by)
+    if ordering:
+        field, descending = ordering
+        matches.sort(key=lambda row: none_last_key(row[field]), reverse=descending)
+    if offset or limit is not None:
+        matches = matches[offset : None if limit is None else offset + limit]
+    return matches
+
+
+# Filters of find() that update_where and delete_where take as criteria
+CRITERIA = ("product_type", "available", "price_between", "stock_below")
+# Fields update_where can change, with the relative changes each one takes
+CHANGEABLE_FIELDS = {
+    "name": (),
+    "description": (),
+    "price": ("+", "*"),
+    "stock": ("+",),
+    "available": (),
+}
+
+
+def check_criteria(criteria: dict) -> dict:
+    unknown = set(criteria) - set(CRITERIA)
+    if unknown:
+        raise ValueError(f"Unknown criteria: {', '.join(sorted(unknown))}")
+    return criteria
+
+
+def parse_changes(changes: dict) -> dict[str, tuple[str | None, object]]:
+    """Validate the changes of update_where and return them as field ->
+    (operator, value), the operator None for a new value
+
+    A field maps to its new value or to an (operator, operand) pair:
+    ("*", 1.05) raises a price by 5%, ("+", -3) takes 3 from the stock.
+    """
+    if not changes:
+        raise ValueError("No changes given")
+    parsed = {}
+    for field, change in changes.items():
+        if field not in CHANGEABLE_FIELDS:
+            raise ValueError(f"Field {field} can't be changed by update_where")
+        if not isinstance(change, (tuple, list)):
+            validate = getattr(BaseProduct, f"validate_{field}")
+            parsed[field] = (None, validate(change))
+            continue
+        operator, operand = change
+        if operator not in CHANGEABLE_FIELDS[field]:
+            raise ValueError(f"Field {field} can't be changed with {operator}")
+        if isinstance(operand, bool) or not isinstance(operand, (int, float)):
+            raise ValueError(f"The change of {field} must be a number")
+        if field == "stock" and not isinstance(operand, int):
+            raise ValueError("The change of stock must be an integer")
+        if operator == "*" and operand < 0:
+            raise ValueError(f"Field {field} can't be multiplied by a negative")
+        parsed[field] = (operator, operand)
+    return parsed
+
+
+def apply_changes(product_data: dict, changes: dict) -> dict:
+    """Return product_data with changes, parsed by parse_changes, applied and
+    validated like the fields of a product; prices are rounded to cents"""
+    new_data = dict(product_data)
+    for field, (operator, value) in changes.items():
+        validate = getattr(BaseProduct, f"validate_{field}")
+        if operator == "+":
+            value = validate(product_data[field]) + value
+        elif operator == "*":
+            value = validate(product_data[field]) * value
+        if operator is not None and field == "price":
+            value = round(value, 2)
+        new_data[field] = validate(value)
+    return new_data
+
+
 class BaseProductRepository(ABC):
-    def __init__(self, storage, *args, **kwargs):
+    event_bus: EventBus | None = None
+    reorder_thresholds: ReorderThresholds | None = None
+    # Called with (code, stock, threshold, low) when a write takes a product
+    # below its reorder threshold, low=True, or back to it, low=False
+    low_stock_listeners: tuple = ()
+
+    def __init__(
+        self,
+        storage,
+        *args,
+        event_bus: EventBus | None = None,
+        reorder_thresholds: ReorderThresholds | None = None,
+        **kwargs,
+    ):
         self.storage = storage
+        self.event_bus = event_bus
+        self.reorder_thresholds = reorder_thresholds
 
     @abstractmethod
     def add(self, product):
@@ -27,62 +187,621 @@ class BaseProductRepository(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def update(self, product: BaseProduct):
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        """Replace the stored product; with expected_version, only if it is
+        still at that version, raising VersionConflictError otherwise"""
         raise NotImplementedError
 
     @abstractmethod
     def delete(self, product_id: int | str):
         raise NotImplementedError
 
+    @traced()
+    def add_many(self, products) -> int:
+        """Add the products, return how many were added; the repositories
+        able to write them together do it in a single write"""
+        added = 0
+        for product in products:
+            self.add(product)
+            added += 1
+        return added
+
+    @traced()
+    def write_batch(self, deletes, inserts, updates):
+        """Apply buffered writes: delete the codes of deletes, then add the
+        products of inserts and update those of updates
+
+        inserts and updates are (product, versions) pairs: the version of
+        the new row, and how many versions the updated row moves forward.
+        The repositories able to write them together do it in a single
+        transaction; here every write is done on its own and moves the
+        version once.
+        """
+        for code in deletes:
+            try:
+                self.delete(code)
+            except (ProductNotFoundError, ValueError):
+                pass
+        for product, _ in inserts:
+            self.add(product)
+        for product, _ in updates:
+            self.update(product)
+
+    @traced()
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        """Change every product matching criteria, the filters of find(),
+        and return how many changed
+
+        changes maps fields to new values or to relative changes, see
+        parse_changes. Every new value is checked before the first write.
+        """
+        changes = parse_changes(changes)
+        rows = filter_product_data(
+            self._iter_product_data(), **check_criteria(criteria)
+        )
+        products = [
+            ProductFactory().create_product(**apply_changes(row, changes))
+            for row in rows
+        ]
+        self.write_batch([], [], [(product, 1) for product in products])
+        return len(products)
+
+    @traced()
+    def delete_where(self, criteria: dict) -> int:
+        """Delete every product matching criteria, the filters of find(), and
+        return how many were deleted"""
+        rows = filter_product_data(
+            self._iter_product_data(), **check_criteria(criteria)
+        )
+        self.write_batch([row["code"] for row in rows], [], [])
+        return len(rows)
+
+    @traced()
+    def adjust_stock(self, product_id: int | str, delta: int):
+        """Add delta, which may be negative, to the stock of a product"""
+        product = self.get(product_id)
+        if product is None:
+            raise ProductNotFoundError(f"Product with code {product_id} not found")
+        product.stock = product.stock + delta
+        self.update(product, expected_version=product.version)
+
+    def iter_batches(self, batch_size: int = 1000):
+        """Yield the stored products in lists of up to batch_size, without
+        building the whole catalog"""
+        rows = self._iter_product_data()
+        while batch := list(islice(rows, batch_size)):
+            yield [ProductFactory().create_product(**row) for row in batch]
+
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        """Return the existing products among the given codes, indexed by code"""
+        products = {}
+        for product_id in product_ids:
+            product = self.get(product_id)
+            if product is not None:
+                products[product.code] = product
+        return products
+
+    @traced()
+    def find(
+        self,
+        product_type: str | None = None,
+        available: bool | None = None,
+        price_between: tuple[float, float] | None = None,
+        stock_below: int | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+    ) -> dict[str, BaseProduct]:
+        """Return the products matching all the given filters, indexed by code;
+        offset skips the first matches, for pages"""
+        rows = filter_product_data(
+            self._iter_product_data(),
+            product_type=product_type,
+            available=available,
+            price_between=price_between,
+            stock_below=stock_below,
+            order_by=order_by,
+            limit=limit,
+            offset=offset,
+        )
+        return {row["code"]: ProductFactory().create_product(**row) for row in rows}
+
+    @traced()
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        """Return the products matching the query by name and description,
+        best matches first"""
+        search_index = SearchIndex()
+        rows = {}
+        for row in self._iter_product_data():
+            search_index.add(row)
+            rows[row["code"]] = row
+        return {
+            code: ProductFactory().create_product(**rows[code])
+            for code, _ in search_index.search(query, limit)
+        }
+
+    def expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        limit: int | None = None,
+    ) -> dict[str, BaseProduct]:
+        """Return the food products expiring between start and end, both
+        included, soonest first"""
+        products = islice(self.iter_expiring_between(start, end), limit)
+        return {product.code: product for product in products}
+
+    def iter_expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        batch_size: int = 1000,
+    ):
+        """Yield the food products expiring between start and end, soonest
+        first, without building the whole result"""
+        expiration_index = ExpirationIndex()
+        rows = {}
+        for row in self._iter_product_data():
+            if row.get("product_type") == "food":
+                expiration_index.add(row)
+                rows[row["code"]] = row
+        for _, code in expiration_index.range(start, end):
+            yield ProductFactory().create_product(**rows[code])
+
+    def inventory_stats(self) -> dict:
+        """Return the total stock, the inventory value and the available and
+        unavailable counts per product type"""
+        stats = InventoryStats()
+        stats.rebuild(self._iter_product_data())
+        return stats.as_dict()
+
+    @traced()
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        """Return the products with less stock than their reorder threshold,
+        lowest stock first"""
+        thresholds = self._thresholds()
+        rows = [row for row in self._iter_product_data() if thresholds.is_low(row)]
+        rows.sort(key=lambda row: (row["stock"], row["code"]))
+        return {
+            row["code"]: ProductFactory().create_product(**row) for row in rows[:limit]
+        }
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        """Set the reorder threshold of a product, of a product type or, with
+        neither, the default one; None removes the one of a product or type"""
+        thresholds = self._thresholds()
+        if code is not None:
+            if threshold is None:
+                thresholds.by_code.pop(str(code), None)
+            else:
+                thresholds.by_code[str(code)] = threshold
+        elif product_type is not None:
+            if threshold is None:
+                thresholds.by_type.pop(product_type, None)
+            else:
+                thresholds.by_type[product_type] = threshold
+        else:
+            thresholds.default = threshold or 0
+
+    def watch_low_stock(self, callback):
+        """Call callback(code, stock, threshold, low) whenever a write takes a
+        product below its reorder threshold or back to it"""
+        self.low_stock_listeners = self.low_stock_listeners + (callback,)
+
+    def _thresholds(self) -> ReorderThresholds:
+        if self.reorder_thresholds is None:
+            self.reorder_thresholds = ReorderThresholds()
+        return self.reorder_thresholds
+
+    def _check_low_stock(self, old_data: dict | None, new_data: dict | None):
+        """Tell the listeners when a write crosses a reorder threshold; adding
+        a product that is already low crosses it, deleting one does not"""
+        if not self.low_stock_listeners or new_data is None:
+            return
+        if old_data is not None and "reorder_threshold" not in new_data:
+            # Rows of the database carry their own threshold, writes keep it
+            new_data = {
+                **new_data,
+                "reorder_threshold": old_data.get("reorder_threshold"),
+            }
+        thresholds = self._thresholds()
+        threshold = thresholds.for_product(new_data)
+        low = new_data["stock"] < threshold
+        if low == (old_data is not None and thresholds.is_low(old_data)):
+            return
+        for callback in self.low_stock_listeners:
+            try:
+                callback(new_data["code"], new_data["stock"], threshold, low)
+            except Exception as ex:
+                logger.error("Error in a low stock listener: %s", ex, exc_info=True)
+
+    def _iter_product_data(self):
+        """Yield the stored products as dictionaries"""
+        return (product.to_dict() for product in self.list().values())
+
+    def _publish_change(self, old_data: dict | None, new_data: dict | None):
+        self._check_low_stock(old_data, new_data)
+        if self.event_bus is None:
+            return
+        event = make_change_event(old_data, new_data)
+        if event is not None:
+            self.event_bus.publish(event)
+
+    def close(self):
+        """Release the files or connections held, none by default"""
+
     @staticmethod
     def get_product_types():
         return BaseProduct.get_product_types()
 
 
-class ListProductRepository(BaseProductRepository):
-    """Simple repository that stores products in a list"""
+class IndexedRepositoryMixin:
+    """Secondary indexes for the repositories that keep products in memory
+
+    Writes report the old and new product dictionaries through
+    _apply_change so every index is updated incrementally and the change
+    is published to the event bus, once the write released its locks.
+
+    In thread safe mode every code maps to one stripe of a StripedLock:
+    reads of a code share it and writes of a code own it. Writers replace
+    the stored dictionaries instead of mutating them, so a snapshot of the
+    storage is a shallow copy that readers share until the next write.
+    """
+
+    def _init_indexes(self, rows=()):
+        self.search_index = SearchIndex()
+        self.expiration_index = ExpirationIndex()
+        self.stats = InventoryStats()
+        self.low_stock_index = LowStockIndex(self._thresholds())
+        self.type_index = ProductTypeIndex()
+        self.indexes = [
+            self.search_index,
+            self.expiration_index,
+            self.stats,
+            self.low_stock_index,
+            self.type_index,
+        ]
+        self._rebuild_indexes(rows)
+
+    def _init_locks(self, thread_safe: bool = False, lock_stripes: int = 16):
+        self.thread_safe = thread_safe
+        if thread_safe:
+            self._locks = StripedLock(lock_stripes)
+            self._index_lock = threading.Lock()
+        else:
+            self._locks = NullStripedLock()
+            self._index_lock = nullcontext()
+        self._versions = itertools.count(1)
+        self._version = 0
+        self._snapshot: tuple[int, list[dict]] | None = None
+        # Changes of the write in progress in a thread, published after it
+        self._publishing = threading.local()
+
+    def _rebuild_indexes(self, rows):
+        rows = list(rows)
+        for index in self.indexes:
+            index.rebuild(rows)
+
+    def _apply_change(self, old_data: dict | None, new_data: dict | None):
+        self._version = next(self._versions)
+        with self._index_lock:
+            for index in self.indexes:
+                if old_data is None:
+                    index.add(new_data)
+                elif new_data is None:
+                    index.remove(old_data)
+                else:
+                    index.update(old_data, new_data)
+        changes = getattr(self._publishing, "changes", None)
+        if changes is None:
+            self._publish_change(old_data, new_data)
+        else:
+            changes.append((old_data, new_data))
+
+    @contextmanager
+    def _publishing_after(self, lock):
+        """Hold lock for a write and publish its changes once it is released,
+        so the subscribers and low stock listeners can read the repository"""
+        if getattr(self._publishing, "changes", None) is not None:
+            # Within another write, which publishes
+            with lock:
+                yield
+            return
+        changes = self._publishing.changes = []
+        try:
+            with lock:
+                yield
+        finally:
+            self._publishing.changes = None
+            for old_data, new_data in changes:
+                self._publish_change(old_data, new_data)
+
+    @staticmethod
+    def _versioned(
+        product: BaseProduct,
+        old_data: dict | None,
+        expected_version: int | None = None,
+    ) -> dict:
+        """Return the dictionary to store for product over old_data, one
+        version later, after checking old_data is at expected_version"""
+        old_version = old_data.get("version", 0) if old_data else None
+        if expected_version is not None and old_version != expected_version:
+            raise VersionConflictError(
+                f"Product with code {product.code} is at version {old_version}, "
+                f"not {expected_version}"
+            )
+        version = 0 if old_version is None else old_version + 1
+        return {**product.to_dict(), "version": version}
+
+    def _copy_storage(self) -> list[dict]:
+        raise NotImplementedError
 
-    def __init__(self, storage: list | None = None, *args, **kwargs):
+    def _get_snapshot(self) -> list[dict]:
+        """Return the stored dictionaries as of the last write"""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == self._version:
+            return snapshot[1]
+        with self._locks.read_all():
+            snapshot = (self._version, self._copy_storage())
+        self._snapshot = snapshot
+        return snapshot[1]
+
+    def _get_product_data_many(self, codes) -> dict[str, dict]:
+        raise NotImplementedError
+
+    def _rows_where(self, criteria: dict) -> list[dict]:
+        """Return the stored rows matching criteria, reading only the rows of
+        the type from the type index when criteria has one; called with
+        every stripe held"""
+        product_type = criteria.get("product_type")
+        if product_type is None:
+            rows = self._copy_storage()
+        else:
+            with self._index_lock:
+                codes = self.type_index.of_type(product_type)
+            rows = [self.storage[code] for code in codes if code in self.storage]
+        return filter_product_data(rows, **criteria)
+
+    def _store_rows(self, rows: list[dict]):
+        """Replace the stored rows of the codes of rows"""
+        raise NotImplementedError
+
+    def _remove_rows(self, rows: list[dict]):
+        raise NotImplementedError
+
+    @traced()
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        """Change the matching products in one pass, holding every stripe so
+        no reader sees part of the change; every new value is checked
+        before the first write"""
+        changes = parse_changes(changes)
+        check_criteria(criteria)
+        with self._publishing_after(self._locks.write_all()):
+            old_rows = self._rows_where(criteria)
+            new_rows = [
+                {**apply_changes(row, changes), "version": row.get("version", 0) + 1}
+                for row in old_rows
+            ]
+            if new_rows:
+                self._store_rows(new_rows)
+            for old_data, new_data in zip(old_rows, new_rows):
+                self._apply_change(old_data, new_data)
+        return len(new_rows)
+
+    @traced()
+    def delete_where(self, criteria: dict) -> int:
+        check_criteria(criteria)
+        with self._publishing_after(self._locks.write_all()):
+            rows = self._rows_where(criteria)
+            if rows:
+                self._remove_rows(rows)
+            for old_data in rows:
+                self._apply_change(old_data, None)
+        return len(rows)
+
+    @traced()
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        product_data = self._get_product_data_many(str(code) for code in product_ids)
+        return {
+            code: self._deserialize_product(data) for code, data in product_data.items()
+        }
+
+    @traced()
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        """Return the products matching the query by name and description,
+        best matches first"""
+        with self._index_lock:
+            codes = [code for code, _ in self.search_index.search(query, limit)]
+        product_data = self._get_product_data_many(codes)
+        return {
+            code: self._deserialize_product(product_data[code])
+            for code in codes
+            if code in product_data
+        }
+
+    def inventory_stats(self) -> dict:
+        with self._index_lock:
+            return self.stats.as_dict()
+
+    @traced()
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        """Return the products with less stock than their reorder threshold,
+        lowest stock first, from the low stock index"""
+        with self._index_lock:
+            codes = [code for _, code in self.low_stock_index.lowest(limit)]
+        product_data = self._get_product_data_many(codes)
+        return {
+            code: self._deserialize_product(product_data[code])
+            for code in codes
+            if code in product_data
+        }
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        """Set a reorder threshold and rebuild the low stock index, without
+        calling the listeners for the products it moves in or out"""
+        with self._locks.read_all():
+            rows = self._copy_storage()
+            with self._index_lock:
+                super().set_reorder_threshold(threshold, code, product_type)
+                self.low_stock_index.rebuild(rows)
+
+    def iter_expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        batch_size: int = 1000,
+    ):
+        """Yield the food products expiring between start and end, soonest
+        first, reading the expiration index one batch at a time"""
+        after = None
+        while True:
+            with self._index_lock:
+                entries = self.expiration_index.range(
+                    start, end, after=after, limit=batch_size
+                )
+            if not entries:
+                return
+            product_data = self._get_product_data_many(code for _, code in entries)
+            for _, code in entries:
+                if code in product_data:
+                    yield self._deserialize_product(product_data[code])
+            after = entries[-1]
+
+
+class ListProductRepository(IndexedRepositoryMixin, BaseProductRepository):
+    """Simple repository that stores products in a list
+
+    With thread_safe=True the whole list is guarded by one read/write lock,
+    positions in a list can't be striped by code. With compact=True the
+    rows are stored as tuples, see CompactRowList.
+    """
+
+    def __init__(
+        self,
+        storage: list | None = None,
+        *args,
+        thread_safe: bool = False,
+        compact: bool = False,
+        **kwargs,
+    ):
         if storage is None:
             storage = []
+        if compact and not isinstance(storage, CompactRowList):
+            storage = CompactRowList(storage)
         super().__init__(storage, *args, **kwargs)
         self.storage: list[dict]
+        self._init_locks(thread_safe, lock_stripes=1)
+        self._init_indexes(self.storage)
 
+    @traced()
     def add(self, product: BaseProduct):
-        self.storage.append(product.to_dict())
+        product_data = self._versioned(product, None)
+        with self._publishing_after(self._locks.for_key(product.code).write()):
+            self.storage.append(product_data)
+            self._apply_change(None, product_data)
+
+    def _iter_codes(self):
+        """Yield the code of every stored row, without decoding compact rows"""
+        if isinstance(self.storage, CompactRowList):
+            return self.storage.codes()
+        return (p["code"] for p in self.storage)
+
+    def _iter_positions(self, product_id: int | str):
+        """Yield the positions of the rows of a code, reading only the codes"""
+        return (
+            position
+            for position, code in enumerate(self._iter_codes())
+            if code == product_id
+        )
 
+    @traced()
     def get(self, product_id: int | str) -> BaseProduct | None:
-        product_data = next((p for p in self.storage if p["code"] == product_id), None)
+        with self._locks.for_key(product_id).read():
+            position = next(self._iter_positions(product_id), None)
+            product_data = None if position is None else self.storage[position]
         if product_data:
             return self._deserialize_product(product_data)
         else:
             return None
 
+    @traced()
     def list(self) -> dict[str, BaseProduct]:
         """Return a dictionary with the products indexed by code"""
-        return {p["code"]: self._deserialize_product(p) for p in self.storage}
-
-    def update(self, product: BaseProduct):
-        product_to_update = self.get(product.code)
-        if product_to_update:
-            for product_dict in self.storage:
-                if product_dict["code"] == product.code:
-                    product_dict["name"] = product.name
-                    product_dict["price"] = product.price
-                    product_dict["description"] = product.description
-                    product_dict["stock"] = product.stock
-                    product_dict["available"] = product.available
-        else:
-            raise ValueError(f"Product with code {product.code} not found")
+        return {
+            p["code"]: self._deserialize_product(p) for p in self._iter_product_data()
+        }
 
+    @traced()
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        with self._publishing_after(self._locks.for_key(product.code).write()):
+            positions = list(self._iter_positions(product.code))
+            if not positions:
+                raise ValueError(f"Product with code {product.code} not found")
+            # Check before writing, so a conflict leaves every copy untouched
+            self._versioned(product, self.storage[positions[0]], expected_version)
+            for position in positions:
+                old_data = self.storage[position]
+                product_data = {
+                    **old_data,
+                    "name": product.name,
+                    "price": product.price,
+                    "description": product.description,
+                    "stock": product.stock,
+                    "available": product.available,
+                    "version": old_data.get("version", 0) + 1,
+                }
+                self.storage[position] = product_data
+                self._apply_change(old_data, product_data)
+
+    @traced()
     def delete(self, product_id: int | str):
-        product_to_delete = self.get(product_id)
-        if product_to_delete:
-            for product in self.storage:
-                if product["code"] == product_id:
-                    self.storage.remove(product)
-        else:
-            raise ValueError(f"Product with code {product_id} not found")
+        with self._publishing_after(self._locks.for_key(product_id).write()):
+            positions = list(self._iter_positions(product_id))
+            if not positions:
+                raise ValueError(f"Product with code {product_id} not found")
+            deleted = [self.storage[position] for position in positions]
+            for position in reversed(positions):
+                del self.storage[position]
+            for product in deleted:
+                self._apply_change(product, None)
+
+    def _copy_storage(self):
+        return list(self.storage)
+
+    def _rows_where(self, criteria: dict):
+        # Rows are found by position, the type index can't help
+        return filter_product_data(self.storage, **criteria)
+
+    def _store_rows(self, rows):
+        new_rows = {row["code"]: row for row in rows}
+        for position, code in enumerate(self._iter_codes()):
+            if code in new_rows:
+                self.storage[position] = new_rows[code]
+
+    def _remove_rows(self, rows):
+        codes = {row["code"] for row in rows}
+        positions = [
+            position
+            for position, code in enumerate(self._iter_codes())
+            if code in codes
+        ]
+        for position in reversed(positions):
+            del self.storage[position]
+
+    def _iter_product_data(self):
+        if self.thread_safe:
+            return iter(self._get_snapshot())
+        return iter(self.storage)
 
     def __str__(self):
         return f"ListProductRepository({self.storage})"
@@ -93,44 +812,94 @@ class ListProductRepository(BaseProductRepository):
     def _deserialize_product(self, product_data: dict):
         return ProductFactory().create_product(**product_data)
 
+    def _get_product_data_many(self, codes) -> dict[str, dict]:
+        codes = set(codes)
+        return {p["code"]: p for p in self._iter_product_data() if p["code"] in codes}
+
 
-class DictProductRepository(BaseProductRepository):
-    """Simple repository that stores products in a dictionary"""
+class DictProductRepository(IndexedRepositoryMixin, BaseProductRepository):
+    """Simple repository that stores products in a dictionary
 
-    def __init__(self, storage: dict | None = None, *args, **kwargs):
+    With thread_safe=True the codes are spread over lock_stripes read/write
+    locks, so threads working on different products rarely wait. With
+    compact=True the rows are stored as tuples, see CompactRowDict.
+    """
+
+    def __init__(
+        self,
+        storage: dict | None = None,
+        *args,
+        thread_safe: bool = False,
+        lock_stripes: int = 16,
+        compact: bool = False,
+        **kwargs,
+    ):
         if storage is None:
             storage = {}
+        if compact and not isinstance(storage, CompactRowDict):
+            storage = CompactRowDict(storage)
         super().__init__(storage, *args, **kwargs)
         self.storage: dict[str, dict]
+        self._init_locks(thread_safe, lock_stripes)
+        self._init_indexes(self.storage.values())
 
+    @traced()
     def add(self, product: BaseProduct):
-        self.storage[product.code] = product.to_dict()
+        with self._publishing_after(self._locks.for_key(product.code).write()):
+            old_data = self.storage.get(product.code)
+            product_data = self._versioned(product, old_data)
+            self.storage[product.code] = product_data
+            self._apply_change(old_data, product_data)
 
+    @traced()
     def get(self, product_id: int | str) -> BaseProduct | None:
-        product_dict = self.storage.get(str(product_id))
+        with self._locks.for_key(str(product_id)).read():
+            product_dict = self.storage.get(str(product_id))
         if product_dict:
             return self._deserialize_product(product_dict)
         else:
             return None
 
+    @traced()
     def list(self) -> dict[str, BaseProduct]:
         """Return a dictionary with the products indexed by code"""
         return {
-            code: self._deserialize_product(product_dict)
-            for code, product_dict in self.storage.items()
+            product_dict["code"]: self._deserialize_product(product_dict)
+            for product_dict in self._iter_product_data()
         }
 
-    def update(self, product: BaseProduct):
-        if product.code in self.storage:
-            self.storage[product.code] = product.to_dict()
-        else:
-            raise ValueError(f"Product with code {product.code} not found")
-
+    @traced()
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        with self._publishing_after(self._locks.for_key(product.code).write()):
+            if product.code not in self.storage:
+                raise ValueError(f"Product with code {product.code} not found")
+            old_data = self.storage[product.code]
+            product_data = self._versioned(product, old_data, expected_version)
+            self.storage[product.code] = product_data
+            self._apply_change(old_data, product_data)
+
+    @traced()
     def delete(self, product_id: int | str):
-        if product_id in self.storage:
-            del self.storage[str(product_id)]
-        else:
-            raise ValueError(f"Product with code {product_id} not found")
+        with self._publishing_after(self._locks.for_key(str(product_id)).write()):
+            if product_id not in self.storage:
+                raise ValueError(f"Product with code {product_id} not found")
+            old_data = self.storage.pop(str(product_id))
+            self._apply_change(old_data, None)
+
+    def _copy_storage(self):
+        return list(self.storage.values())
+
+    def _store_rows(self, rows):
+        self.storage.update((row["code"], row) for row in rows)
+
+    def _remove_rows(self, rows):
+        for row in rows:
+            del self.storage[row["code"]]
+
+    def _iter_product_data(self):
+        if self.thread_safe:
+            return iter(self._get_snapshot())
+        return iter(self.storage.values())
 
     def __str__(self):
         return f"DictProductRepository({self.storage})"
@@ -141,36 +910,150 @@ class DictProductRepository(BaseProductRepository):
     def _deserialize_product(self, product_data: dict):
         return ProductFactory().create_product(**product_data)
 
+    def _get_product_data_many(self, codes) -> dict[str, dict]:
+        return {code: self.storage[code] for code in codes if code in self.storage}
+
+
+class JsonProductRepository(IndexedRepositoryMixin, BaseProductRepository):
+    """Repository that stores products in a JSON file
 
-class JsonProductRepository(BaseProductRepository):
-    """Repository that stores products in a JSON file"""
+    Several processes can share the file: readers hold a shared fcntl lock
+    on "<filename>.lock", writers an exclusive one, and every write goes to
+    a temporary file that atomically replaces the JSON file. The lock file
+    holds a revision bumped by every write, so load() only parses the JSON
+    again when another process changed it. Without fcntl (Windows) there is
+    no lock file, and load() parses the JSON every time. close() releases
+    the lock file.
+    """
 
-    def __init__(self, filename: str):
+    def __init__(
+        self,
+        filename: str,
+        event_bus: EventBus | None = None,
+        reorder_thresholds: ReorderThresholds | None = None,
+    ):
         self.filename = filename
-        self.storage: dict[str, dict] = self.load()
+        self.lock_filename = f"{filename}.lock"
+        self.event_bus = event_bus
+        self.reorder_thresholds = reorder_thresholds
+        self.storage: dict[str, dict] = {}
+        # Revision of the file self.storage was read from, None to re-read it
+        self.revision: int | None = None
+        self._lock_fd: int | None = None
+        self._lock_depth = 0
+        self._thread_lock = threading.RLock()
+        self._init_locks()
+        self._init_indexes()
+        self.storage = self.load()
+
+    def _get_lock_fd(self) -> int | None:
+        if fcntl is None:
+            return None
+        if self._lock_fd is None:
+            try:
+                self._lock_fd = os.open(self.lock_filename, os.O_RDWR | os.O_CREAT)
+            except FileNotFoundError:
+                return None
+        return self._lock_fd
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool = False):
+        """Lock the file for the other processes, reentrant within this one"""
+        with self._thread_lock:
+            fd = None if self._lock_depth else self._get_lock_fd()
+            if fd is not None and fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if fd is not None and fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _read_revision(self) -> int | None:
+        if self._lock_fd is None:
+            return None
+        data = os.pread(self._lock_fd, 32, 0).strip()
+        return int(data) if data else 0
+
+    def _write_revision(self, revision: int):
+        if self._lock_fd is not None:
+            os.ftruncate(self._lock_fd, 0)
+            os.pwrite(self._lock_fd, str(revision).encode(), 0)
 
     def load(self) -> dict:
         """Load products from JSON file, call this to keep the storage up to date"""
-        try:
-            with open(self.filename, "r") as file:
-                self.storage = json.load(file)
+        with self._file_lock():
+            revision = self._read_revision()
+            if revision is not None and revision == self.revision:
                 return self.storage
-        except (json.JSONDecodeError, FileNotFoundError):
-            return {}
+            try:
+                with open(self.filename, "r") as file:
+                    storage = json.load(file)
+            except (json.JSONDecodeError, FileNotFoundError):
+                return {}
+            self.revision = revision
+        if storage != self.storage:
+            # Changed by someone else, the local writes are already indexed
+            self._rebuild_indexes(storage.values())
+        self.storage = storage
+        return self.storage
 
     def save(self):
-        try:
-            with open(self.filename, "w") as file:
-                json.dump(self.storage, file, ensure_ascii=False, indent=4)
-        except FileNotFoundError:
-            raise FileNotFoundError(f"File {self.filename} not found")
-
+        temp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        with self._file_lock(exclusive=True):
+            try:
+                with open(temp_filename, "w") as file:
+                    json.dump(self.storage, file, ensure_ascii=False, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_filename, self.filename)
+            except BaseException as error:
+                # The storage holds changes that are not in the file
+                self.revision = None
+                if os.path.exists(temp_filename):
+                    os.remove(temp_filename)
+                if isinstance(error, FileNotFoundError):
+                    raise FileNotFoundError(f"File {self.filename} not found")
+                raise
+            revision = (self._read_revision() or 0) + 1
+            self._write_revision(revision)
+            self.revision = revision
+
+    def close(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    @traced()
     def add(self, product: BaseProduct):
-        self.load()
-        if product.code not in self.storage:
-            self.storage[product.code] = product.to_dict()
-            self.save()
-
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            if product.code not in self.storage:
+                product_data = self._versioned(product, None)
+                self.storage[product.code] = product_data
+                self.save()
+                self._apply_change(None, product_data)
+
+    @traced()
+    def add_many(self, products) -> int:
+        """Add the products not stored yet, writing the file once"""
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            added = []
+            for product in products:
+                if product.code not in self.storage:
+                    product_data = self._versioned(product, None)
+                    self.storage[product.code] = product_data
+                    added.append(product_data)
+            if added:
+                self.save()
+                for product_data in added:
+                    self._apply_change(None, product_data)
+        return len(added)
+
+    @traced()
     def get(self, product_id: int | str):
         self.load()
         product_data = self.storage.get(str(product_id))
@@ -178,6 +1061,7 @@ class JsonProductRepository(BaseProductRepository):
             return self._deserialize_product(product_data)
         return None
 
+    @traced()
     def list(self):
         self.all_product_data = self.load()
         return {
@@ -185,24 +1069,64 @@ class JsonProductRepository(BaseProductRepository):
             for code, product_data in self.storage.items()
         }
 
-    def update(self, product: BaseProduct):
-        self.load()
-        product_to_update = self.get(product.code)
-        if product_to_update and product.code in self.storage:
-            self.storage[product.code] = product.to_dict()
-            self.save()
-        else:
-            raise ProductNotFoundError(f"Product with code {product.code} not found")
+    @traced()
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        # Under the exclusive lock the check and the write are atomic for
+        # every process sharing the file
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            product_to_update = self.get(product.code)
+            if product_to_update and product.code in self.storage:
+                old_data = self.storage[product.code]
+                product_data = self._versioned(product, old_data, expected_version)
+                self.storage[product.code] = product_data
+                self.save()
+                self._apply_change(old_data, product_data)
+            else:
+                raise ProductNotFoundError(
+                    f"Product with code {product.code} not found"
+                )
 
+    @traced()
     def delete(self, product_id: int | str):
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            product_to_delete = self.get(product_id)
+            if product_to_delete:
+                old_data = self.storage.pop(str(product_id))
+                self.save()
+                self._apply_change(old_data, None)
+                return True
+            else:
+                raise ValueError(f"Product with code {product_id} not found")
+
+    def _iter_product_data(self):
         self.load()
-        product_to_delete = self.get(product_id)
-        if product_to_delete:
-            del self.storage[str(product_id)]
-            self.save()
-            return True
-        else:
-            raise ValueError(f"Product with code {product_id} not found")
+        return iter(self.storage.values())
+
+    def _copy_storage(self):
+        return list(self.storage.values())
+
+    def _store_rows(self, rows):
+        self.storage.update((row["code"], row) for row in rows)
+        self.save()
+
+    def _remove_rows(self, rows):
+        for row in rows:
+            del self.storage[row["code"]]
+        self.save()
+
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        """Change the matching products, writing the file once"""
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            return super().update_where(criteria, changes)
+
+    def delete_where(self, criteria: dict) -> int:
+        """Delete the matching products, writing the file once"""
+        with self._publishing_after(self._file_lock(exclusive=True)):
+            self.load()
+            return super().delete_where(criteria)
 
     def __str__(self):
         return f"JsonProductRepository({self.storage})"
@@ -213,25 +1137,121 @@ class JsonProductRepository(BaseProductRepository):
     def _deserialize_product(self, product_data: dict):
         return ProductFactory().create_product(**product_data)
 
+    def _get_product_data_many(self, codes) -> dict[str, dict]:
+        return {code: self.storage[code] for code in codes if code in self.storage}
+
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        self.load()
+        return super().get_many(product_ids)
+
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        self.load()
+        return super().search(query, limit)
+
+    def iter_expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        batch_size: int = 1000,
+    ):
+        self.load()
+        return super().iter_expiring_between(start, end, batch_size)
+
+    def inventory_stats(self) -> dict:
+        self.load()
+        return super().inventory_stats()
+
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        self.load()
+        return super().low_stock(limit)
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        self.load()
+        super().set_reorder_threshold(threshold, code, product_type)
+
 
 class MySQLProductRepository(BaseProductRepository):
     """Repository that stores products in a MySQL database"""
 
-    def __init__(self, connector: MySqlConnector):
+    def __init__(
+        self,
+        connector: MySqlConnector,
+        stats_reconcile_interval: float = 300,
+        event_bus: EventBus | None = None,
+        reorder_thresholds: ReorderThresholds | None = None,
+    ):
         self.connector = connector
+        self.event_bus = event_bus
+        # The thresholds of the products are in their reorder_threshold
+        # column, these are the ones of the types and the default one
+        self.reorder_thresholds = reorder_thresholds
+        # The aggregates are tracked with deltas once inventory_stats() is
+        # first used, and replaced by a GROUP BY query every interval
+        self.stats: InventoryStats | None = None
+        self.stats_reconcile_interval = stats_reconcile_interval
+        self._stats_reconciled_at = 0.0
 
     def create_tables(self):
         self.connector.create_database("products")
         self.connector.create_tables()
 
-    def add(self, product: BaseProduct):
-        _fields = product.get_common_field_names()
+    @staticmethod
+    @functools.cache
+    def _insert_statements(product_type: str, extra_fields) -> tuple[str, str | None]:
+        """Return the INSERT texts of a product type, built once so every
+        add sends the same statements"""
+        _fields = BaseProduct.get_common_field_names()
+        query = (
+            f"INSERT INTO products ({', '.join(_fields)}) "
+            f"VALUES ({', '.join(['%s' for _ in _fields])})"
+        )
+        _extra_table_name = MySQLProductRepository._get_extra_table_name(product_type)
+        if not _extra_table_name:
+            return query, None
+        extra_query = (
+            f"INSERT INTO {_extra_table_name} (code, {', '.join(extra_fields)}) "
+            f"VALUES (%s, {', '.join(['%s' for _ in extra_fields])})"
+        )
+        return query, extra_query
+
+    @staticmethod
+    @functools.cache
+    def _update_statements(
+        product_type: str, extra_fields, conditional: bool
+    ) -> tuple[str, str | None]:
+        """Return the UPDATE texts of a product type, with conditional only
+        if the row is still at an expected version"""
+        _fields = tuple(
+            field for field in BaseProduct.get_common_field_names() if field != "code"
+        )
+        query = (
+            f"UPDATE products SET {', '.join([f'{field} = %s' for field in _fields])}, "
+            "version = version + 1 WHERE code = %s"
+        )
+        if conditional:
+            query += " AND version = %s"
+        _extra_table_name = MySQLProductRepository._get_extra_table_name(product_type)
+        if not _extra_table_name:
+            return query, None
+        extra_query = (
+            f"UPDATE {_extra_table_name} "
+            f"SET {', '.join([f'{field} = %s' for field in extra_fields])} "
+            "WHERE code = %s"
+        )
+        return query, extra_query
 
+    @traced()
+    def add(self, product: BaseProduct):
+        extra_fields = (
+            product.get_extra_field_names() if product.type != "product" else ()
+        )
+        query, extra_query = self._insert_statements(product.type, extra_fields)
         try:
-            query = f"""
-            INSERT INTO products ({", ".join(_fields)})
-            VALUES ({", ".join(["%s" for _ in _fields])})
-            """.strip()
             query_args = (
                 product.code,
                 product.name,
@@ -242,15 +1262,7 @@ class MySQLProductRepository(BaseProductRepository):
                 product.type,
             )
             self.connector.run_query(query, query_args, commit=False)
-            if product.type != "product":
-                _extra_table_name = (
-                    product.type + "s" if product.type == "electronic" else product.type
-                )
-                extra_fields = product.get_extra_field_names()
-                extra_query = f"""
-                INSERT INTO {_extra_table_name} (code, {", ".join(extra_fields)})
-                VALUES (%s, {", ".join(["%s" for _ in extra_fields])})
-                """.strip()
+            if extra_query:
                 extra_query_args = (
                     product.code,
                     *[getattr(product, field) for field in extra_fields],
@@ -266,10 +1278,196 @@ class MySQLProductRepository(BaseProductRepository):
             raise ex
         else:
             self.connector.commit()
+            product_data = product.to_dict()
+            if self.stats is not None:
+                self.stats.add(product_data)
+            self._publish_change(None, product_data)
         return self.connector.run_query(
             "select code from products where code = %s", (product.code,)
         )
 
+    @traced()
+    def add_many(self, products) -> int:
+        """Insert the products in one transaction, with a multi-row INSERT
+        per table"""
+        products = list(products)
+        if not products:
+            return 0
+        try:
+            self._insert_many(products)
+        except Exception as ex:
+            logger.error("Error adding products: %s", ex, exc_info=True)
+            self.connector.rollback()
+            raise ex
+        else:
+            self.connector.commit()
+            for product in products:
+                product_data = product.to_dict()
+                if self.stats is not None:
+                    self.stats.add(product_data)
+                self._publish_change(None, product_data)
+        return len(products)
+
+    def _insert_many(self, products: list[BaseProduct], versions=None):
+        """INSERT the products, without committing, with a multi-row INSERT
+        per table; versions, when given, are those of the new rows"""
+        _fields = BaseProduct.get_common_field_names() + ("version",)
+        products_by_type: dict[str, list[BaseProduct]] = {}
+        for product in products:
+            products_by_type.setdefault(product.type, []).append(product)
+        if versions is None:
+            versions = [0] * len(products)
+        self.connector.run_many(
+            f"INSERT INTO products ({', '.join(_fields)}) "
+            f"VALUES ({', '.join(['%s' for _ in _fields])})",
+            [
+                (
+                    product.code,
+                    product.name,
+                    product.price,
+                    product.description,
+                    product.stock,
+                    product.available,
+                    product.type,
+                    version,
+                )
+                for product, version in zip(products, versions)
+            ],
+            commit=False,
+        )
+        for product_type, typed_products in products_by_type.items():
+            _extra_table_name = self._get_extra_table_name(product_type)
+            if not _extra_table_name:
+                continue
+            extra_fields = typed_products[0].get_extra_field_names()
+            self.connector.run_many(
+                f"INSERT INTO {_extra_table_name} "
+                f"(code, {', '.join(extra_fields)}) "
+                f"VALUES (%s, {', '.join(['%s' for _ in extra_fields])})",
+                [
+                    (
+                        product.code,
+                        *[getattr(product, field) for field in extra_fields],
+                    )
+                    for product in typed_products
+                ],
+                commit=False,
+            )
+
+    def _update_many(self, updates: list[tuple[BaseProduct, int]]):
+        """UPDATE the products, without committing, moving every version
+        forward by the given number"""
+        _fields = tuple(
+            field for field in BaseProduct.get_common_field_names() if field != "code"
+        )
+        self.connector.run_many(
+            f"UPDATE products SET {', '.join([f'{field} = %s' for field in _fields])}, "
+            "version = version + %s WHERE code = %s",
+            [
+                (
+                    product.name,
+                    product.price,
+                    product.description,
+                    product.stock,
+                    product.available,
+                    product.type,
+                    versions,
+                    product.code,
+                )
+                for product, versions in updates
+            ],
+            commit=False,
+        )
+        products_by_type: dict[str, list[BaseProduct]] = {}
+        for product, _ in updates:
+            products_by_type.setdefault(product.type, []).append(product)
+        for product_type, typed_products in products_by_type.items():
+            _extra_table_name = self._get_extra_table_name(product_type)
+            if not _extra_table_name:
+                continue
+            extra_fields = typed_products[0].get_extra_field_names()
+            self.connector.run_many(
+                f"UPDATE {_extra_table_name} "
+                f"SET {', '.join([f'{field} = %s' for field in extra_fields])} "
+                "WHERE code = %s",
+                [
+                    (
+                        *[getattr(product, field) for field in extra_fields],
+                        product.code,
+                    )
+                    for product in typed_products
+                ],
+                commit=False,
+            )
+
+    @traced()
+    def write_batch(self, deletes, inserts, updates, chunk_size: int = 1000):
+        """Apply the writes in one transaction: a DELETE per chunk of codes,
+        then a multi-row INSERT and a batched UPDATE per table"""
+        deletes = [str(code) for code in deletes]
+        inserts = list(inserts)
+        updates = list(updates)
+        changed_codes = deletes + [product.code for product, _ in updates]
+        try:
+            old_data = self._get_old_rows_by_code(changed_codes, chunk_size)
+            for start in range(0, len(deletes), chunk_size):
+                chunk = deletes[start : start + chunk_size]
+                self.connector.run_query(
+                    "DELETE FROM products "
+                    f"WHERE code IN ({', '.join(['%s' for _ in chunk])})",
+                    tuple(chunk),
+                    commit=False,
+                )
+            if inserts:
+                self._insert_many(
+                    [product for product, _ in inserts],
+                    [version for _, version in inserts],
+                )
+            if updates:
+                self._update_many(updates)
+        except Exception as ex:
+            logger.error("Error writing a batch: %s", ex, exc_info=True)
+            self.connector.rollback()
+            raise ex
+        else:
+            self.connector.commit()
+            for code in deletes:
+                if code in old_data:
+                    if self.stats is not None:
+                        self.stats.remove(old_data[code])
+                    self._publish_change(old_data[code], None)
+            for product, _ in inserts:
+                product_data = product.to_dict()
+                if self.stats is not None:
+                    self.stats.add(product_data)
+                self._publish_change(None, product_data)
+            for product, _ in updates:
+                product_data = product.to_dict()
+                if product.code in old_data:
+                    if self.stats is not None:
+                        self.stats.update(old_data[product.code], product_data)
+                    self._publish_change(old_data[product.code], product_data)
+
+    def iter_batches(self, batch_size: int = 1000):
+        """Yield the products in code order, reading batch_size rows per query"""
+        after = None
+        while True:
+            if after is None:
+                product_data = self.connector.run_query(
+                    "SELECT * FROM products ORDER BY code LIMIT %s", (batch_size,)
+                )
+            else:
+                product_data = self.connector.run_query(
+                    "SELECT * FROM products WHERE code > %s ORDER BY code LIMIT %s",
+                    (after, batch_size),
+                )
+            if not product_data:
+                return
+            after = product_data[-1]["code"]
+            self._attach_extra_data(product_data)
+            yield [self._deserialize_product(p) for p in product_data]
+
+    @traced()
     def get(self, product_id: int | str):
         product_data = self.connector.run_query(
             "SELECT * FROM products WHERE code = %s", (str(product_id),)
@@ -288,38 +1486,213 @@ class MySQLProductRepository(BaseProductRepository):
 
     def _deserialize_product(self, product_data: dict):
         product_data["available"] = bool(product_data["available"])
+        product_data.pop("reorder_threshold", None)
         return ProductFactory().create_product(**product_data)
 
     def _serialize_product(self, product: BaseProduct):
         return product.to_dict()
 
-    def list(self):
-        product_data = self.connector.run_query("SELECT * FROM products")
+    @staticmethod
+    def _get_extra_table_name(product_type: str) -> str | None:
+        if product_type == "product":
+            return None
+        return product_type + "s" if product_type == "electronic" else product_type
+
+    def _attach_extra_data(
+        self, product_data: list[dict], chunk_size: int = 1000, commit: bool = True
+    ):
+        """Merge the rows of the extra tables, one query per table and chunk;
+        commit=False reads them inside the transaction in progress"""
+        codes_by_table: dict[str, list[str]] = {}
         for product in product_data:
-            product_type = product.get("product_type", "product")
-            _extra_table = (
-                None
-                if product_type == "product"
-                else (
-                    product_type + "s" if product_type == "electronic" else product_type
-                )
+            _extra_table = self._get_extra_table_name(
+                product.get("product_type", "product")
             )
             if _extra_table:
-                extra_product_data = self.connector.run_query(
-                    f"SELECT * FROM {_extra_table} WHERE code = %s", (product["code"],)
+                codes_by_table.setdefault(_extra_table, []).append(product["code"])
+        extra_rows = {}
+        for _extra_table, codes in codes_by_table.items():
+            for start in range(0, len(codes), chunk_size):
+                chunk = codes[start : start + chunk_size]
+                rows = self.connector.run_query(
+                    f"SELECT * FROM {_extra_table} "
+                    f"WHERE code IN ({', '.join(['%s' for _ in chunk])})",
+                    tuple(chunk),
+                    commit=commit,
                 )
-                product.update(extra_product_data[0])
+                for row in rows or []:
+                    extra_rows[row["code"]] = row
+        for product in product_data:
+            if product["code"] in extra_rows:
+                product.update(extra_rows[product["code"]])
+        return product_data
+
+    @traced()
+    def get_many(self, product_ids, chunk_size: int = 1000) -> dict[str, BaseProduct]:
+        codes = [str(code) for code in product_ids]
+        product_data = []
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start : start + chunk_size]
+            product_data.extend(
+                self.connector.run_query(
+                    "SELECT * FROM products "
+                    f"WHERE code IN ({', '.join(['%s' for _ in chunk])})",
+                    tuple(chunk),
+                )
+                or []
+            )
+        self._attach_extra_data(product_data)
+        return {p["code"]: self._deserialize_product(p) for p in product_data}
+
+    @traced()
+    def list(self):
+        product_data = self.connector.run_query("SELECT * FROM products") or []
+        self._attach_extra_data(product_data)
+        return {p["code"]: self._deserialize_product(p) for p in product_data}
+
+    @traced()
+    def find(
+        self,
+        product_type: str | None = None,
+        available: bool | None = None,
+        price_between: tuple[float, float] | None = None,
+        stock_below: int | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+    ) -> dict[str, BaseProduct]:
+        """Filter, sort and limit in SQL so the indexes can be used"""
+        where, query_args = self._where_clause(
+            product_type=product_type,
+            available=available,
+            price_between=price_between,
+            stock_below=stock_below,
+        )
+        query = "SELECT * FROM products" + where
+        ordering = parse_order_by(order_by)
+        if ordering:
+            field, descending = ordering
+            query += f" ORDER BY {field} {'DESC' if descending else 'ASC'}"
+        if limit is not None or offset:
+            # MySQL has no OFFSET without a LIMIT, the largest one stands for none
+            query += " LIMIT %s"
+            query_args.append(int(limit) if limit is not None else 2**64 - 1)
+        if offset:
+            query += " OFFSET %s"
+            query_args.append(int(offset))
+        product_data = self.connector.run_query(query, tuple(query_args)) or []
+        self._attach_extra_data(product_data)
+        return {p["code"]: self._deserialize_product(p) for p in product_data}
+
+    @staticmethod
+    def _where_clause(
+        product_type: str | None = None,
+        available: bool | None = None,
+        price_between: tuple[float, float] | None = None,
+        stock_below: int | None = None,
+    ) -> tuple:
+        """Return the WHERE clause of the filters of find(), empty without
+        any, and its arguments"""
+        conditions = []
+        query_args = []
+        if product_type is not None:
+            conditions.append("product_type = %s")
+            query_args.append(product_type)
+        if available is not None:
+            conditions.append("available = %s")
+            query_args.append(available)
+        if price_between is not None:
+            conditions.append("price BETWEEN %s AND %s")
+            query_args.extend(price_between)
+        if stock_below is not None:
+            conditions.append("stock < %s")
+            query_args.append(stock_below)
+        if not conditions:
+            return "", query_args
+        return " WHERE " + " AND ".join(conditions), query_args
+
+    @traced()
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        """Rank the products with the FULLTEXT index on name and description"""
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+        # Every token is required and matches as a prefix, like the in-memory index
+        boolean_query = " ".join(f"+{token}*" for token in tokens)
+        sql = (
+            "SELECT *, MATCH (name, description) AGAINST (%s IN BOOLEAN MODE) AS score "
+            "FROM products "
+            "WHERE MATCH (name, description) AGAINST (%s IN BOOLEAN MODE) "
+            "ORDER BY score DESC, code"
+        )
+        query_args = [boolean_query, boolean_query]
+        if limit is not None:
+            sql += " LIMIT %s"
+            query_args.append(int(limit))
+        product_data = self.connector.run_query(sql, tuple(query_args)) or []
+        for product in product_data:
+            product.pop("score", None)
+        self._attach_extra_data(product_data)
         return {p["code"]: self._deserialize_product(p) for p in product_data}
 
-    def update(self, product: BaseProduct):
-        _fields = product.get_common_field_names()
-        _fields = tuple([field for field in _fields if field != "code"])
+    def _select_expiring(self, start, end, after=None, limit=None):
+        """Read food rows by expiration date through idx_food_expiration_date"""
+        query = (
+            "SELECT products.*, food.expiration_date FROM food "
+            "JOIN products ON products.code = food.code "
+            "WHERE food.expiration_date BETWEEN %s AND %s"
+        )
+        query_args = [to_date_key(start), to_date_key(end)]
+        if after is not None:
+            # Keyset pagination: continue right after the last row read
+            query += (
+                " AND (food.expiration_date > %s"
+                " OR (food.expiration_date = %s AND food.code > %s))"
+            )
+            query_args.extend((after[0], after[0], after[1]))
+        query += " ORDER BY food.expiration_date, food.code"
+        if limit is not None:
+            query += " LIMIT %s"
+            query_args.append(int(limit))
+        return self.connector.run_query(query, tuple(query_args)) or []
+
+    def expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        limit: int | None = None,
+    ) -> dict[str, BaseProduct]:
+        product_data = self._select_expiring(start, end, limit=limit)
+        return {p["code"]: self._deserialize_product(p) for p in product_data}
+
+    def iter_expiring_between(
+        self,
+        start: str | datetime.date,
+        end: str | datetime.date,
+        batch_size: int = 1000,
+    ):
+        after = None
+        while True:
+            product_data = self._select_expiring(
+                start, end, after=after, limit=batch_size
+            )
+            if not product_data:
+                return
+            last_row = product_data[-1]
+            after = (to_date_key(last_row["expiration_date"]), last_row["code"])
+            for product in product_data:
+                yield self._deserialize_product(product)
+
+    @traced()
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        extra_fields = (
+            product.get_extra_field_names() if product.type != "product" else ()
+        )
+        query, extra_query = self._update_statements(
+            product.type, extra_fields, expected_version is not None
+        )
+        old_data = self._get_old_data(product.code)
         try:
-            query = f"""
-            UPDATE products
-            SET {", ".join([f"{field} = %s" for field in _fields])}
-            WHERE code = %s
-            """.strip()
             query_args = (
                 product.name,
                 product.price,
@@ -329,21 +1702,16 @@ class MySQLProductRepository(BaseProductRepository):
                 product.type,
                 product.code,
             )
-            self.connector.run_query(
+            if expected_version is not None:
+                query_args += (expected_version,)
+            updated_rows = self.connector.run_query(
                 query,
                 query_args,
                 commit=False,
             )
-            if product.type != "product":
-                _extra_table_name = (
-                    product.type + "s" if product.type == "electronic" else product.type
-                )
-                extra_fields = product.get_extra_field_names()
-                extra_query = f"""
-                UPDATE {_extra_table_name}
-                SET {", ".join([f"{field} = %s" for field in extra_fields])}
-                WHERE code = %s
-                """.strip()
+            if expected_version is not None and not updated_rows:
+                self._raise_version_conflict(product.code, expected_version)
+            if extra_query:
                 extra_query_args = (
                     *[getattr(product, field) for field in extra_fields],
                     product.code,
@@ -353,21 +1721,56 @@ class MySQLProductRepository(BaseProductRepository):
                     extra_query_args,
                     commit=False,
                 )
+        except (ProductNotFoundError, VersionConflictError):
+            self.connector.rollback()
+            raise
         except Exception as ex:
             logger.error("Error updating product: %s", ex, exc_info=True)
             self.connector.rollback()
             raise ex
         else:
             self.connector.commit()
+            product_data = product.to_dict()
+            if old_data and self.stats is not None:
+                self.stats.update(old_data, product_data)
+            if old_data:
+                self._publish_change(old_data, product_data)
         return self.connector.run_query(
             "select code from products where code = %s", (product.code,)
         )
 
+    @traced()
+    def adjust_stock(self, product_id: int | str, delta: int):
+        """Move the stock in a single UPDATE, which can't make it negative"""
+        old_data = self._get_old_data(product_id)
+        updated_rows = self.connector.run_query(
+            "UPDATE products SET stock = stock + %s, version = version + 1 "
+            "WHERE code = %s AND stock + %s >= 0",
+            (delta, str(product_id), delta),
+        )
+        if not updated_rows:
+            if self.connector.run_query(
+                "SELECT code FROM products WHERE code = %s", (str(product_id),)
+            ):
+                raise ValueError("Stock cannot be negative")
+            raise ProductNotFoundError(f"Product with code {product_id} not found")
+        if old_data:
+            product_data = {**old_data, "stock": old_data["stock"] + delta}
+            if self.stats is not None:
+                self.stats.update(old_data, product_data)
+            self._publish_change(old_data, product_data)
+
+    @traced()
     def delete(self, product_id: int | str):
         query = "DELETE FROM products WHERE code = %s"
+        old_data = self._get_old_data(product_id)
         try:
             affected_rows = self.connector.run_query(query, (str(product_id),))
             if affected_rows:
+                if old_data and self.stats is not None:
+                    self.stats.remove(old_data)
+                if old_data:
+                    self._publish_change(old_data, None)
                 return affected_rows
             raise ProductNotFoundError(f"Product with code {product_id} not found")
         except ProductNotFoundError:
@@ -376,6 +1779,260 @@ class MySQLProductRepository(BaseProductRepository):
             logger.error("Error deleting product: %s", ex, exc_info=True)
             raise ValueError(f"Product with code {product_id} not found")
 
+    @traced()
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        """Change the matching products with a single UPDATE, the relative
+        changes computed by the server; a change that would leave a stock
+        or price negative changes nothing"""
+        changes = parse_changes(changes)
+        where, where_args = self._where_clause(**check_criteria(criteria))
+        assignments = []
+        set_args = []
+        negative_checks = []
+        for field, (operator, value) in changes.items():
+            if operator is None:
+                assignments.append(f"{field} = %s")
+            elif operator == "*":
+                assignments.append(f"{field} = ROUND({field} * %s, 2)")
+            else:
+                assignments.append(f"{field} = {field} + %s")
+                if value < 0:
+                    negative_checks.append((field, value))
+            set_args.append(value)
+        try:
+            old_rows = self._get_old_rows(where, where_args)
+            if negative_checks and old_rows is None:
+                self._lock_rows(where, where_args)
+            # The rows are locked: no adjust_stock can lower them meanwhile
+            for field, value in negative_checks:
+                self._check_not_negative(field, value, where, where_args)
+            updated_rows = self.connector.run_query(
+                f"UPDATE products SET {', '.join(assignments)}, "
+                f"version = version + 1{where}",
+                tuple(set_args + where_args),
+                commit=False,
+            )
+        except ValueError:
+            self.connector.rollback()
+            raise
+        except Exception as ex:
+            logger.error("Error updating products: %s", ex, exc_info=True)
+            self.connector.rollback()
+            raise ex
+        else:
+            self.connector.commit()
+        self._invalidate_stats()
+        for old_data in old_rows or []:
+            self._publish_change(old_data, apply_changes(old_data, changes))
+        return updated_rows or 0
+
+    @traced()
+    def delete_where(self, criteria: dict) -> int:
+        """Delete the matching products with a single DELETE, the rows of the
+        extra tables go with them through their foreign keys"""
+        where, where_args = self._where_clause(**check_criteria(criteria))
+        try:
+            old_rows = self._get_old_rows(where, where_args)
+            deleted_rows = self.connector.run_query(
+                f"DELETE FROM products{where}", tuple(where_args), commit=False
+            )
+        except Exception as ex:
+            logger.error("Error deleting products: %s", ex, exc_info=True)
+            self.connector.rollback()
+            raise ex
+        else:
+            self.connector.commit()
+        self._invalidate_stats()
+        for old_data in old_rows or []:
+            self._publish_change(old_data, None)
+        return deleted_rows or 0
+
+    def _get_old_rows(self, where: str, where_args):
+        """Return the rows a bulk write changes, locked until its commit, when
+        the event bus or the low stock listeners need them; every statement
+        runs on the connection of the transaction"""
+        if self.event_bus is None and not self.low_stock_listeners:
+            return None
+        rows = (
+            self.connector.run_query(
+                f"SELECT * FROM products{where} FOR UPDATE",
+                tuple(where_args),
+                commit=False,
+            )
+            or []
+        )
+        self._attach_extra_data(rows, commit=False)
+        old_rows = []
+        for row in rows:
+            threshold = row.get("reorder_threshold")
+            product_data = self._deserialize_product(row).to_dict()
+            if self.low_stock_listeners:
+                product_data["reorder_threshold"] = threshold
+            old_rows.append(product_data)
+        return old_rows
+
+    def _get_old_rows_by_code(self, codes, chunk_size: int = 1000):
+        """Return the rows of codes a batch write replaces, by code, locked
+        until its commit, when the event bus, the aggregates or the low
+        stock listeners need them; one query per chunk of codes"""
+        if (
+            self.event_bus is None
+            and self.stats is None
+            and not self.low_stock_listeners
+        ):
+            return {}
+        old_rows = {}
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start : start + chunk_size]
+            where = f" WHERE code IN ({', '.join(['%s' for _ in chunk])})"
+            rows = self._get_old_rows(where, chunk)
+            if rows is None:
+                # Only the aggregated columns, for the aggregates
+                rows = (
+                    self.connector.run_query(
+                        "SELECT code, product_type, available, price, stock "
+                        f"FROM products{where} FOR UPDATE",
+                        tuple(chunk),
+                        commit=False,
+                    )
+                    or []
+                )
+            for row in rows:
+                old_rows[row["code"]] = row
+        return old_rows
+
+    def _lock_rows(self, where: str, where_args):
+        """Lock the rows a bulk write changes until its commit"""
+        self.connector.run_query(
+            f"SELECT code FROM products{where} FOR UPDATE",
+            tuple(where_args),
+            commit=False,
+        )
+
+    def _check_not_negative(self, field: str, delta, where: str, where_args):
+        """Raise ValueError if adding delta to field of a matching row would
+        make it negative"""
+        condition = f"{field} + %s < 0"
+        where = f"{where} AND {condition}" if where else f" WHERE {condition}"
+        rows = self.connector.run_query(
+            f"SELECT code FROM products{where} LIMIT 1",
+            tuple(where_args) + (delta,),
+            commit=False,
+        )
+        if rows:
+            raise ValueError(f"{field.capitalize()} cannot be negative")
+
+    def _invalidate_stats(self):
+        """Have the next inventory_stats() recompute the aggregates, after a
+        bulk write whose rows were not read"""
+        self._stats_reconciled_at = float("-inf")
+
+    def _raise_version_conflict(self, product_id: int | str, expected_version: int):
+        """Explain why a conditional UPDATE changed no row"""
+        rows = self.connector.run_query(
+            "SELECT version FROM products WHERE code = %s", (str(product_id),)
+        )
+        if not rows:
+            raise ProductNotFoundError(f"Product with code {product_id} not found")
+        raise VersionConflictError(
+            f"Product with code {product_id} is at version {rows[0]['version']}, "
+            f"not {expected_version}"
+        )
+
+    def _get_old_data(self, product_id: int | str) -> dict | None:
+        """Return the stored row a write replaces, when the event bus, the
+        aggregates or the low stock listeners need it; only the aggregated
+        columns and the reorder threshold for the latter two"""
+        if self.event_bus is not None:
+            product = self.get(product_id)
+            if product is None or not self.low_stock_listeners:
+                return product.to_dict() if product else None
+            rows = self.connector.run_query(
+                "SELECT reorder_threshold FROM products WHERE code = %s",
+                (str(product_id),),
+            )
+            return {**product.to_dict(), **(rows[0] if rows else {})}
+        if self.stats is None and not self.low_stock_listeners:
+            return None
+        rows = self.connector.run_query(
+            "SELECT code, product_type, available, price, stock, reorder_threshold "
+            "FROM products WHERE code = %s",
+            (str(product_id),),
+        )
+        return rows[0] if rows else None
+
+    def reconcile_stats(self):
+        """Recompute the aggregates with a single GROUP BY query"""
+        rows = self.connector.run_query(
+            "SELECT product_type, available, COUNT(*) AS products, "
+            "SUM(stock) AS stock, SUM(price * stock) AS inventory_value "
+            "FROM products GROUP BY product_type, available"
+        )
+        if rows is None:
+            return
+        if self.stats is None:
+            self.stats = InventoryStats()
+        self.stats.load_totals(rows)
+        self._stats_reconciled_at = time.monotonic()
+
+    def inventory_stats(self) -> dict:
+        if (
+            self.stats is None
+            or time.monotonic() - self._stats_reconciled_at
+            >= self.stats_reconcile_interval
+        ):
+            self.reconcile_stats()
+        return self.stats.as_dict() if self.stats is not None else {}
+
+    @traced()
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        """Read the low products in stock order from idx_products_stock,
+        bounded by the highest threshold so only low stock rows are read"""
+        thresholds = self._thresholds()
+        rows = self.connector.run_query(
+            "SELECT MAX(reorder_threshold) AS threshold FROM products"
+        )
+        highest = max(
+            [thresholds.default, *thresholds.by_type.values()]
+            + [row["threshold"] for row in rows or [] if row["threshold"] is not None]
+        )
+        query_args = [highest]
+        if thresholds.by_type:
+            cases = " ".join("WHEN %s THEN %s" for _ in thresholds.by_type)
+            fallback = f"CASE product_type {cases} ELSE %s END"
+            for product_type, threshold in thresholds.by_type.items():
+                query_args.extend((product_type, threshold))
+        else:
+            fallback = "%s"
+        query_args.append(thresholds.default)
+        query = (
+            "SELECT * FROM products WHERE stock < %s "
+            f"AND stock < COALESCE(reorder_threshold, {fallback}) "
+            "ORDER BY stock, code"
+        )
+        if limit is not None:
+            query += " LIMIT %s"
+            query_args.append(int(limit))
+        product_data = self.connector.run_query(query, tuple(query_args)) or []
+        self._attach_extra_data(product_data)
+        return {p["code"]: self._deserialize_product(p) for p in product_data}
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        """Keep the threshold of a product in its row, those of the types and
+        the default one in reorder_thresholds"""
+        if code is None:
+            super().set_reorder_threshold(threshold, product_type=product_type)
+            return
+        self.connector.run_query(
+            "UPDATE products SET reorder_threshold = %s WHERE code = %s",
+            (threshold, str(code)),
+        )
+
     def __str__(self):
         return "MySQLProductRepository()"
 
@@ -389,15 +2046,24 @@ class RepositoryFactory:
             return DictProductRepository(*args, **kwargs)
         elif repository_type == "json":
             return JsonProductRepository(*args, **kwargs)
+        elif repository_type == "binary":
+            # Imported here, the module builds on this one
+            from binary_repository import BinaryFileProductRepository
+
+            return BinaryFileProductRepository(*args, **kwargs)
         else:
             raise ValueError(f"Unknown repository type: {repository_type}")
 
 
 if __name__ == "__main__":
+    import multiprocessing
+    import tempfile
+    import threading
     import unittest
     from unittest import mock
 
-    from models import Product
+    from events import ProductCreated, ProductDeleted, ProductUpdated
+    from models import FoodProduct, Product
 
     class TestListProductRepository(unittest.TestCase):
         def setUp(self):
@@ -430,6 +2096,19 @@ if __name__ == "__main__":
             with self.assertRaises(ValueError):
                 self.repository.delete("2")
 
+        def test_update_where_and_delete_where(self):
+            repository = ListProductRepository(compact=True)
+            for code in "123":
+                repository.add(Product(code, "Pen", 1, stock=int(code)))
+            self.assertEqual(
+                repository.update_where({"stock_below": 3}, {"price": 2}), 2
+            )
+            self.assertEqual(
+                [product.price for product in repository.list().values()], [2, 2, 1]
+            )
+            self.assertEqual(repository.delete_where({"price_between": (2, 2)}), 2)
+            self.assertEqual(list(repository.list()), ["3"])
+
     class TestDictProductRepository(unittest.TestCase):
         def setUp(self):
             self.product = Product("1", "Product", 10)
@@ -461,44 +2140,797 @@ if __name__ == "__main__":
             with self.assertRaises(ValueError):
                 self.repository.delete("2")
 
+        def test_adjust_stock(self):
+            self.repository.adjust_stock("1", 4)
+            self.repository.adjust_stock("1", -1)
+            self.assertEqual(self.repository.get("1").stock, 3)
+            self.assertEqual(self.repository.get("1").version, 2)
+            with self.assertRaises(ValueError):
+                self.repository.adjust_stock("1", -4)
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.adjust_stock("2", 1)
+
+        def test_find_products(self):
+            self.repository.add(Product("2", "Cheap", 5, stock=3))
+            self.repository.add(Product("3", "Expensive", 50, stock=30))
+            found = self.repository.find(price_between=(5, 10), order_by="-price")
+            self.assertEqual(list(found), ["1", "2"])
+            found = self.repository.find(stock_below=10, order_by="stock", limit=1)
+            self.assertEqual(list(found), ["1"])
+            found = self.repository.find(order_by="price", offset=1, limit=1)
+            self.assertEqual(list(found), ["1"])
+            self.assertEqual(list(self.repository.find(offset=2)), ["3"])
+            with self.assertRaises(ValueError):
+                self.repository.find(order_by="warranty")
+
+        def test_search_products(self):
+            self.repository.add(Product("2", "Café molido", 5, "Tostado oscuro"))
+            self.repository.add(Product("3", "Cafetera", 50, "Para café molido"))
+            self.assertEqual(list(self.repository.search("cafe molido")), ["2", "3"])
+            self.assertEqual(list(self.repository.search("caf", limit=1)), ["3"])
+            self.repository.delete("3")
+            self.assertEqual(list(self.repository.search("caf")), ["2"])
+            self.repository.update(Product("2", "Té verde", 5))
+            self.assertEqual(self.repository.search("cafe"), {})
+            self.assertEqual(list(self.repository.search("te")), ["2"])
+
+        def test_expiring_between(self):
+            for code, expiration_date in (
+                ("2", "2030-01-20"),
+                ("3", "2030-01-05"),
+                ("4", "2030-03-01"),
+                ("5", None),
+            ):
+                self.repository.add(
+                    FoodProduct(
+                        code,
+                        "Food",
+                        1,
+                        product_type="food",
+                        expiration_date=expiration_date,
+                    )
+                )
+            expiring = self.repository.expiring_between("2030-01-01", "2030-01-31")
+            self.assertEqual(list(expiring), ["3", "2"])
+            self.repository.update(
+                FoodProduct(
+                    "4", "Food", 1, product_type="food", expiration_date="2030-01-10"
+                )
+            )
+            expiring = self.repository.iter_expiring_between(
+                datetime.date(2030, 1, 5), datetime.date(2030, 1, 31), batch_size=1
+            )
+            self.assertEqual([p.code for p in expiring], ["3", "4", "2"])
+
+        def test_inventory_stats(self):
+            self.repository.add(
+                Product("2", "Pen", 1.1, stock=3, product_type="product")
+            )
+            self.repository.update(Product("1", "Product", 10, stock=2))
+            self.repository.delete("2")
+            self.repository.add(Product("3", "Out", 0.1, stock=0, available=False))
+            self.assertEqual(
+                self.repository.inventory_stats(),
+                {
+                    "total_stock": 2,
+                    "inventory_value": 20.0,
+                    "by_type": {
+                        "product": {
+                            "available": 1,
+                            "unavailable": 1,
+                            "stock": 2,
+                            "inventory_value": 20.0,
+                        }
+                    },
+                },
+            )
+
+        def test_low_stock(self):
+            self.repository.set_reorder_threshold(5)
+            self.repository.set_reorder_threshold(20, product_type="food")
+            self.repository.add(Product("2", "Pen", 1, stock=4))
+            self.repository.add(Product("3", "Ink", 1, stock=2))
+            self.repository.add(
+                FoodProduct(
+                    "4",
+                    "Milk",
+                    2,
+                    stock=10,
+                    product_type="food",
+                    expiration_date="2030-01-01",
+                )
+            )
+            self.repository.set_reorder_threshold(1, code="3")
+            self.assertEqual(list(self.repository.low_stock()), ["1", "2", "4"])
+            self.assertEqual(list(self.repository.low_stock(limit=2)), ["1", "2"])
+            self.repository.adjust_stock("1", 7)
+            self.repository.delete("2")
+            self.assertEqual(list(self.repository.low_stock()), ["4"])
+
+        def test_low_stock_heap_under_churn(self):
+            self.repository.set_reorder_threshold(50)
+            for code in range(2, 200):
+                self.repository.add(Product(str(code), "Pen", 1, stock=code % 60))
+            for step in range(2000):
+                code = str(2 + step * 7 % 198)
+                stock = self.repository.get(code).stock
+                self.repository.adjust_stock(code, 3 if stock < 40 else -stock)
+            expected = sorted(
+                (product.stock, code)
+                for code, product in self.repository.list().items()
+                if product.stock < 50
+            )
+            index = self.repository.low_stock_index
+            self.assertEqual(index.lowest(10), expected[:10])
+            self.assertEqual(index.lowest(), expected)
+            # The removed entries are dropped once they outnumber the live ones
+            self.assertLessEqual(len(index.heap), 2 * len(index.stocks) + 64)
+            self.repository.add(Product("500", "Pen", 1, stock=0))
+            self.repository.delete("500")
+            self.repository.add(Product("500", "Pen", 1, stock=0))
+            self.assertEqual([code for _, code in index.lowest(200)].count("500"), 1)
+
+        def test_low_stock_listeners(self):
+            crossings = []
+            self.repository.set_reorder_threshold(5)
+            self.repository.watch_low_stock(
+                lambda *crossing: crossings.append(crossing)
+            )
+            self.repository.adjust_stock("1", 10)
+            self.repository.adjust_stock("1", -6)
+            self.repository.adjust_stock("1", -1)
+            self.repository.update(Product("1", "Product", 10, stock=9))
+            self.repository.add(Product("2", "Pen", 1, stock=4))
+            self.repository.delete("2")
+            self.assertEqual(
+                crossings,
+                [("1", 10, 5, False), ("1", 4, 5, True)]
+                + [("1", 9, 5, False), ("2", 4, 5, True)],
+            )
+
+        def test_update_where_and_delete_where(self):
+            self.repository.add(
+                FoodProduct(
+                    "2",
+                    "Milk",
+                    2,
+                    stock=4,
+                    product_type="food",
+                    expiration_date="2030-01-01",
+                )
+            )
+            self.repository.add(Product("3", "Pen", 1, stock=4))
+            crossings = []
+            self.repository.set_reorder_threshold(5)
+            self.repository.watch_low_stock(
+                lambda *crossing: crossings.append(crossing)
+            )
+            updated = self.repository.update_where(
+                {"stock_below": 5, "price_between": (0, 5)},
+                {"price": ("*", 1.05), "stock": ("+", 3)},
+            )
+            self.assertEqual(updated, 2)
+            self.assertEqual(self.repository.get("2").price, 2.1)
+            self.assertEqual(self.repository.get("2").stock, 7)
+            self.assertEqual(self.repository.get("2").version, 1)
+            self.assertEqual(self.repository.get("1").price, 10)
+            self.assertEqual(crossings, [("2", 7, 5, False), ("3", 7, 5, False)])
+            self.assertEqual(self.repository.inventory_stats()["total_stock"], 14)
+            with self.assertRaises(ValueError):
+                self.repository.update_where({}, {"stock": ("+", -5)})
+            self.assertEqual(self.repository.get("3").stock, 7)
+            with self.assertRaises(ValueError):
+                self.repository.update_where({}, {"code": "9"})
+            self.assertEqual(
+                self.repository.update_where({"product_type": "food"}, {"name": "Tea"}),
+                1,
+            )
+            self.assertEqual(list(self.repository.search("tea")), ["2"])
+            self.assertEqual(self.repository.delete_where({"product_type": "food"}), 1)
+            self.assertEqual(self.repository.delete_where({"available": False}), 0)
+            self.assertEqual(list(self.repository.list()), ["1", "3"])
+
+        def test_change_events(self):
+            event_bus = EventBus()
+            events = []
+            event_bus.subscribe(events.append)
+            queued_events = []
+            event_bus.subscribe(
+                queued_events.append, event_types=[ProductDeleted], queued=True
+            )
+            self.repository.event_bus = event_bus
+            self.repository.add(Product("2", "Pen", 1))
+            self.repository.update(Product("2", "Pen", 2))
+            self.repository.update(Product("2", "Pen", 2))
+            self.repository.delete("2")
+            event_bus.join()
+            self.assertEqual(
+                [type(event) for event in events],
+                [ProductCreated, ProductUpdated, ProductDeleted],
+            )
+            self.assertEqual(events[1].changes, {"price": (1.0, 2.0)})
+            self.assertEqual(queued_events, [events[2]])
+            event_bus.close()
+
+    class TestThreadSafeRepositories(unittest.TestCase):
+        def test_subscribers_can_read_the_repository(self):
+            for repository in (
+                DictProductRepository(thread_safe=True, event_bus=EventBus()),
+                ListProductRepository(thread_safe=True, event_bus=EventBus()),
+            ):
+                read = []
+                repository.event_bus.subscribe(
+                    lambda event: read.append(repository.get(event.code))
+                )
+                repository.set_reorder_threshold(5)
+                repository.watch_low_stock(
+                    lambda code, *crossing: read.append(repository.get(code))
+                )
+
+                def write():
+                    repository.add(Product("1", "Pen", 1, stock=2))
+                    repository.update_where({}, {"stock": ("+", 1)})
+                    repository.delete_where({})
+
+                thread = threading.Thread(target=write, daemon=True)
+                thread.start()
+                thread.join(timeout=5)
+                self.assertFalse(thread.is_alive(), f"{repository} deadlocked")
+                # The add read by the listener and the subscriber, then the
+                # update and the delete by the subscriber
+                self.assertEqual(len(read), 4)
+                self.assertEqual(read[-1], None)
+                repository.event_bus.close()
+
+        def stress(self, repository, workers=8, operations=300):
+            errors = []
+
+            def writer(worker):
+                try:
+                    for i in range(operations):
+                        code = f"{worker}-{i % 20}"
+                        if repository.get(code) is None:
+                            repository.add(Product(code, "Product", 1, stock=i))
+                        elif i % 3:
+                            repository.update(Product(code, "Renamed", 2, stock=i))
+                        else:
+                            repository.delete(code)
+                except Exception as ex:
+                    errors.append(ex)
+
+            def reader():
+                try:
+                    for _ in range(operations):
+                        products = repository.list()
+                        for code, product in products.items():
+                            self.assertEqual(code, product.code)
+                        repository.search("renamed")
+                        repository.get("0-1")
+                except Exception as ex:
+                    errors.append(ex)
+
+            threads = [
+                threading.Thread(target=writer, args=(worker,))
+                for worker in range(workers)
+            ] + [threading.Thread(target=reader) for _ in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            products = repository.list()
+            stats = repository.inventory_stats()
+            self.assertEqual(
+                stats["total_stock"],
+                sum(product.stock for product in products.values()),
+            )
+            self.assertEqual(
+                stats["by_type"].get("product", {}).get("available", 0)
+                + stats["by_type"].get("product", {}).get("unavailable", 0),
+                len(products),
+            )
+            renamed = {
+                code for code, product in products.items() if product.name == "Renamed"
+            }
+            self.assertEqual(set(repository.search("renamed", limit=None)), renamed)
+
+        def test_dict_repository(self):
+            self.stress(DictProductRepository(thread_safe=True, lock_stripes=4))
+
+        def test_list_repository(self):
+            self.stress(ListProductRepository(thread_safe=True))
+
+        def test_snapshot_is_shared_until_next_write(self):
+            repository = DictProductRepository(thread_safe=True)
+            repository.add(Product("1", "Product", 1))
+            snapshot = repository._get_snapshot()
+            self.assertIs(repository._get_snapshot(), snapshot)
+            repository.delete("1")
+            self.assertEqual(snapshot[0]["code"], "1")
+            self.assertEqual(repository._get_snapshot(), [])
+
+    class TestOptimisticConcurrency(unittest.TestCase):
+        def check_compare_and_swap(self, repository):
+            repository.add(Product("1", "Product", 10, stock=5))
+            product = repository.get("1")
+            self.assertEqual(product.version, 0)
+            repository.update(Product("1", "First", 10), expected_version=0)
+            with self.assertRaises(VersionConflictError):
+                repository.update(Product("1", "Second", 10), expected_version=0)
+            self.assertEqual(repository.get("1").name, "First")
+            self.assertEqual(repository.get("1").version, 1)
+            repository.update(Product("1", "Blind", 10))
+            self.assertEqual(repository.get("1").version, 2)
+
+        def test_list_repository(self):
+            self.check_compare_and_swap(ListProductRepository())
+
+        def test_dict_repository(self):
+            self.check_compare_and_swap(DictProductRepository(thread_safe=True))
+
+        def test_json_repository(self):
+            with tempfile.TemporaryDirectory() as directory:
+                repository = JsonProductRepository(
+                    os.path.join(directory, "products.json")
+                )
+                self.check_compare_and_swap(repository)
+                repository.close()
+
+        def test_one_winner_among_threads(self):
+            repository = DictProductRepository(thread_safe=True)
+            repository.add(Product("1", "Product", 10))
+            results = []
+
+            def update(name):
+                try:
+                    repository.update(Product("1", name, 10), expected_version=0)
+                    results.append(name)
+                except VersionConflictError:
+                    pass
+
+            threads = [
+                threading.Thread(target=update, args=(f"Writer {number}",))
+                for number in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), 1)
+            self.assertEqual(repository.get("1").name, results[0])
+
+    def add_products_in_process(filename, codes):
+        repository = JsonProductRepository(filename)
+        for code in codes:
+            repository.add(Product(code, f"Product {code}", 10))
+        repository.close()
+
     class TestJsonProductRepository(unittest.TestCase):
         def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+            self.filename = os.path.join(self.directory.name, "sample.json")
+            self.lock_filename = f"{self.filename}.lock"
             self.product = Product("1", "Product", 10)
-            with mock.patch("__main__.open", mock.mock_open(read_data="{}")):
-                self.repository = JsonProductRepository(filename="sample.json")
-                self.repository.add(self.product)
+            self.repository = JsonProductRepository(filename=self.filename)
+            self.repository.add(self.product)
+
+        def tearDown(self):
+            self.repository.close()
+            self.directory.cleanup()
 
         def test_add_product(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                for product in self.repository.list().values():
-                    self.assertEqual(product.to_dict(), self.product.to_dict())
+            for product in self.repository.list().values():
+                self.assertEqual(product.to_dict(), self.product.to_dict())
 
         def test_get_product(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                self.assertEqual(
-                    self.repository.get("1").to_dict(), self.product.to_dict()
-                )
+            self.assertEqual(self.repository.get("1").to_dict(), self.product.to_dict())
 
         def test_list_products(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                for product in self.repository.list().values():
-                    self.assertEqual(product.to_dict(), self.product.to_dict())
+            for product in self.repository.list().values():
+                self.assertEqual(product.to_dict(), self.product.to_dict())
 
         def test_update_product(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                new_product = Product("1", "New Product", 20)
-                self.repository.update(new_product)
-                self.assertEqual(self.repository.get("1").name, "New Product")
-                self.assertEqual(self.repository.get("1").price, 20)
+            new_product = Product("1", "New Product", 20)
+            self.repository.update(new_product)
+            self.assertEqual(self.repository.get("1").name, "New Product")
+            self.assertEqual(self.repository.get("1").price, 20)
 
         def test_delete_product(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                self.repository.delete("1")
-                self.assertEqual(self.repository.list(), {})
+            self.repository.delete("1")
+            self.assertEqual(self.repository.list(), {})
 
         def test_delete_product_not_found(self):
-            with mock.patch("__main__.open", mock.mock_open()):
-                with self.assertRaises(ValueError):
-                    self.repository.delete("2")
+            with self.assertRaises(ValueError):
+                self.repository.delete("2")
+
+        def test_low_stock_follows_the_file(self):
+            self.repository.set_reorder_threshold(3)
+            other = JsonProductRepository(filename=self.filename)
+            other.add(Product("2", "Pen", 1, stock=2))
+            other.close()
+            self.assertEqual(list(self.repository.low_stock()), ["1", "2"])
+
+        def test_update_where_writes_the_file_once(self):
+            self.repository.add(Product("2", "Pen", 1))
+            with mock.patch.object(
+                self.repository, "save", wraps=self.repository.save
+            ) as save:
+                self.assertEqual(
+                    self.repository.update_where({}, {"price": ("+", 1)}), 2
+                )
+            save.assert_called_once()
+            reopened = JsonProductRepository(self.filename)
+            self.assertEqual(reopened.get("2").price, 2)
+            self.assertEqual(reopened.delete_where({"price_between": (0, 5)}), 1)
+            self.assertEqual(list(self.repository.list()), ["1"])
+            reopened.close()
+
+        def test_skips_parsing_until_the_revision_changes(self):
+            other = JsonProductRepository(filename=self.filename)
+            with mock.patch("json.load", wraps=json.load) as load:
+                self.repository.list()
+                self.assertEqual(load.call_count, 0)
+                other.add(Product("2", "Other", 5))
+                self.assertEqual(set(self.repository.list()), {"1", "2"})
+                self.assertEqual(load.call_count, 1)
+            other.close()
+
+        def test_without_fcntl(self):
+            self.repository.close()
+            os.remove(self.lock_filename)
+            with mock.patch(f"{__name__}.fcntl", None), mock.patch.object(
+                os, "pread", create=True, side_effect=AssertionError
+            ), mock.patch.object(os, "pwrite", create=True, side_effect=AssertionError):
+                repository = JsonProductRepository(self.filename)
+                other = JsonProductRepository(self.filename)
+                other.add(Product("2", "Other", 5))
+                self.assertEqual(set(repository.list()), {"1", "2"})
+                repository.close()
+                other.close()
+            self.assertFalse(os.path.exists(self.lock_filename))
+
+        def test_no_partial_file_while_saving(self):
+            with mock.patch("json.dump", side_effect=TypeError("Not serializable")):
+                with self.assertRaises(TypeError):
+                    self.repository.add(Product("2", "Broken", 5))
+            with open(self.filename) as file:
+                self.assertEqual(set(json.load(file)), {"1"})
+            self.assertEqual(set(self.repository.list()), {"1"})
+            self.assertFalse(
+                [name for name in os.listdir(self.directory.name) if ".tmp" in name]
+            )
+
+        def test_processes_share_the_file(self):
+            processes = [
+                multiprocessing.Process(
+                    target=add_products_in_process,
+                    args=(
+                        self.filename,
+                        [f"{worker}-{number}" for number in range(25)],
+                    ),
+                )
+                for worker in range(4)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(len(self.repository.list()), 101)
+
+    class TestMySQLProductRepository(unittest.TestCase):
+        def setUp(self):
+            self.connector = mock.Mock()
+            self.repository = MySQLProductRepository(self.connector)
+
+        def test_find_pushes_filters_into_sql(self):
+            self.connector.run_query.side_effect = [
+                [
+                    {
+                        "code": "1",
+                        "name": "Milk",
+                        "price": 2,
+                        "description": None,
+                        "stock": 1,
+                        "available": 1,
+                        "product_type": "food",
+                    }
+                ],
+                [{"code": "1", "expiration_date": "2030-01-01"}],
+            ]
+            found = self.repository.find(
+                product_type="food", stock_below=5, order_by="-price", limit=10
+            )
+            query, query_args = self.connector.run_query.call_args_list[0].args
+            self.assertEqual(
+                query,
+                "SELECT * FROM products WHERE product_type = %s AND stock < %s"
+                " ORDER BY price DESC LIMIT %s",
+            )
+            self.assertEqual(query_args, ("food", 5, 10))
+            extra_query, extra_args = self.connector.run_query.call_args_list[1].args
+            self.assertEqual(extra_query, "SELECT * FROM food WHERE code IN (%s)")
+            self.assertEqual(found["1"].expiration_date, "2030-01-01")
+            self.connector.run_query.side_effect = None
+            self.connector.run_query.return_value = []
+            self.repository.find(order_by="code", limit=20, offset=40)
+            self.assertEqual(
+                self.connector.run_query.call_args.args,
+                (
+                    "SELECT * FROM products ORDER BY code ASC LIMIT %s OFFSET %s",
+                    (20, 40),
+                ),
+            )
+
+        def test_conditional_update(self):
+            self.connector.run_query.side_effect = [0, [{"version": 3}]]
+            with self.assertRaises(VersionConflictError):
+                self.repository.update(Product("1", "Milk", 2), expected_version=2)
+            query, query_args = self.connector.run_query.call_args_list[0].args
+            self.assertTrue(query.endswith("WHERE code = %s AND version = %s"))
+            self.assertIn("version = version + 1", query)
+            self.assertEqual(query_args[-2:], ("1", 2))
+            self.connector.rollback.assert_called_once()
+            self.connector.commit.assert_not_called()
+
+        def test_adjust_stock_in_one_statement(self):
+            self.connector.run_query.side_effect = [1, 0, [{"code": "1"}], 0, []]
+            self.repository.adjust_stock("1", 5)
+            query, query_args = self.connector.run_query.call_args.args
+            self.assertIn("stock = stock + %s", query)
+            self.assertEqual(query_args, (5, "1", 5))
+            with self.assertRaises(ValueError):
+                self.repository.adjust_stock("1", -50)
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.adjust_stock("9", 1)
+
+        def test_low_stock_from_the_stock_index(self):
+            self.repository.set_reorder_threshold(5)
+            self.repository.set_reorder_threshold(20, product_type="food")
+            self.connector.run_query.side_effect = [
+                [{"threshold": 50}],
+                [
+                    {
+                        "code": "1",
+                        "name": "Pen",
+                        "price": 1,
+                        "description": None,
+                        "stock": 30,
+                        "available": 1,
+                        "product_type": "product",
+                        "version": 0,
+                        "reorder_threshold": 50,
+                    }
+                ],
+            ]
+            low = self.repository.low_stock(limit=10)
+            query, query_args = self.connector.run_query.call_args.args
+            self.assertEqual(
+                query,
+                "SELECT * FROM products WHERE stock < %s AND stock < "
+                "COALESCE(reorder_threshold, CASE product_type WHEN %s THEN %s "
+                "ELSE %s END) ORDER BY stock, code LIMIT %s",
+            )
+            self.assertEqual(query_args, (50, "food", 20, 5, 10))
+            self.assertEqual(low["1"].stock, 30)
+
+        def test_low_stock_listeners_see_the_row_threshold(self):
+            crossings = []
+            self.repository.watch_low_stock(
+                lambda *crossing: crossings.append(crossing)
+            )
+            row = {"code": "1", "product_type": "product", "available": 1}
+            self.connector.run_query.side_effect = [
+                [{**row, "price": 1, "stock": 12, "reorder_threshold": 10}],
+                1,
+            ]
+            self.repository.adjust_stock("1", -3)
+            self.assertEqual(crossings, [("1", 9, 10, True)])
+
+        def test_write_batch_in_one_transaction(self):
+            milk = FoodProduct(
+                "2", "Milk", 2, product_type="food", expiration_date="2030-01-01"
+            )
+            self.repository.write_batch(
+                ["5", "6"], [(milk, 2)], [(Product("1", "Pen", 1), 3)]
+            )
+            delete_query, delete_args = self.connector.run_query.call_args.args
+            self.assertEqual(
+                delete_query, "DELETE FROM products WHERE code IN (%s, %s)"
+            )
+            self.assertEqual(delete_args, ("5", "6"))
+            insert, food_insert, update = self.connector.run_many.call_args_list
+            self.assertTrue(insert.args[0].startswith("INSERT INTO products"))
+            self.assertEqual(insert.args[1][0][-1], 2)
+            self.assertTrue(food_insert.args[0].startswith("INSERT INTO food"))
+            self.assertIn("version = version + %s WHERE code = %s", update.args[0])
+            self.assertEqual(update.args[1][0][-2:], (3, "1"))
+            self.connector.commit.assert_called_once()
+
+        def test_write_batch_reads_the_old_rows_in_its_transaction(self):
+            self.repository.event_bus = mock.Mock()
+            row = {
+                "code": "1",
+                "name": "Pen",
+                "price": 1,
+                "description": None,
+                "stock": 4,
+                "available": 1,
+                "product_type": "product",
+                "version": 2,
+            }
+            self.connector.run_query.side_effect = [[row], None]
+            self.repository.write_batch(
+                ["5", "6"], [], [(Product("1", "Pen", 1, stock=3), 1)]
+            )
+            select, delete = self.connector.run_query.call_args_list
+            self.assertEqual(
+                select.args,
+                (
+                    "SELECT * FROM products WHERE code IN (%s, %s, %s) FOR UPDATE",
+                    ("5", "6", "1"),
+                ),
+            )
+            self.assertEqual(select.kwargs, {"commit": False})
+            self.assertTrue(delete.args[0].startswith("DELETE FROM products"))
+            (event,), _ = self.repository.event_bus.publish.call_args
+            self.assertEqual(event.changes, {"stock": (4, 3)})
+
+        def test_update_where_in_one_statement(self):
+            self.connector.run_query.side_effect = [[], [], 3]
+            updated = self.repository.update_where(
+                {"product_type": "food", "available": True},
+                {"price": ("*", 1.05), "stock": ("+", -2), "available": False},
+            )
+            self.assertEqual(updated, 3)
+            lock, check, update = self.connector.run_query.call_args_list
+            self.assertEqual(
+                lock.args,
+                (
+                    "SELECT code FROM products WHERE product_type = %s "
+                    "AND available = %s FOR UPDATE",
+                    ("food", True),
+                ),
+            )
+            self.assertEqual(
+                check.args,
+                (
+                    "SELECT code FROM products WHERE product_type = %s "
+                    "AND available = %s AND stock + %s < 0 LIMIT 1",
+                    ("food", True, -2),
+                ),
+            )
+            self.assertEqual(
+                update.args,
+                (
+                    "UPDATE products SET price = ROUND(price * %s, 2), "
+                    "stock = stock + %s, available = %s, version = version + 1 "
+                    "WHERE product_type = %s AND available = %s",
+                    (1.05, -2, False, "food", True),
+                ),
+            )
+            self.connector.commit.assert_called_once()
+
+        def test_update_where_refuses_negative_stock(self):
+            self.connector.run_query.side_effect = [[{"code": "1"}], [{"code": "1"}]]
+            with self.assertRaises(ValueError):
+                self.repository.update_where({}, {"stock": ("+", -2)})
+            self.connector.rollback.assert_called_once()
+            self.connector.commit.assert_not_called()
+
+        def test_bulk_write_keeps_its_connection(self):
+            class StandInCursor:
+                def __init__(self, connection):
+                    self.connection = connection
+                    self.rows = []
+                    self.rowcount = 1
+
+                def execute(self, query, params=()):
+                    if not self.connection.connected:
+                        raise AssertionError("Statement on a closed connection")
+                    self.connection.executed.append(query)
+                    self.rows = [
+                        row
+                        for prefix, rows in self.connection.results.items()
+                        if query.startswith(prefix)
+                        for row in rows
+                    ]
+
+                def fetchall(self):
+                    return self.rows
+
+                def close(self):
+                    pass
+
+            class StandInConnection:
+                def __init__(self, results):
+                    self.results = results
+                    self.executed = []
+                    self.connected = True
+                    self.commits = 0
+
+                def cursor(self, **options):
+                    return StandInCursor(self)
+
+                def is_connected(self):
+                    return self.connected
+
+                def commit(self):
+                    self.commits += 1
+
+                def rollback(self):
+                    pass
+
+                def close(self):
+                    self.connected = False
+
+            row = {
+                "code": "1",
+                "name": "Milk",
+                "price": 2,
+                "description": None,
+                "stock": 12,
+                "available": 1,
+                "product_type": "food",
+                "version": 0,
+                "reorder_threshold": None,
+            }
+            results = {
+                "SELECT * FROM products": [row],
+                "SELECT * FROM food": [{"code": "1", "expiration_date": None}],
+            }
+            connections = []
+
+            def connect(**options):
+                connections.append(StandInConnection(results))
+                return connections[-1]
+
+            settings = {"DB_NAME": "products", "DB_PORT": 3306}
+            connector = MySqlConnector(
+                lambda option, default=None: settings.get(option, default),
+                connect=connect,
+            )
+            repository = MySQLProductRepository(connector)
+            repository.watch_low_stock(lambda *crossing: None)
+            for write in (
+                lambda: repository.update_where(
+                    {"product_type": "food"}, {"stock": ("+", -1)}
+                ),
+                lambda: repository.delete_where({"product_type": "food"}),
+            ):
+                connections.clear()
+                self.assertEqual(write(), 1)
+                # The locking read, the extra table, the check and the write
+                # on one connection, closed by the commit only
+                self.assertEqual(len(connections), 1)
+                self.assertEqual(connections[0].commits, 1)
+                self.assertFalse(connections[0].connected)
+            self.assertIn(
+                "SELECT * FROM food WHERE code IN (%s)", connections[0].executed
+            )
+
+        def test_delete_where_publishes_the_deleted_rows(self):
+            self.repository.event_bus = EventBus()
+            events = []
+            self.repository.event_bus.subscribe(events.append)
+            row = {
+                "code": "1",
+                "name": "Pen",
+                "price": 1,
+                "description": None,
+                "stock": 0,
+                "available": 0,
+                "product_type": "product",
+                "version": 2,
+                "reorder_threshold": None,
+            }
+            self.connector.run_query.side_effect = [[row], 1]
+            self.assertEqual(self.repository.delete_where({"available": False}), 1)
+            self.assertEqual(
+                self.connector.run_query.call_args.args,
+                ("DELETE FROM products WHERE available = %s", (False,)),
+            )
+            self.assertEqual([type(event) for event in events], [ProductDeleted])
+            self.assertEqual(events[0].code, "1")
+            self.repository.event_bus.close()
 
     unittest.main()
@@ -0,0 +1,268 @@
+import threading
+from collections.abc import MutableMapping, MutableSequence, ValuesView
+
+# Fields with few distinct values, shared by the rows instead of repeated
+LOW_CARDINALITY_FIELDS = ("product_type", "size", "color", "expiration_date")
+
+
+class RowCodec:
+    """Store product dictionaries as tuples of their values
+
+    Rows with the same keys, in the same order, share a schema: the tuple
+    of their keys, kept once. A row is the tuple of its values followed by
+    the number of its schema, so it costs a pointer per value instead of a
+    dictionary slot with its own key. The values of the low cardinality
+    fields are interned in a table of the codec, so every row points to the
+    same string instead of its own copy of "food" or "XL".
+    """
+
+    def __init__(self, low_cardinality_fields=LOW_CARDINALITY_FIELDS):
+        self.low_cardinality_fields = frozenset(low_cardinality_fields)
+        self.schemas: list[tuple[str, ...]] = []
+        # Position of the code in the rows of every schema
+        self.code_positions: list[int | None] = []
+        # keys -> (schema number, positions of the low cardinality fields)
+        self._schema_numbers: dict[tuple[str, ...], tuple[int, tuple[int, ...]]] = {}
+        self._interned: dict = {}
+        # Held to add a schema, which thread safe repositories do from any
+        # thread; the schemas known are looked up without it
+        self._schemas_lock = threading.Lock()
+
+    def _schema_for(self, keys: tuple[str, ...]) -> tuple[int, tuple[int, ...]]:
+        schema = self._schema_numbers.get(keys)
+        if schema is not None:
+            return schema
+        with self._schemas_lock:
+            schema = self._schema_numbers.get(keys)
+            if schema is None:
+                positions = tuple(
+                    position
+                    for position, key in enumerate(keys)
+                    if key in self.low_cardinality_fields
+                )
+                schema = (len(self.schemas), positions)
+                self.schemas.append(keys)
+                self.code_positions.append(
+                    keys.index("code") if "code" in keys else None
+                )
+                # Last, once the schema can be decoded
+                self._schema_numbers[keys] = schema
+        return schema
+
+    def encode(self, row: dict) -> tuple:
+        number, positions = self._schema_for(tuple(row))
+        values = list(row.values())
+        interned = self._interned
+        for position in positions:
+            value = values[position]
+            # By type too, True and 1 are equal keys
+            values[position] = interned.setdefault((value.__class__, value), value)
+        values.append(number)
+        return tuple(values)
+
+    def decode(self, row: tuple) -> dict:
+        # zip stops at the keys, leaving the schema number out
+        return dict(zip(self.schemas[row[-1]], row))
+
+    def stats(self) -> dict:
+        return {"schemas": len(self.schemas), "interned_values": len(self._interned)}
+
+
+class CompactRowDict(MutableMapping):
+    """Dictionary of product rows by code, stored encoded by a RowCodec
+
+    Reads return a new dictionary decoded from the stored tuple, so rows
+    can't be changed in place; writes replace them, as the repositories
+    already do.
+    """
+
+    def __init__(self, rows=None, codec: RowCodec | None = None):
+        self.codec = codec or RowCodec()
+        self.rows: dict[str, tuple] = {}
+        if rows:
+            self.update(rows)
+
+    def __getitem__(self, code):
+        return self.codec.decode(self.rows[code])
+
+    def __setitem__(self, code, row: dict):
+        self.rows[code] = self.codec.encode(row)
+
+    def __delitem__(self, code):
+        del self.rows[code]
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, code, default=None):
+        row = self.rows.get(code)
+        return default if row is None else self.codec.decode(row)
+
+    def values(self):
+        return _CompactValues(self)
+
+    def __repr__(self):
+        return f"CompactRowDict({dict(self.items())})"
+
+
+class _CompactValues(ValuesView):
+    def __iter__(self):
+        decode = self._mapping.codec.decode
+        return (decode(row) for row in self._mapping.rows.values())
+
+
+class CompactRowList(MutableSequence):
+    """List of product rows, stored encoded by a RowCodec"""
+
+    def __init__(self, rows=None, codec: RowCodec | None = None):
+        self.codec = codec or RowCodec()
+        self.rows: list[tuple] = [self.codec.encode(row) for row in rows or ()]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.codec.decode(row) for row in self.rows[position]]
+        return self.codec.decode(self.rows[position])
+
+    def __setitem__(self, position, row):
+        if isinstance(position, slice):
+            self.rows[position] = [self.codec.encode(item) for item in row]
+        else:
+            self.rows[position] = self.codec.encode(row)
+
+    def __delitem__(self, position):
+        del self.rows[position]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        decode = self.codec.decode
+        return (decode(row) for row in self.rows)
+
+    def insert(self, position, row: dict):
+        self.rows.insert(position, self.codec.encode(row))
+
+    def codes(self):
+        """Yield the code of every row without decoding it"""
+        code_positions = self.codec.code_positions
+        return (row[code_positions[row[-1]]] for row in self.rows)
+
+    def __repr__(self):
+        return f"CompactRowList({list(self)})"
+
+
+if __name__ == "__main__":
+    import itertools
+    import json
+    import time
+    import unittest
+
+    from models import ClothingProduct, FoodProduct, Product
+    from repositories import DictProductRepository, ListProductRepository
+
+    class TestRowCodec(unittest.TestCase):
+        def test_round_trip(self):
+            codec = RowCodec()
+            rows = [
+                {**Product("1", "Pen", 1.5).to_dict(), "version": 2},
+                ClothingProduct(
+                    "2", "Shirt", 9, product_type="clothing", size="XL", color="red"
+                ).to_dict(),
+                {"code": "3", "name": "Ink"},
+            ]
+            for row in rows:
+                encoded = codec.encode(row)
+                self.assertIsInstance(encoded, tuple)
+                self.assertEqual(codec.decode(encoded), row)
+                self.assertEqual(list(codec.decode(encoded)), list(row))
+            self.assertEqual(codec.stats()["schemas"], 3)
+
+        def test_shares_low_cardinality_values(self):
+            codec = RowCodec()
+            # Decoded JSON has its own copy of every value
+            first, second = json.loads(
+                json.dumps([{"code": str(code), "color": "red"} for code in "12"])
+            )
+            self.assertIsNot(first["color"], second["color"])
+            first, second = codec.encode(first), codec.encode(second)
+            self.assertIs(first[1], second[1])
+            self.assertIsNot(first[0], second[0])
+
+        def test_concurrent_schemas(self):
+            class SlowFields(frozenset):
+                # Widens the window between looking a schema up and adding it
+                def __contains__(self, key):
+                    time.sleep(0.001)
+                    return super().__contains__(key)
+
+            codec = RowCodec()
+            codec.low_cardinality_fields = SlowFields(codec.low_cardinality_fields)
+            rows = [
+                dict.fromkeys(keys, "x")
+                for keys in itertools.permutations(("code", "name", "color", "size"))
+            ]
+            barrier = threading.Barrier(8)
+            encoded = []
+
+            def encode_all():
+                barrier.wait()
+                encoded.append([codec.encode(row) for row in rows])
+
+            threads = [threading.Thread(target=encode_all) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(codec.stats()["schemas"], len(rows))
+            for thread_rows in encoded:
+                self.assertEqual(thread_rows, encoded[0])
+                decoded = [codec.decode(row) for row in thread_rows]
+                self.assertEqual(
+                    [list(row) for row in decoded], [list(row) for row in rows]
+                )
+
+    class TestCompactRepositories(unittest.TestCase):
+        def check_repository(self, repository):
+            milk = FoodProduct(
+                "1",
+                "Milk",
+                2,
+                stock=3,
+                product_type="food",
+                expiration_date="2030-01-01",
+            )
+            repository.add(milk)
+            repository.add(Product("2", "Pen", 1))
+            repository.update(Product("2", "Pen", 1.5, stock=4))
+            self.assertEqual(repository.get("1").to_dict(), milk.to_dict())
+            self.assertEqual(repository.get("2").version, 1)
+            self.assertEqual(list(repository.search("milk")), ["1"])
+            self.assertEqual(repository.inventory_stats()["total_stock"], 7)
+            repository.delete("1")
+            self.assertEqual(list(repository.list()), ["2"])
+            self.assertEqual(list(repository.find(stock_below=5)), ["2"])
+
+        def test_dict_repository(self):
+            repository = DictProductRepository(compact=True)
+            self.check_repository(repository)
+            self.assertIsInstance(repository.storage.rows["2"], tuple)
+
+        def test_list_repository(self):
+            repository = ListProductRepository(compact=True)
+            self.check_repository(repository)
+            self.assertIsInstance(repository.storage.rows[0], tuple)
+
+        def test_thread_safe_dict_repository(self):
+            repository = DictProductRepository(
+                {"1": Product("1", "Pen", 1).to_dict()}, thread_safe=True, compact=True
+            )
+            self.assertEqual(repository.get("1").name, "Pen")
+            self.check_repository(DictProductRepository(thread_safe=True, compact=True))
+
+    unittest.main()
@@ -1,22 +1,74 @@
+from async_repositories import AsyncProductRepository
 from models import BaseProduct
 from repositories import BaseProductRepository
+from tracing import traced
 
 
 class ProductService:
     def __init__(self, product_repository: BaseProductRepository):
         self.product_repository = product_repository
 
+    @traced()
     def list(self):
         return self.product_repository.list()
 
+    @traced()
     def get(self, product_id: int | str):
         return self.product_repository.get(product_id)
 
+    @traced()
+    def get_many(self, product_ids):
+        return self.product_repository.get_many(product_ids)
+
+    @traced()
     def add(self, product: BaseProduct):
         return self.product_repository.add(product)
 
-    def update(self, product: BaseProduct):
-        return self.product_repository.update(product)
+    @traced()
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        return self.product_repository.update(product, expected_version)
 
+    @traced()
     def delete(self, product_id: int | str):
         return self.product_repository.delete(product_id)
+
+    @traced()
+    def find(self, **filters):
+        return self.product_repository.find(**filters)
+
+    @traced()
+    def search(self, query: str, limit: int | None = 10):
+        return self.product_repository.search(query, limit)
+
+
+class AsyncProductService:
+    """ProductService for asyncio front ends, see AsyncProductRepository"""
+
+    def __init__(self, product_repository):
+        if isinstance(product_repository, BaseProductRepository):
+            product_repository = AsyncProductRepository(product_repository)
+        self.product_repository: AsyncProductRepository = product_repository
+
+    async def list(self):
+        return await self.product_repository.list()
+
+    async def get(self, product_id: int | str):
+        return await self.product_repository.get(product_id)
+
+    async def get_many(self, product_ids):
+        return await self.product_repository.get_many(product_ids)
+
+    async def add(self, product: BaseProduct):
+        return await self.product_repository.add(product)
+
+    async def update(self, product: BaseProduct, expected_version: int | None = None):
+        return await self.product_repository.update(product, expected_version)
+
+    async def delete(self, product_id: int | str):
+        return await self.product_repository.delete(product_id)
+
+    async def find(self, **filters):
+        return await self.product_repository.find(**filters)
+
+    async def search(self, query: str, limit: int | None = 10):
+        return await self.product_repository.search(query, limit)
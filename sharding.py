@@ -0,0 +1,525 @@
+import hashlib
+import heapq
+import threading
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from indexes import SearchIndex
+from locks import StripedLock
+from models import BaseProduct
+from repositories import (
+    BaseProductRepository,
+    none_last_key,
+    parse_order_by,
+)
+from stats import InventoryStats
+from tracing import in_current_context
+
+
+def stable_hash(key: str) -> int:
+    """Hash that is the same in every process, unlike hash()"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    """Map keys to shard names so adding a shard only moves about 1/N keys
+
+    Every shard is placed at virtual_nodes points of the ring, and a key
+    belongs to the first point after its own hash.
+    """
+
+    def __init__(self, shard_names, virtual_nodes: int = 64):
+        self.virtual_nodes = virtual_nodes
+        points = sorted(
+            (stable_hash(f"{name}#{replica}"), name)
+            for name in shard_names
+            for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def shard_for(self, key: str) -> str:
+        position = bisect(self._hashes, stable_hash(key)) % len(self._hashes)
+        return self._names[position]
+
+
+class ShardedProductRepository(BaseProductRepository):
+    """Repository that spreads the products over several repositories
+
+    Writes and lookups by code go to the shard chosen by a consistent hash
+    of the code; list, get_many, find, search, inventory_stats and low_stock
+    ask every shard in parallel and merge the answers. The shards can be any
+    repositories, but they must be thread safe: the fan-out calls run on
+    the executor's threads while the callers' threads, and add_shards moving
+    products, use the same shards.
+    """
+
+    def __init__(
+        self,
+        shards: dict[str, BaseProductRepository] | list[BaseProductRepository],
+        virtual_nodes: int = 64,
+        max_workers: int | None = None,
+    ):
+        if not isinstance(shards, dict):
+            shards = {f"shard-{number}": shard for number, shard in enumerate(shards)}
+        if not shards:
+            raise ValueError("At least one shard is needed")
+        self.shards = dict(shards)
+        self.virtual_nodes = virtual_nodes
+        self.ring = ConsistentHashRing(self.shards, virtual_nodes)
+        # Ring before the last add_shards, while its keys are being moved
+        self.previous_ring: ConsistentHashRing | None = None
+        self.max_workers = max_workers
+        self.executor = self._create_executor()
+        # Held to submit to the executor, and by add_shards to change the
+        # shards, the ring and the executor
+        self._routing_lock = threading.Lock()
+        # Held by code while a product is moved to its new shard
+        self._move_locks = StripedLock()
+
+    def _create_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers or len(self.shards),
+            thread_name_prefix="shard",
+        )
+
+    def shard_for(self, product_id: int | str) -> BaseProductRepository:
+        return self.shards[self.ring.shard_for(str(product_id))]
+
+    def _previous_shard_for(
+        self, product_id: int | str
+    ) -> BaseProductRepository | None:
+        if self.previous_ring is None:
+            return None
+        shard = self.shards[self.previous_ring.shard_for(str(product_id))]
+        return None if shard is self.shard_for(product_id) else shard
+
+    def _move_if_pending(self, product_id: int | str):
+        """Move a product whose owner changed and that wasn't moved yet"""
+        previous_shard = self._previous_shard_for(product_id)
+        if previous_shard is not None:
+            self._move(str(product_id), previous_shard, self.shard_for(product_id))
+
+    def _move(
+        self,
+        code: str,
+        shard: BaseProductRepository,
+        target: BaseProductRepository,
+    ) -> bool:
+        """Move the product of code from shard to target, if shard still has
+        it, and return whether it was moved"""
+        with self._move_locks.for_key(code).write():
+            product = shard.get(code)
+            if product is None:
+                return False
+            if target.get(code) is None:
+                target.add(product)
+            shard.delete(code)
+            return True
+
+    def _fan_out(self, method_name: str, *args, **kwargs) -> list:
+        with self._routing_lock:
+            futures = [
+                self.executor.submit(
+                    in_current_context(getattr(shard, method_name)), *args, **kwargs
+                )
+                for shard in self.shards.values()
+            ]
+        return [future.result() for future in futures]
+
+    def add(self, product: BaseProduct):
+        self._move_if_pending(product.code)
+        return self.shard_for(product.code).add(product)
+
+    def get(self, product_id: int | str) -> BaseProduct | None:
+        product = self.shard_for(product_id).get(product_id)
+        if product is None:
+            previous_shard = self._previous_shard_for(product_id)
+            if previous_shard is not None:
+                product = previous_shard.get(product_id)
+        return product
+
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        self._move_if_pending(product.code)
+        return self.shard_for(product.code).update(product, expected_version)
+
+    def delete(self, product_id: int | str):
+        self._move_if_pending(product_id)
+        return self.shard_for(product_id).delete(product_id)
+
+    def list(self) -> dict[str, BaseProduct]:
+        products = {}
+        for shard_products in self._fan_out("list"):
+            products.update(shard_products)
+        return products
+
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        codes_by_shard: dict[str, list[str]] = {}
+        for product_id in product_ids:
+            name = self.ring.shard_for(str(product_id))
+            codes_by_shard.setdefault(name, []).append(str(product_id))
+        with self._routing_lock:
+            futures = [
+                self.executor.submit(
+                    in_current_context(self.shards[name].get_many), codes
+                )
+                for name, codes in codes_by_shard.items()
+            ]
+        products = {}
+        for future in futures:
+            products.update(future.result())
+        missing = [code for code in map(str, product_ids) if code not in products]
+        if missing and self.previous_ring is not None:
+            for code in missing:
+                product = self.get(code)
+                if product is not None:
+                    products[code] = product
+        return products
+
+    def find(
+        self,
+        product_type: str | None = None,
+        available: bool | None = None,
+        price_between: tuple[float, float] | None = None,
+        stock_below: int | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+    ) -> dict[str, BaseProduct]:
+        shard_results = self._fan_out(
+            "find",
+            product_type=product_type,
+            available=available,
+            price_between=price_between,
+            stock_below=stock_below,
+            order_by=order_by,
+            # A shard can't tell which of its matches the others push past
+            # the offset
+            limit=None if limit is None else offset + limit,
+        )
+        products = [
+            product
+            for shard_products in shard_results
+            for product in shard_products.values()
+        ]
+        ordering = parse_order_by(order_by)
+        if ordering:
+            # Sorted again rather than merged: the shards don't all put the
+            # None values at the same end (MySQL sorts NULL first)
+            field, descending = ordering
+            products.sort(
+                key=lambda product: none_last_key(product.to_dict()[field]),
+                reverse=descending,
+            )
+        products = products[offset : None if limit is None else offset + limit]
+        return {product.code: product for product in products}
+
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        products = {}
+        for shard_products in self._fan_out("search", query, limit):
+            products.update(shard_products)
+        # Rank the best matches of every shard together
+        search_index = SearchIndex()
+        for product in products.values():
+            search_index.add(product.to_dict())
+        return {code: products[code] for code, _ in search_index.search(query, limit)}
+
+    def inventory_stats(self) -> dict:
+        stats = InventoryStats()
+        for shard_stats in self._fan_out("inventory_stats"):
+            stats.merge(shard_stats)
+        return stats.as_dict()
+
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        # Every shard answers lowest first, merged lazily up to the limit
+        products = heapq.merge(
+            *[
+                shard_products.values()
+                for shard_products in self._fan_out("low_stock", limit)
+            ],
+            key=lambda product: (product.stock, product.code),
+        )
+        return {product.code: product for product in islice(products, limit)}
+
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        """Every shard changes its matching products, in parallel"""
+        return sum(self._fan_out("update_where", criteria, changes))
+
+    def delete_where(self, criteria: dict) -> int:
+        return sum(self._fan_out("delete_where", criteria))
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        """Every shard keeps its thresholds, the one of a product goes to the
+        shard of its code"""
+        if code is not None:
+            self.shard_for(code).set_reorder_threshold(threshold, code)
+            return
+        for shard in self.shards.values():
+            shard.set_reorder_threshold(threshold, product_type=product_type)
+
+    def watch_low_stock(self, callback):
+        super().watch_low_stock(callback)
+        for shard in self.shards.values():
+            shard.watch_low_stock(callback)
+
+    def add_shards(
+        self, new_shards: dict[str, BaseProductRepository], batch_size: int = 500
+    ) -> dict[str, int]:
+        """Add shards and move the products they now own, while serving
+
+        Lookups of products not moved yet fall back to their previous shard,
+        and writes to them move them first. Return the number of products
+        moved out of every shard. If the moves fail, the previous ring is
+        kept for lookups and writes, and rebalance() resumes them.
+        """
+        with self._routing_lock:
+            duplicated = set(new_shards) & set(self.shards)
+            if duplicated:
+                raise ValueError(
+                    f"Shards already exist: {', '.join(sorted(duplicated))}"
+                )
+            # Replaced rather than changed, for the threads iterating it
+            old_shards = self.shards
+            self.previous_ring = self.ring
+            self.shards = {**old_shards, **new_shards}
+            self.ring = ConsistentHashRing(self.shards, self.virtual_nodes)
+            old_executor, self.executor = self.executor, self._create_executor()
+        # No fan-out submits to it any more; let those in flight finish
+        old_executor.shutdown(wait=True)
+        try:
+            return self.rebalance(batch_size, old_shards)
+        finally:
+            # After the moves, which don't take products below their threshold
+            for shard in new_shards.values():
+                for callback in self.low_stock_listeners:
+                    shard.watch_low_stock(callback)
+
+    def rebalance(
+        self,
+        batch_size: int = 500,
+        shards: dict[str, BaseProductRepository] | None = None,
+    ) -> dict[str, int]:
+        """Move the products of shards, all by default, that belong to
+        another shard; the previous ring is only dropped once every one is
+        moved, so a failed rebalance can be run again"""
+        if shards is None:
+            shards = self.shards
+        moved = {}
+        for name, shard in shards.items():
+            moved[name] = self._move_out(name, shard, batch_size)
+        self.previous_ring = None
+        return moved
+
+    def _move_out(
+        self, name: str, shard: BaseProductRepository, batch_size: int
+    ) -> int:
+        codes = [code for code in shard.list() if self.ring.shard_for(code) != name]
+        moved = 0
+        for start in range(0, len(codes), batch_size):
+            # Skips the codes already moved by writes to them, see
+            # _move_if_pending; the others are read again while moved
+            for code in shard.get_many(codes[start : start + batch_size]):
+                if self._move(code, shard, self.shard_for(code)):
+                    moved += 1
+        return moved
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __str__(self):
+        return f"ShardedProductRepository({', '.join(self.shards)})"
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import unittest
+
+    from models import Product
+    from repositories import DictProductRepository, JsonProductRepository
+
+    class TestShardedProductRepository(unittest.TestCase):
+        def setUp(self):
+            self.repository = ShardedProductRepository(
+                [DictProductRepository() for _ in range(3)]
+            )
+            for code in range(100):
+                self.repository.add(
+                    Product(str(code), f"Product {code}", code, stock=code % 7)
+                )
+
+        def tearDown(self):
+            self.repository.close()
+
+        def test_routes_by_code(self):
+            for code in ("1", "42", "99"):
+                shard = self.repository.shard_for(code)
+                self.assertEqual(shard.get(code).code, code)
+            sizes = [len(shard.list()) for shard in self.repository.shards.values()]
+            self.assertEqual(sum(sizes), 100)
+            self.assertTrue(all(sizes))
+
+        def test_fan_out(self):
+            self.assertEqual(len(self.repository.list()), 100)
+            self.assertEqual(
+                set(self.repository.get_many(["1", "2", "missing"])), {"1", "2"}
+            )
+            found = self.repository.find(stock_below=1, order_by="-price", limit=3)
+            self.assertEqual(list(found), ["98", "91", "84"])
+            found = self.repository.find(
+                stock_below=1, order_by="-price", limit=2, offset=2
+            )
+            self.assertEqual(list(found), ["84", "77"])
+            self.assertEqual(list(self.repository.search("product 42")), ["42"])
+            stats = self.repository.inventory_stats()
+            self.assertEqual(stats["by_type"]["product"]["available"], 100)
+
+        def test_bulk_writes_reach_every_shard(self):
+            updated = self.repository.update_where(
+                {"stock_below": 1}, {"stock": ("+", 10)}
+            )
+            self.assertEqual(updated, 15)
+            self.assertEqual(self.repository.find(stock_below=1), {})
+            self.assertEqual(
+                self.repository.delete_where({"price_between": (0, 9)}), 10
+            )
+            self.assertEqual(len(self.repository.list()), 90)
+
+        def test_low_stock_is_merged(self):
+            self.repository.set_reorder_threshold(2)
+            low = self.repository.low_stock(limit=20)
+            self.assertEqual(len(low), 20)
+            self.assertEqual(
+                [product.stock for product in low.values()], [0] * 15 + [1] * 5
+            )
+            self.assertEqual(list(low)[:3], ["0", "14", "21"])
+
+        def test_add_shards_moves_keys(self):
+            directory = tempfile.mkdtemp()
+            new_shard = JsonProductRepository(os.path.join(directory, "shard.json"))
+            moved = self.repository.add_shards({"json": new_shard})
+            self.assertEqual(sum(moved.values()), len(new_shard.list()))
+            self.assertTrue(0 < len(new_shard.list()) < 50)
+            self.assertEqual(len(self.repository.list()), 100)
+            for code in map(str, range(100)):
+                self.assertEqual(self.repository.get(code).code, code)
+            new_shard.close()
+
+        def test_pending_keys_are_moved_on_write(self):
+            new_shard = DictProductRepository()
+            self.repository.previous_ring = self.repository.ring
+            self.repository.shards["new"] = new_shard
+            self.repository.ring = ConsistentHashRing(self.repository.shards)
+            code = next(
+                str(code)
+                for code in range(100)
+                if self.repository.shard_for(str(code)) is new_shard
+            )
+            self.assertEqual(self.repository.get(code).code, code)
+            self.repository.update(Product(code, "Moved", 1))
+            self.assertEqual(new_shard.get(code).name, "Moved")
+            self.assertIsNone(
+                self.repository.shards[
+                    self.repository.previous_ring.shard_for(code)
+                ].get(code)
+            )
+
+        def test_rebalance_skips_products_moved_meanwhile(self):
+            new_shard = DictProductRepository()
+            self.repository.previous_ring = self.repository.ring
+            self.repository.shards["new"] = new_shard
+            self.repository.ring = ConsistentHashRing(self.repository.shards)
+            old_shard = self.repository.shards["shard-0"]
+            get_many = old_shard.get_many
+
+            def get_many_then_write(codes):
+                products = get_many(codes)
+                # A write moves the first one before the rebalance does
+                self.repository.update(Product(codes[0], "Moved", 1))
+                return products
+
+            old_shard.get_many = get_many_then_write
+            moved = self.repository.rebalance()
+            self.assertIsNone(self.repository.previous_ring)
+            self.assertEqual(len(self.repository.list()), 100)
+            self.assertEqual(sum(moved.values()) + 1, len(new_shard.list()), msg=moved)
+
+        def test_rebalance_keeps_products_deleted_meanwhile(self):
+            new_shard = DictProductRepository()
+            self.repository.previous_ring = self.repository.ring
+            self.repository.shards["new"] = new_shard
+            self.repository.ring = ConsistentHashRing(self.repository.shards)
+            old_shard = self.repository.shards["shard-0"]
+            get_many = old_shard.get_many
+            deleted = []
+
+            def get_many_then_delete(codes):
+                products = get_many(codes)
+                self.repository.delete(codes[0])
+                deleted.append(codes[0])
+                return products
+
+            old_shard.get_many = get_many_then_delete
+            self.repository.rebalance()
+            self.assertTrue(deleted)
+            for code in deleted:
+                self.assertIsNone(self.repository.get(code))
+            self.assertEqual(len(self.repository.list()), 100 - len(deleted))
+
+        def test_fan_out_during_add_shards(self):
+            errors = []
+            done = threading.Event()
+
+            def read():
+                while not done.is_set():
+                    try:
+                        self.repository.list()
+                        self.repository.get_many(["1", "2", "3"])
+                    except Exception as error:
+                        errors.append(error)
+
+            readers = [threading.Thread(target=read) for _ in range(4)]
+            for reader in readers:
+                reader.start()
+            try:
+                for number in range(5):
+                    self.repository.add_shards(
+                        {f"new-{number}": DictProductRepository()}
+                    )
+            finally:
+                done.set()
+                for reader in readers:
+                    reader.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(self.repository.list()), 100)
+
+        def test_failed_add_shards_can_be_resumed(self):
+            new_shard = DictProductRepository()
+            add = new_shard.add
+            calls = []
+
+            def add_or_fail(product):
+                calls.append(product.code)
+                if len(calls) == 2:
+                    raise OSError("Disk full")
+                return add(product)
+
+            new_shard.add = add_or_fail
+            with self.assertRaises(OSError):
+                self.repository.add_shards({"new": new_shard})
+            self.assertIsNotNone(self.repository.previous_ring)
+            for code in map(str, range(100)):
+                self.assertEqual(self.repository.get(code).code, code)
+            self.repository.rebalance()
+            self.assertIsNone(self.repository.previous_ring)
+            self.assertEqual(len(self.repository.list()), 100)
+            for code in new_shard.list():
+                self.assertIs(self.repository.shard_for(code), new_shard)
+
+    unittest.main()
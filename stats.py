@@ -0,0 +1,87 @@
+from indexes import BaseIndex
+
+
+def to_cents(amount) -> int:
+    """Money is accumulated in cents so adding and removing never drifts"""
+    return round(amount * 100)
+
+
+class InventoryStats(BaseIndex):
+    """Stock, inventory value and availability counts per product type
+
+    Every add or remove applies the product's contribution as a delta, so
+    the aggregates never need a full scan to stay current.
+    """
+
+    def __init__(self):
+        self.by_type: dict[str, dict[str, int]] = {}
+
+    def _totals(self, product_type: str) -> dict[str, int]:
+        totals = self.by_type.get(product_type)
+        if totals is None:
+            totals = self.by_type[product_type] = {
+                "available": 0,
+                "unavailable": 0,
+                "stock": 0,
+                "value_cents": 0,
+            }
+        return totals
+
+    def _apply(self, product_data: dict, sign: int):
+        product_type = product_data.get("product_type", "product")
+        totals = self._totals(product_type)
+        stock = int(product_data["stock"])
+        totals["available" if product_data["available"] else "unavailable"] += sign
+        totals["stock"] += sign * stock
+        totals["value_cents"] += sign * to_cents(product_data["price"]) * stock
+        if not totals["available"] and not totals["unavailable"]:
+            del self.by_type[product_type]
+
+    def add(self, product_data: dict):
+        self._apply(product_data, 1)
+
+    def remove(self, product_data: dict):
+        self._apply(product_data, -1)
+
+    def clear(self):
+        self.by_type = {}
+
+    def load_totals(self, rows):
+        """Replace the aggregates with rows grouped by product_type and
+        available, holding the products count, stock and inventory value"""
+        self.clear()
+        for row in rows:
+            totals = self._totals(row["product_type"])
+            totals["available" if row["available"] else "unavailable"] += int(
+                row["products"]
+            )
+            totals["stock"] += int(row["stock"] or 0)
+            totals["value_cents"] += to_cents(row["inventory_value"] or 0)
+
+    def merge(self, stats: dict):
+        """Add the aggregates returned by another inventory_stats()"""
+        for product_type, type_stats in stats.get("by_type", {}).items():
+            totals = self._totals(product_type)
+            totals["available"] += type_stats["available"]
+            totals["unavailable"] += type_stats["unavailable"]
+            totals["stock"] += type_stats["stock"]
+            totals["value_cents"] += to_cents(type_stats["inventory_value"])
+
+    def as_dict(self) -> dict:
+        by_type = {
+            product_type: {
+                "available": totals["available"],
+                "unavailable": totals["unavailable"],
+                "stock": totals["stock"],
+                "inventory_value": totals["value_cents"] / 100,
+            }
+            for product_type, totals in self.by_type.items()
+        }
+        return {
+            "total_stock": sum(totals["stock"] for totals in self.by_type.values()),
+            "inventory_value": sum(
+                totals["value_cents"] for totals in self.by_type.values()
+            )
+            / 100,
+            "by_type": by_type,
+        }
@@ -0,0 +1,312 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+
+# Span the code running in this thread or task is part of
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+@dataclass(slots=True)
+class Span:
+    """A timed operation; spans started inside it are its children"""
+
+    name: str
+    span_id: int
+    trace_id: int
+    parent_id: int | None
+    start_ns: int
+    thread_id: int
+    duration_ns: int = 0
+    error: str | None = None
+    attributes: dict = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def to_trace_event(self, process_id: int) -> dict:
+        """Return the span as a Chrome trace event, in microseconds"""
+        return {
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start_ns / 1000,
+            "dur": self.duration_ns / 1000,
+            "pid": process_id,
+            "tid": self.thread_id,
+            "args": {
+                "span_id": self.span_id,
+                "trace_id": self.trace_id,
+                "parent_id": self.parent_id,
+                **({"error": self.error} if self.error else {}),
+                **self.attributes,
+            },
+        }
+
+
+class _ActiveSpan:
+    """Context manager timing a span and making it the current one"""
+
+    __slots__ = ("tracer", "name", "attributes", "span", "token")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        span_id = next(self.tracer._span_ids)
+        self.span = Span(
+            name=self.name,
+            span_id=span_id,
+            trace_id=parent.trace_id if parent else span_id,
+            parent_id=parent.span_id if parent else None,
+            start_ns=time.perf_counter_ns(),
+            thread_id=threading.get_ident(),
+            attributes=self.attributes,
+        )
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        span = self.span
+        span.duration_ns = time.perf_counter_ns() - span.start_ns
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        _current_span.reset(self.token)
+        self.tracer.spans.append(span)
+        return False
+
+
+class _NullSpan:
+    """What span() returns while tracing is off"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Collect the spans of the operations while enabled
+
+    Tracing is off until enable(); until then span() returns a shared no-op
+    context manager and traced functions call the wrapped one directly.
+    The last max_spans finished spans are kept, for write().
+    """
+
+    def __init__(self, max_spans: int = 100_000):
+        self.enabled = False
+        self.spans: deque[Span] = deque(maxlen=max_spans)
+        self._span_ids = itertools.count(1)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.spans.clear()
+
+    def write_jsonl(self, filename: str):
+        """Write a span per line, the order they finished in"""
+        with open(filename, "w", encoding="utf-8") as file:
+            for span in list(self.spans):
+                file.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def write_chrome_trace(self, filename: str):
+        """Write the spans in the trace event format of chrome://tracing and
+        Perfetto, which draw them as a flame chart per thread"""
+        process_id = os.getpid()
+        trace = {
+            "traceEvents": [
+                span.to_trace_event(process_id) for span in list(self.spans)
+            ],
+            "displayTimeUnit": "ms",
+        }
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(trace, file, default=str)
+
+    def write(self, filename: str):
+        """Write the spans as JSONL to a .jsonl file, as a Chrome trace else"""
+        if filename.endswith(".jsonl"):
+            self.write_jsonl(filename)
+        else:
+            self.write_chrome_trace(filename)
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attributes):
+    """Time the block inside `with span(...)` as a child of the current span"""
+    if not tracer.enabled:
+        return NULL_SPAN
+    return _ActiveSpan(tracer, name, attributes)
+
+
+def traced(name: str | None = None, attributes=None):
+    """Decorator timing every call of a function in a span
+
+    The span is named after the function's qualified name unless name is
+    given; attributes, if given, is called with the arguments of the call
+    and returns the attributes of the span.
+    """
+
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            span_attributes = attributes(*args, **kwargs) if attributes else {}
+            with _ActiveSpan(tracer, span_name, span_attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_current_context(function):
+    """Return function bound to the current span, to run on another thread"""
+    if not tracer.enabled:
+        return function
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+
+    from models import Product
+    from db.connectors import MySqlConnector
+    from repositories import DictProductRepository, MySQLProductRepository
+    from services import ProductService
+
+    # The tracer the repositories use, not the one of this __main__ module
+    from tracing import NULL_SPAN, in_current_context, span, traced, tracer
+
+    class TestTracing(unittest.TestCase):
+        def setUp(self):
+            tracer.clear()
+            tracer.enable()
+
+        def tearDown(self):
+            tracer.disable()
+            tracer.clear()
+
+        def test_nested_spans(self):
+            with span("outer", code="1") as outer:
+                with span("inner"):
+                    pass
+            inner = tracer.spans[0]
+            self.assertEqual(inner.parent_id, outer.span_id)
+            self.assertEqual(inner.trace_id, outer.span_id)
+            self.assertEqual(outer.attributes, {"code": "1"})
+            self.assertGreaterEqual(outer.duration_ns, inner.duration_ns)
+
+        def test_nothing_recorded_when_off(self):
+            tracer.disable()
+
+            @traced()
+            def work():
+                return 1
+
+            self.assertIs(span("anything"), NULL_SPAN)
+            self.assertEqual(work(), 1)
+            self.assertEqual(len(tracer.spans), 0)
+
+        def test_errors_are_recorded(self):
+            @traced("failing", attributes=lambda code: {"code": code})
+            def fail(code):
+                raise ValueError(code)
+
+            with self.assertRaises(ValueError):
+                fail("7")
+            self.assertEqual(tracer.spans[0].name, "failing")
+            self.assertEqual(tracer.spans[0].error, "ValueError")
+            self.assertEqual(tracer.spans[0].attributes, {"code": "7"})
+
+        def test_service_to_repository(self):
+            service = ProductService(DictProductRepository())
+            service.add(Product("1", "Pen", 1))
+            service.get("1")
+            names = [recorded.name for recorded in tracer.spans]
+            self.assertEqual(
+                names,
+                [
+                    "DictProductRepository.add",
+                    "ProductService.add",
+                    "DictProductRepository.get",
+                    "ProductService.get",
+                ],
+            )
+            self.assertEqual(tracer.spans[0].parent_id, tracer.spans[1].span_id)
+
+        def test_repository_to_connector(self):
+            settings = {"DB_NAME": "products", "DB_PORT": 3306}
+            connector = MySqlConnector(
+                lambda option, default=None: settings.get(option, default),
+                connect=lambda **options: mock.MagicMock(),
+            )
+            MySQLProductRepository(connector).update(Product("1", "Pen", 1))
+            update = tracer.spans[-1]
+            queries = [
+                recorded.attributes["sql"]
+                for recorded in tracer.spans
+                if recorded.parent_id == update.span_id
+            ]
+            self.assertEqual(update.name, "MySQLProductRepository.update")
+            self.assertEqual(len(queries), 2)
+            self.assertTrue(queries[0].startswith("UPDATE products SET"))
+            self.assertTrue(queries[1].startswith("select code from products"))
+
+        def test_other_threads(self):
+            def work():
+                with span("work"):
+                    pass
+
+            with ThreadPoolExecutor(1) as executor, span("request") as request:
+                executor.submit(in_current_context(work)).result()
+            work = tracer.spans[0]
+            self.assertEqual(work.parent_id, request.span_id)
+            self.assertNotEqual(work.thread_id, request.thread_id)
+
+        def test_write(self):
+            with span("outer"):
+                with span("inner"):
+                    pass
+            with tempfile.TemporaryDirectory() as directory:
+                filename = os.path.join(directory, "trace.jsonl")
+                tracer.write(filename)
+                with open(filename, encoding="utf-8") as file:
+                    lines = [json.loads(line) for line in file]
+                self.assertEqual([line["name"] for line in lines], ["inner", "outer"])
+                filename = os.path.join(directory, "trace.json")
+                tracer.write(filename)
+                with open(filename, encoding="utf-8") as file:
+                    events = json.load(file)["traceEvents"]
+                self.assertEqual(events[1]["ph"], "X")
+                self.assertEqual(
+                    events[0]["args"]["parent_id"], events[1]["args"]["span_id"]
+                )
+
+    unittest.main()
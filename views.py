@@ -1,10 +1,22 @@
 import os
+import sys
+from collections import OrderedDict
 from typing import Literal
 
+try:
+    import select
+    import termios
+    import tty
+except ImportError:  # Windows, search as you type falls back to a prompt
+    termios = None
+
 from models import BaseProduct
 
 PRODUCT_TYPES = Literal["generic", "electronic", "food", "clothing"]
 
+# Erase the screen and move the cursor to its top left corner
+CLEAR_SCREEN = "\033[2J\033[H"
+
 
 class Menu:
     def __init__(self, title: str, options: list[str], back_option: str = "Back"):
@@ -13,27 +25,95 @@ class Menu:
         self.back_option = back_option
 
 
+def iter_pages(products: dict[str, BaseProduct], page_size: int):
+    products = list(products.values())
+    for start in range(0, len(products), page_size):
+        yield products[start : start + page_size]
+
+
+def apply_keys(query: str, keys: str) -> tuple[str, bool]:
+    """Return the query after the typed keys, and whether Enter or Esc ended
+    it; the escape sequences of the arrow and function keys are ignored"""
+    position = 0
+    while position < len(keys):
+        key = keys[position]
+        position += 1
+        if key in ("\r", "\n"):
+            return query, True
+        if key == "\x1b":
+            if position == len(keys):
+                return query, True
+            # CSI or SS3 sequence: skip to its final letter or ~
+            position += 1
+            while position < len(keys) and not (
+                keys[position].isalpha() or keys[position] == "~"
+            ):
+                position += 1
+            position += 1
+        elif key in ("\x7f", "\b"):
+            query = query[:-1]
+        elif key.isprintable():
+            query += key
+    return query, False
+
+
 class CLIView:
+    """Terminal interface of the Controller
+
+    Screens are built in a buffer and written at once when the user is
+    asked for something, so a screen costs one write, however many lines.
+    """
+
+    page_size = 20
+    # Results of the last queries typed, so erasing a letter answers at once
+    search_cache_size = 32
+
+    def __init__(self, output=None):
+        self.output = output or sys.stdout
+        self._buffer: list[str] = []
+
+    @property
+    def interactive(self) -> bool:
+        """Whether the keys can be read one by one, for search as you type"""
+        return termios is not None and sys.stdin.isatty()
+
+    def write(self, *values, sep: str = " ", end: str = "\n"):
+        """Add to the screen being built, like print"""
+        self._buffer.append(sep.join(str(value) for value in values) + end)
+
+    def flush(self):
+        if self._buffer:
+            self.output.write("".join(self._buffer))
+            self._buffer.clear()
+        self.output.flush()
+
+    def prompt(self, text: str = "") -> str:
+        """Show the screen built so far and read a line"""
+        self.write(text, end="")
+        self.flush()
+        return input()
+
     def show_menu(self, menu: Menu | list[str], back_text: str = "Back"):
         self.clear_screen()
         if isinstance(menu, Menu):
-            print(f"{menu.title}\n")
+            self.write(f"{menu.title}\n")
             for i, option in enumerate(menu.options):
-                print(f"{i + 1}. {option}")
-            print(f"0. {back_text or menu.back_option}\n")
-            return input("Select an option: ")
+                self.write(f"{i + 1}. {option}")
+            self.write(f"0. {back_text or menu.back_option}\n")
+            return self.prompt("Select an option: ")
         if isinstance(menu, list):
             for i, option in enumerate(menu):
-                print(f"{i + 1}. {option}")
-            print("0. Cancel\n")
-            selected = input("Select an option: ")
+                self.write(f"{i + 1}. {option}")
+            self.write("0. Cancel\n")
+            selected = self.prompt("Select an option: ")
             if selected == "0":
                 return None
             return menu[int(selected) - 1]
         raise ValueError("Invalid menu type")
 
-    def clear_screen(slef):
-        os.system("cls" if os.name == "nt" else "clear")
+    def clear_screen(self):
+        # Drops what the previous screen left unwritten
+        self._buffer = [CLEAR_SCREEN]
 
     def main_menu(self):
         main_menu = Menu(
@@ -44,30 +124,31 @@ class CLIView:
                 "Search Product",
                 "Update Product",
                 "Delete Product",
+                "Find Products by Name",
             ],
         )
         while True:
             try:
                 return self.show_menu(main_menu, back_text="Exit")
             except ValueError:
-                print("Invalid option")
-                input()
+                self.write("Invalid option")
+                self.prompt()
 
     def wait_for_user(self):
-        input("Press enter to continue...")
+        self.prompt("Press enter to continue...")
 
     def delete_product(self):
-        return input("Enter the product ID to delete: ")
+        return self.prompt("Enter the product ID to delete: ")
 
     def update_product(self, product_data):
         self.clear_screen()
-        print("Update Product")
+        self.write("Update Product")
         update_data = {}
-        print("Enter new product data. Leave blank to keep the original value.")
+        self.write("Enter new product data. Leave blank to keep the original value.")
         for key, value in product_data.items():
             if key in ("product_type", "code"):
                 continue
-            new_value = input(f"{key} ({value}): ")
+            new_value = self.prompt(f"{key} ({value}): ")
             if new_value:
                 update_data[key] = new_value
         return update_data
@@ -75,30 +156,205 @@ class CLIView:
     def search_product(self):
         self.clear_screen()
         self.show_message("Search Product", "\n")
-        return input("Enter the product code to search: ")
+        return self.prompt("Enter the product code to search: ")
+
+    def search_products(self):
+        self.clear_screen()
+        self.show_message("Find Products", "\n")
+        return self.prompt("Enter words of the name or description: ")
 
     def get_product_fields(self, product_type: PRODUCT_TYPES):
         pass
 
     def show_message(self, message: str, *args):
-        print(message, *args)
+        self.write(message, *args)
 
     def add_product(self, fields: list[str]):
         product_data = {}
         for field in fields:
             if field == "product_type":
                 continue
-            product_data[field] = input(f"Enter {field}: ")
+            product_data[field] = self.prompt(f"Enter {field}: ")
         return product_data
 
     def list_products(self, products: dict[str, BaseProduct]):
+        self.browse_products(iter_pages(products, self.page_size))
+
+    def browse_products(self, pages, title: str = "Products"):
+        """Page through lists of products, reading the next one from pages
+        only when it is shown; the pages seen are kept to go back"""
+        pages = iter(pages)
+        seen: list[list[BaseProduct]] = []
+        last_read = False
+        number = 0
+        while True:
+            while number == len(seen) and not last_read:
+                page = next(pages, None)
+                if page is None:
+                    last_read = True
+                elif page:
+                    seen.append(page)
+            if not seen:
+                self.clear_screen()
+                self.write(title, "\n")
+                self.write("No products")
+                self.wait_for_user()
+                return
+            if number == len(seen):
+                # Went past a last page not known as such when shown
+                return
+            is_last = last_read and number == len(seen) - 1
+            self.clear_screen()
+            self.write(f"{title} - page {number + 1}{' (last)' if is_last else ''}\n")
+            for product in seen[number]:
+                self.write(f"{product.code}, {product.name}, {product.type}")
+            choice = self.prompt(
+                "\nEnter: next page, p: previous page, q: back "
+                if not is_last
+                else "\nEnter: back, p: previous page "
+            )
+            choice = choice.strip().lower()
+            if choice in ("q", "0") or (is_last and choice != "p"):
+                return
+            number = max(0, number - 1) if choice == "p" else number + 1
+
+    def search_as_you_type(self, search):
+        """Show the results of search(query) on every key typed, until Enter
+        or Esc; needs interactive"""
+        fd = sys.stdin.fileno()
+        saved = termios.tcgetattr(fd)
+        try:
+            tty.setcbreak(fd)
+            self._search_loop(fd, search)
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+    def _search_loop(self, fd: int, search):
+        """Search for the query typed on fd, only once for the keys typed
+        while a search ran: they are read together before the next one"""
+        cache: OrderedDict[str, dict[str, BaseProduct]] = OrderedDict()
+        query = ""
+        while True:
+            key = query.strip().lower()
+            if key in cache:
+                cache.move_to_end(key)
+            else:
+                cache[key] = search(query) if key else {}
+                if len(cache) > self.search_cache_size:
+                    cache.popitem(last=False)
+            self._show_search(query, cache[key])
+            keys = os.read(fd, 1024)
+            if not keys:
+                return
+            while select.select([fd], [], [], 0)[0]:
+                more = os.read(fd, 1024)
+                if not more:
+                    break
+                keys += more
+            query, done = apply_keys(query, keys.decode(errors="ignore"))
+            if done:
+                return
+
+    def _show_search(self, query: str, products: dict[str, BaseProduct]):
         self.clear_screen()
-        self.show_message("Products")
-        for product in products.values():
-            print(f"{product.code}, {product.name}, {product.type}")
-        input("Press enter to continue...")
+        self.write("Find Products - Enter or Esc to finish\n")
+        for product in list(products.values())[: self.page_size]:
+            self.write(f"{product.code}, {product.name}, {product.type}")
+        if query.strip() and not products:
+            self.write("No products found")
+        self.write(f"\nSearch: {query}", end="")
+        self.flush()
 
     def show_product_details(self, product: BaseProduct):
-        print(product)
-        input("Press enter to continue...")
+        self.write(product)
+        self.prompt("Press enter to continue...")
         return None
+
+
+if __name__ == "__main__":
+    import io
+    import unittest
+    from unittest import mock
+
+    from models import Product
+
+    class TestCLIView(unittest.TestCase):
+        def setUp(self):
+            self.output = io.StringIO()
+            self.output.write = mock.Mock(wraps=self.output.write)
+            self.view = CLIView(self.output)
+
+        def test_screen_is_written_once(self):
+            with mock.patch("builtins.input", return_value="1"):
+                self.assertEqual(self.view.main_menu(), "1")
+            self.output.write.assert_called_once()
+            screen = self.output.getvalue()
+            self.assertTrue(screen.startswith(CLEAR_SCREEN))
+            self.assertIn("6. Find Products by Name", screen)
+
+        def test_pages_are_read_when_shown(self):
+            read = []
+
+            def pages():
+                for number in range(3):
+                    read.append(number)
+                    yield [Product(str(number), f"Pen {number}", 1)]
+
+            with mock.patch("builtins.input", side_effect=["", "p", "q"]):
+                self.view.browse_products(pages())
+            self.assertEqual(read, [0, 1])
+            self.assertEqual(self.output.write.call_count, 3)
+            self.assertIn("page 1\n", self.output.getvalue().split(CLEAR_SCREEN)[-1])
+
+        def test_last_page(self):
+            with mock.patch("builtins.input", side_effect=["", ""]) as prompt:
+                self.view.list_products(
+                    {str(code): Product(str(code), "Pen", 1) for code in range(25)}
+                )
+            self.assertEqual(prompt.call_count, 2)
+            self.assertIn("page 2\n", self.output.getvalue())
+
+        def test_no_products(self):
+            with mock.patch("builtins.input", return_value="") as prompt:
+                self.view.browse_products(iter([[], []]))
+            prompt.assert_called_once()
+            self.assertIn("No products", self.output.getvalue())
+
+        def test_apply_keys(self):
+            self.assertEqual(apply_keys("", "pen"), ("pen", False))
+            self.assertEqual(apply_keys("pen", "\x7f\x7fa"), ("pa", False))
+            self.assertEqual(apply_keys("pen", "\x1b[A\x1b[Bs"), ("pens", False))
+            self.assertEqual(apply_keys("pen", "s\r"), ("pens", True))
+            self.assertEqual(apply_keys("pen", "\x1b"), ("pen", True))
+
+        @unittest.skipIf(termios is None, "needs select on a pipe")
+        def test_keys_typed_during_a_search_are_searched_once(self):
+            read_fd, write_fd = os.pipe()
+            searches = []
+
+            def search(query):
+                searches.append(query)
+                if query == "p":
+                    # Typed while the search of "p" runs
+                    os.write(write_fd, b"en")
+                return {"1": Product("1", "Pen", 1)}
+
+            shown = []
+            # Typed once "pen" is shown: back to "p", then Enter
+            keys = [b"\x7f\x7f", b"\r"]
+
+            def show(query, products):
+                shown.append(query)
+                if query == "pen" or query == "p" and len(shown) > 2:
+                    os.write(write_fd, keys.pop(0))
+
+            os.write(write_fd, b"p")
+            self.view._show_search = show
+            self.view._search_loop(read_fd, search)
+            os.close(read_fd)
+            os.close(write_fd)
+            self.assertEqual(shown, ["", "p", "pen", "p"])
+            # "pe" was never searched, and "p" came back from the cache
+            self.assertEqual(searches, ["p", "pen"])
+
+    unittest.main()
@@ -0,0 +1,444 @@
+import json
+import math
+import queue
+import threading
+import time
+
+from models import BaseProduct, ProductFactory
+from repositories import BaseProductRepository
+
+
+def encode_product(product: BaseProduct) -> dict:
+    return {**product.to_dict(), "version": product.version}
+
+
+def decode_arguments(arguments: dict) -> dict:
+    """Return the keyword arguments of a recorded operation, with products"""
+    arguments = dict(arguments)
+    if "product" in arguments:
+        arguments["product"] = ProductFactory().create_product(**arguments["product"])
+    if "products" in arguments:
+        arguments["products"] = [
+            ProductFactory().create_product(**product_data)
+            for product_data in arguments["products"]
+        ]
+    if arguments.get("price_between") is not None:
+        arguments["price_between"] = tuple(arguments["price_between"])
+    if arguments.get("criteria", {}).get("price_between") is not None:
+        arguments["criteria"] = {
+            **arguments["criteria"],
+            "price_between": tuple(arguments["criteria"]["price_between"]),
+        }
+    return arguments
+
+
+class RecordingRepository(BaseProductRepository):
+    """Log every operation on a repository to a JSONL file, for replay()
+
+    A line holds the operation, its arguments, when it started (at, a Unix
+    time), how long it took (seconds) and the name of the exception it
+    raised, if any. iter_batches and iter_expiring_between, which return
+    generators, the watch_low_stock registrations and write_batch are
+    passed through to the repository without being recorded.
+    """
+
+    def __init__(self, repository: BaseProductRepository, filename: str):
+        self.repository = repository
+        self.filename = filename
+        self._file = open(filename, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def _record(self, operation: str, arguments: dict, function, *args, **kwargs):
+        error = None
+        at = time.time()
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            line = json.dumps(
+                {
+                    "operation": operation,
+                    "arguments": arguments,
+                    "at": at,
+                    "seconds": seconds,
+                    "error": error,
+                },
+                default=str,
+            )
+            with self._lock:
+                self._file.write(line + "\n")
+
+    def add(self, product: BaseProduct):
+        return self._record(
+            "add", {"product": encode_product(product)}, self.repository.add, product
+        )
+
+    def add_many(self, products) -> int:
+        products = list(products)
+        return self._record(
+            "add_many",
+            {"products": [encode_product(product) for product in products]},
+            self.repository.add_many,
+            products,
+        )
+
+    def get(self, product_id: int | str) -> BaseProduct | None:
+        return self._record(
+            "get", {"product_id": product_id}, self.repository.get, product_id
+        )
+
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        product_ids = list(product_ids)
+        return self._record(
+            "get_many",
+            {"product_ids": product_ids},
+            self.repository.get_many,
+            product_ids,
+        )
+
+    def list(self) -> dict[str, BaseProduct]:
+        return self._record("list", {}, self.repository.list)
+
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        return self._record(
+            "update",
+            {"product": encode_product(product), "expected_version": expected_version},
+            self.repository.update,
+            product,
+            expected_version,
+        )
+
+    def delete(self, product_id: int | str):
+        return self._record(
+            "delete", {"product_id": product_id}, self.repository.delete, product_id
+        )
+
+    def adjust_stock(self, product_id: int | str, delta: int):
+        return self._record(
+            "adjust_stock",
+            {"product_id": product_id, "delta": delta},
+            self.repository.adjust_stock,
+            product_id,
+            delta,
+        )
+
+    def find(self, **filters) -> dict[str, BaseProduct]:
+        return self._record("find", filters, self.repository.find, **filters)
+
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        return self._record(
+            "search",
+            {"query": query, "limit": limit},
+            self.repository.search,
+            query,
+            limit,
+        )
+
+    def expiring_between(self, start, end, limit: int | None = None):
+        return self._record(
+            "expiring_between",
+            {"start": start, "end": end, "limit": limit},
+            self.repository.expiring_between,
+            start,
+            end,
+            limit,
+        )
+
+    def inventory_stats(self) -> dict:
+        return self._record("inventory_stats", {}, self.repository.inventory_stats)
+
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        return self._record(
+            "low_stock", {"limit": limit}, self.repository.low_stock, limit
+        )
+
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        return self._record(
+            "update_where",
+            {"criteria": criteria, "changes": changes},
+            self.repository.update_where,
+            criteria,
+            changes,
+        )
+
+    def delete_where(self, criteria: dict) -> int:
+        return self._record(
+            "delete_where",
+            {"criteria": criteria},
+            self.repository.delete_where,
+            criteria,
+        )
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        return self._record(
+            "set_reorder_threshold",
+            {"threshold": threshold, "code": code, "product_type": product_type},
+            self.repository.set_reorder_threshold,
+            threshold,
+            code,
+            product_type,
+        )
+
+    def watch_low_stock(self, callback):
+        self.repository.watch_low_stock(callback)
+
+    def write_batch(self, deletes, inserts, updates):
+        return self.repository.write_batch(deletes, inserts, updates)
+
+    def iter_batches(self, batch_size: int = 1000):
+        return self.repository.iter_batches(batch_size)
+
+    def iter_expiring_between(self, start, end, batch_size: int = 1000):
+        return self.repository.iter_expiring_between(start, end, batch_size)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.repository.close()
+
+    def __str__(self):
+        return f"RecordingRepository({self.repository}, {self.filename})"
+
+
+def read_workload(filename: str) -> list[dict]:
+    with open(filename, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of values sorted in ascending order"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(latencies: dict[str, list[float]], errors: dict[str, int]) -> dict:
+    """Return the count, errors and latency percentiles, in milliseconds, of
+    every operation"""
+    summary = {}
+    for operation, seconds in sorted(latencies.items()):
+        ordered = sorted(seconds)
+        summary[operation] = {
+            "count": len(ordered),
+            "errors": errors.get(operation, 0),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+        }
+    return summary
+
+
+def replay(
+    records: list[dict],
+    repository: BaseProductRepository,
+    speed: float | None = None,
+    concurrency: int = 1,
+) -> dict:
+    """Run recorded operations against repository and report their latency
+
+    With speed None the operations run as fast as the repository allows;
+    else every one starts when it did in the recording, its time from the
+    first operation divided by speed: 1 for the original pacing, 2 twice
+    as fast. concurrency threads take the operations in their recorded
+    order, so with more than one they can overlap like they did when
+    recorded. Failed operations, like updates of codes the repository
+    doesn't have, count as errors of their operation.
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError("speed must be positive")
+    pending: queue.Queue = queue.Queue()
+    for record in records:
+        pending.put(record)
+    first_at = records[0]["at"] if records else 0.0
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    def worker():
+        while True:
+            try:
+                record = pending.get_nowait()
+            except queue.Empty:
+                return
+            if speed is not None:
+                delay = started + (record["at"] - first_at) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            operation = record["operation"]
+            arguments = decode_arguments(record["arguments"])
+            failed = False
+            operation_started = time.perf_counter()
+            try:
+                getattr(repository, operation)(**arguments)
+            except Exception:
+                failed = True
+            seconds = time.perf_counter() - operation_started
+            with lock:
+                latencies.setdefault(operation, []).append(seconds)
+                if failed:
+                    errors[operation] = errors.get(operation, 0) + 1
+
+    workers = [
+        threading.Thread(target=worker, name=f"replay-{number}")
+        for number in range(concurrency)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - started
+    recorded_latencies: dict[str, list[float]] = {}
+    recorded_errors: dict[str, int] = {}
+    for record in records:
+        recorded_latencies.setdefault(record["operation"], []).append(record["seconds"])
+        if record.get("error"):
+            recorded_errors[record["operation"]] = (
+                recorded_errors.get(record["operation"], 0) + 1
+            )
+    return {
+        "operations": len(records),
+        "errors": sum(errors.values()),
+        "seconds": round(elapsed, 3),
+        "operations_per_second": round(len(records) / elapsed, 1) if elapsed else 0.0,
+        "replayed": summarize(latencies, errors),
+        "recorded": summarize(recorded_latencies, recorded_errors),
+    }
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import unittest
+    from unittest import mock
+
+    from models import FoodProduct, Product
+    from repositories import DictProductRepository, ProductNotFoundError
+
+    class TestRecordAndReplay(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+            self.filename = os.path.join(self.directory.name, "workload.jsonl")
+
+        def tearDown(self):
+            self.directory.cleanup()
+
+        def record(self) -> DictProductRepository:
+            source = DictProductRepository()
+            repository = RecordingRepository(source, self.filename)
+            repository.add(Product("1", "Pen", 1, stock=5))
+            repository.add_many(
+                [
+                    FoodProduct(
+                        "2",
+                        "Milk",
+                        2,
+                        product_type="food",
+                        expiration_date="2030-01-01",
+                    ),
+                    Product("3", "Ink", 3),
+                ]
+            )
+            repository.update(Product("1", "Pen", 1.5, stock=5), expected_version=0)
+            repository.adjust_stock("1", -2)
+            repository.get("1")
+            repository.find(price_between=(1, 2), order_by="price")
+            repository.search("milk")
+            repository.delete("3")
+            with self.assertRaises(ProductNotFoundError):
+                repository.adjust_stock("9", 1)
+            repository.close()
+            return source
+
+        def test_records_every_operation(self):
+            self.record()
+            records = read_workload(self.filename)
+            self.assertEqual(
+                [record["operation"] for record in records],
+                [
+                    "add",
+                    "add_many",
+                    "update",
+                    "adjust_stock",
+                    "get",
+                    "find",
+                    "search",
+                    "delete",
+                    "adjust_stock",
+                ],
+            )
+            self.assertEqual(records[-1]["error"], "ProductNotFoundError")
+            self.assertGreater(records[0]["seconds"], 0)
+
+        def test_replay_reproduces_the_catalog(self):
+            source = self.record()
+            target = DictProductRepository()
+            report = replay(read_workload(self.filename), target)
+            self.assertEqual(
+                {code: p.to_dict() for code, p in target.list().items()},
+                {code: p.to_dict() for code, p in source.list().items()},
+            )
+            self.assertEqual(report["operations"], 9)
+            self.assertEqual(report["errors"], 1)
+            self.assertEqual(report["replayed"]["adjust_stock"]["count"], 2)
+            self.assertEqual(report["replayed"]["adjust_stock"]["errors"], 1)
+            self.assertEqual(report["recorded"]["adjust_stock"]["errors"], 1)
+
+        def test_paced_replay(self):
+            records = [
+                {
+                    "operation": "get",
+                    "arguments": {"product_id": "1"},
+                    "at": 100.0 + 0.1 * number,
+                    "seconds": 0.001,
+                    "error": None,
+                }
+                for number in range(5)
+            ]
+            report = replay(records, DictProductRepository(), speed=2, concurrency=2)
+            self.assertGreaterEqual(report["seconds"], 0.2)
+            self.assertLess(report["seconds"], 0.4)
+            self.assertEqual(report["replayed"]["get"]["count"], 5)
+
+        def test_behaves_like_the_repository(self):
+            source = DictProductRepository()
+            repository = RecordingRepository(source, self.filename)
+            crossings = []
+            repository.watch_low_stock(lambda *crossing: crossings.append(crossing))
+            repository.set_reorder_threshold(3)
+            repository.add(Product("1", "Pen", 1, stock=5))
+            repository.write_batch([], [(Product("2", "Ink", 2, stock=1), 0)], [])
+            repository.adjust_stock("1", -3)
+            self.assertEqual(crossings, [("2", 1, 3, True), ("1", 2, 3, True)])
+            self.assertEqual(list(source.low_stock()), ["2", "1"])
+            self.assertEqual(list(repository.low_stock()), ["2", "1"])
+            with mock.patch.object(source, "close") as close:
+                repository.close()
+            close.assert_called_once()
+            self.assertIn(
+                "set_reorder_threshold",
+                [record["operation"] for record in read_workload(self.filename)],
+            )
+
+        def test_percentile(self):
+            values = [float(value) for value in range(1, 101)]
+            self.assertEqual(percentile(values, 0.5), 50)
+            self.assertEqual(percentile(values, 0.99), 99)
+            self.assertEqual(percentile([7.0], 0.9), 7)
+
+    unittest.main()
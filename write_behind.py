@@ -0,0 +1,562 @@
+import atexit
+import threading
+from contextlib import nullcontext
+
+from mysql.connector import DataError, IntegrityError
+
+from loggers import logger
+from models import BaseProduct, ProductFactory
+from repositories import (
+    BaseProductRepository,
+    ProductNotFoundError,
+    VersionConflictError,
+)
+
+# Errors of a single write, which is dropped; any other error leaves the
+# writes buffered, the repository is probably unreachable
+WRITE_ERRORS = (ValueError, ProductNotFoundError, IntegrityError, DataError)
+
+
+class PendingWrite:
+    """Net effect of the buffered writes to one code
+
+    kind is "insert" (new row), "update" (existing row), "delete" or
+    "replace" (delete the row and insert a new one). For the inserted rows
+    versions is their version, for the updated rows how many versions they
+    move forward from base_version, None while it was not read.
+    """
+
+    __slots__ = ("kind", "product", "versions", "base_version", "seq")
+
+    def __init__(self, kind, product=None, versions=0, base_version=None, seq=0):
+        self.kind = kind
+        self.product = product
+        self.versions = versions
+        self.base_version = base_version
+        self.seq = seq
+
+    @property
+    def version(self) -> int | None:
+        if self.kind == "update":
+            if self.base_version is None:
+                return None
+            return self.base_version + self.versions
+        return self.versions
+
+    def copy(self) -> "PendingWrite":
+        return PendingWrite(
+            self.kind, self.product, self.versions, self.base_version, self.seq
+        )
+
+
+def _copy_product(product: BaseProduct, version: int | None = None) -> BaseProduct:
+    product_data = product.to_dict()
+    product_data["version"] = product.version if version is None else version
+    return ProductFactory().create_product(**product_data)
+
+
+class WriteBehindRepository(BaseProductRepository):
+    """Buffer the writes to a repository and apply them in batches
+
+    add, update and delete only change an in-memory buffer where repeated
+    writes to a code coalesce into one; the buffer is written with the
+    write_batch of the repository, in a single transaction for MySQL, once
+    it holds flush_size codes, every flush_interval seconds and on flush()
+    or close(). get and get_many see the buffered writes, the other reads
+    flush first. A write that would make the buffer hold more than
+    max_pending codes flushes it first, so a repository slower than the
+    writers holds them back.
+
+    A buffered write that the repository refuses, like an add of a code it
+    already has, is logged and kept in errors; the others stay buffered
+    when the repository can't be reached.
+    """
+
+    def __init__(
+        self,
+        repository: BaseProductRepository,
+        flush_size: int = 500,
+        flush_interval: float = 1.0,
+        max_pending: int = 5000,
+    ):
+        if max_pending < flush_size:
+            raise ValueError("max_pending can't be lower than flush_size")
+        self.repository = repository
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.errors: list[tuple[str, Exception]] = []
+        self._pending: dict[str, PendingWrite] = {}
+        self._in_flight: dict[str, PendingWrite] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        # Held while writing a batch, and while reading a stored version so
+        # no batch changes it meanwhile
+        self._flush_lock = threading.RLock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flush_thread = threading.Thread(
+            target=self._flush_loop, name="write-behind", daemon=True
+        )
+        self._flush_thread.start()
+        atexit.register(self.close)
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as error:
+                logger.error("Error flushing the write buffer: %s", error)
+
+    def _stored_version(self, code: str) -> int | None:
+        product = self.repository.get(code)
+        return None if product is None else product.version
+
+    def _write(self, code: str, change, needs_version: bool = False):
+        """Apply change(entry, stored_version) to the pending write of code
+        under the lock; change returns the new entry, or None to forget it"""
+        while True:
+            with self._flush_lock if needs_version else nullcontext():
+                stored_version = None
+                if needs_version:
+                    with self._lock:
+                        entry = self._pending.get(code)
+                        known = entry is not None and (
+                            entry.kind == "delete" or entry.version is not None
+                        )
+                    if not known:
+                        stored_version = self._stored_version(code)
+                with self._lock:
+                    entry = self._pending.get(code)
+                    if entry is None and len(self._pending) >= self.max_pending:
+                        full = True
+                    else:
+                        full = False
+                        self._seq += 1
+                        new_entry = change(entry, stored_version)
+                        if new_entry is None:
+                            del self._pending[code]
+                        else:
+                            new_entry.seq = self._seq
+                            self._pending[code] = new_entry
+                        if len(self._pending) >= self.flush_size:
+                            self._wake.set()
+                        return
+            if full:
+                self.flush()
+
+    def add(self, product: BaseProduct):
+        product = _copy_product(product, 0)
+
+        def change(entry, _):
+            if entry is None:
+                return PendingWrite("insert", product)
+            if entry.kind == "delete":
+                return PendingWrite("replace", product)
+            raise ValueError(f"Product with code {product.code} already exists")
+
+        self._write(product.code, change)
+
+    def update(self, product: BaseProduct, expected_version: int | None = None):
+        code = product.code
+
+        def change(entry, stored_version):
+            if entry is None:
+                if stored_version is None:
+                    raise ProductNotFoundError(f"Product with code {code} not found")
+                entry = PendingWrite("update", base_version=stored_version)
+            elif entry.kind == "delete":
+                raise ProductNotFoundError(f"Product with code {code} not found")
+            else:
+                entry = entry.copy()
+                if entry.version is None:
+                    if stored_version is None:
+                        raise ProductNotFoundError(
+                            f"Product with code {code} not found"
+                        )
+                    entry.base_version = stored_version
+            if expected_version is not None and entry.version != expected_version:
+                raise VersionConflictError(
+                    f"Product with code {code} is at version {entry.version}, "
+                    f"not {expected_version}"
+                )
+            entry.versions += 1
+            entry.product = _copy_product(product, entry.version)
+            return entry
+
+        # The stored version is read on the first update of a code, which
+        # also tells whether the code exists
+        self._write(code, change, needs_version=True)
+
+    def delete(self, product_id: int | str):
+        code = str(product_id)
+        with self._lock:
+            pending = code in self._pending
+        if not pending and self.repository.get(code) is None:
+            raise ProductNotFoundError(f"Product with code {code} not found")
+
+        def change(entry, _):
+            if entry is not None and entry.kind == "delete":
+                raise ProductNotFoundError(f"Product with code {code} not found")
+            if entry is not None and entry.kind == "insert":
+                # Never written, unless it is being written right now
+                return PendingWrite("delete") if code in self._in_flight else None
+            return PendingWrite("delete")
+
+        self._write(code, change)
+        return 1
+
+    def flush(self) -> int:
+        """Write the buffered changes, return the number of codes written"""
+        with self._flush_lock:
+            with self._lock:
+                self._in_flight = {
+                    code: entry.copy() for code, entry in self._pending.items()
+                }
+                batch = self._in_flight
+            if not batch:
+                return 0
+            try:
+                failed = self._write_batch(batch)
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+            return len(batch) - len(failed)
+
+    @staticmethod
+    def _split(batch: dict[str, PendingWrite]):
+        deletes, inserts, updates = [], [], []
+        for code, entry in batch.items():
+            if entry.kind in ("delete", "replace"):
+                deletes.append(code)
+            if entry.kind in ("insert", "replace"):
+                inserts.append((entry.product, entry.versions))
+            elif entry.kind == "update":
+                updates.append((entry.product, entry.versions))
+        return deletes, inserts, updates
+
+    def _write_batch(self, batch: dict[str, PendingWrite]) -> dict[str, Exception]:
+        try:
+            self.repository.write_batch(*self._split(batch))
+        except WRITE_ERRORS as error:
+            logger.warning("Writing the batch one code at a time: %s", error)
+        else:
+            self._settle(batch, {})
+            return {}
+        # Find the writes the repository refuses, stopping at any other error
+        failed = {}
+        written = {}
+        try:
+            for code, entry in batch.items():
+                try:
+                    self.repository.write_batch(*self._split({code: entry}))
+                except WRITE_ERRORS as error:
+                    logger.error("Buffered write of %s dropped: %s", code, error)
+                    failed[code] = error
+                else:
+                    written[code] = entry
+        finally:
+            self._settle(written, failed)
+        return failed
+
+    def _settle(self, written: dict[str, PendingWrite], failed: dict[str, Exception]):
+        """Forget the written and failed entries, keeping the writes made
+        to their codes since the batch was taken, relative to it"""
+        with self._lock:
+            for code, error in failed.items():
+                self.errors.append((code, error))
+                if self._pending[code].seq == self._in_flight[code].seq:
+                    del self._pending[code]
+            for code, flushed in written.items():
+                entry = self._pending[code]
+                if entry.seq == flushed.seq:
+                    del self._pending[code]
+                elif flushed.kind == "delete" and entry.kind == "replace":
+                    entry.kind = "insert"
+                elif flushed.kind != "delete" and entry.kind in ("insert", "update"):
+                    # The row now exists with the versions written
+                    version = entry.version
+                    entry.kind = "update"
+                    entry.versions -= flushed.versions
+                    if version is not None:
+                        entry.base_version = version - entry.versions
+
+    def get(self, product_id: int | str) -> BaseProduct | None:
+        code = str(product_id)
+        with self._lock:
+            entry = self._pending.get(code)
+            entry = entry.copy() if entry is not None else None
+        if entry is None:
+            return self.repository.get(code)
+        if entry.kind == "delete":
+            return None
+        if entry.version is None:
+            # An update of a row whose version was never read
+            with self._flush_lock:
+                stored_version = self._stored_version(code)
+                with self._lock:
+                    entry = self._pending.get(code)
+                    if entry is not None and entry.version is None:
+                        if stored_version is None:
+                            # Deleted from the repository meanwhile
+                            del self._pending[code]
+                            return None
+                        entry.base_version = stored_version
+            return self.get(code)
+        return _copy_product(entry.product, entry.version)
+
+    def get_many(self, product_ids) -> dict[str, BaseProduct]:
+        codes = [str(code) for code in product_ids]
+        with self._lock:
+            pending = {code for code in codes if code in self._pending}
+        products = self.repository.get_many(
+            [code for code in codes if code not in pending]
+        )
+        for code in pending:
+            product = self.get(code)
+            if product is not None:
+                products[code] = product
+        return products
+
+    def list(self) -> dict[str, BaseProduct]:
+        self.flush()
+        return self.repository.list()
+
+    def iter_batches(self, batch_size: int = 1000):
+        self.flush()
+        return self.repository.iter_batches(batch_size)
+
+    def find(
+        self,
+        product_type: str | None = None,
+        available: bool | None = None,
+        price_between: tuple[float, float] | None = None,
+        stock_below: int | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+    ) -> dict[str, BaseProduct]:
+        self.flush()
+        return self.repository.find(
+            product_type=product_type,
+            available=available,
+            price_between=price_between,
+            stock_below=stock_below,
+            order_by=order_by,
+            limit=limit,
+            offset=offset,
+        )
+
+    def search(self, query: str, limit: int | None = 10) -> dict[str, BaseProduct]:
+        self.flush()
+        return self.repository.search(query, limit)
+
+    def expiring_between(self, start, end, limit: int | None = None):
+        self.flush()
+        return self.repository.expiring_between(start, end, limit)
+
+    def iter_expiring_between(self, start, end, batch_size: int = 1000):
+        self.flush()
+        return self.repository.iter_expiring_between(start, end, batch_size)
+
+    def inventory_stats(self) -> dict:
+        self.flush()
+        return self.repository.inventory_stats()
+
+    def low_stock(self, limit: int | None = None) -> dict[str, BaseProduct]:
+        self.flush()
+        return self.repository.low_stock(limit)
+
+    def update_where(self, criteria: dict, changes: dict) -> int:
+        self.flush()
+        return self.repository.update_where(criteria, changes)
+
+    def delete_where(self, criteria: dict) -> int:
+        self.flush()
+        return self.repository.delete_where(criteria)
+
+    def set_reorder_threshold(
+        self,
+        threshold: int | None,
+        code: int | str | None = None,
+        product_type: str | None = None,
+    ):
+        self.flush()
+        self.repository.set_reorder_threshold(threshold, code, product_type)
+
+    def watch_low_stock(self, callback):
+        """The callbacks run when the buffered writes reach the repository"""
+        self.repository.watch_low_stock(callback)
+
+    def close(self):
+        """Stop the background flushes and write what is left"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._flush_thread.join()
+        atexit.unregister(self.close)
+        self.flush()
+
+    def __str__(self):
+        return f"WriteBehindRepository({self.repository})"
+
+
+if __name__ == "__main__":
+    import time
+    import unittest
+
+    from models import Product
+    from repositories import DictProductRepository
+
+    class RecordingRepository(DictProductRepository):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.batches = []
+            self.before_write = None
+
+        def write_batch(self, deletes, inserts, updates):
+            if self.before_write is not None:
+                self.before_write()
+            self.batches.append((list(deletes), list(inserts), list(updates)))
+            super().write_batch(deletes, inserts, updates)
+
+    class TestWriteBehindRepository(unittest.TestCase):
+        def setUp(self):
+            self.backing = RecordingRepository()
+            self.backing.add(Product("1", "Product", 10, stock=1))
+            self.repository = WriteBehindRepository(self.backing, flush_interval=60)
+
+        def tearDown(self):
+            self.repository.close()
+
+        def test_coalesces_and_reads_own_writes(self):
+            for stock in range(50):
+                self.repository.update(Product("1", "Product", 10, stock=stock))
+            self.assertEqual(self.backing.get("1").stock, 1)
+            product = self.repository.get("1")
+            self.assertEqual((product.stock, product.version), (49, 50))
+            self.assertEqual(self.repository.get_many(["1"])["1"].stock, 49)
+            self.assertEqual(self.repository.flush(), 1)
+            self.assertEqual(len(self.backing.batches), 1)
+            _, _, updates = self.backing.batches[0]
+            self.assertEqual(
+                [(p.stock, versions) for p, versions in updates], [(49, 50)]
+            )
+            self.assertEqual(self.backing.get("1").stock, 49)
+            self.assertEqual(self.repository.flush(), 0)
+
+        def test_add_and_delete(self):
+            self.repository.add(Product("2", "New", 1))
+            self.repository.delete("2")
+            self.assertIsNone(self.repository.get("2"))
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.delete("2")
+            self.repository.add(Product("3", "New", 1))
+            with self.assertRaises(ValueError):
+                self.repository.add(Product("3", "Again", 1))
+            self.repository.delete("1")
+            self.repository.add(Product("1", "Replaced", 5))
+            self.repository.flush()
+            deletes, inserts, updates = self.backing.batches[0]
+            self.assertEqual(deletes, ["1"])
+            self.assertEqual(sorted(p.code for p, _ in inserts), ["1", "3"])
+            self.assertEqual(self.backing.get("1").name, "Replaced")
+            self.assertIsNone(self.backing.get("2"))
+
+        def test_update_of_a_missing_code(self):
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.update(Product("2", "Missing", 1))
+            self.assertIsNone(self.repository.get("2"))
+            self.assertEqual(self.repository.flush(), 0)
+            # An update whose row was deleted from the repository meanwhile
+            self.repository._pending["1"] = PendingWrite(
+                "update", Product("1", "Product", 10), versions=1
+            )
+            self.backing.delete("1")
+            self.assertIsNone(self.repository.get("1"))
+            self.assertEqual(self.repository.flush(), 0)
+
+        def test_expected_version(self):
+            self.repository.update(Product("1", "Product", 10), expected_version=0)
+            self.repository.update(Product("1", "Product", 10), expected_version=1)
+            with self.assertRaises(VersionConflictError):
+                self.repository.update(Product("1", "Product", 10), expected_version=1)
+            with self.assertRaises(ProductNotFoundError):
+                self.repository.update(Product("9", "Missing", 1), expected_version=0)
+
+        def test_flushes_on_size(self):
+            repository = WriteBehindRepository(
+                self.backing, flush_size=10, flush_interval=60
+            )
+            for code in range(10, 20):
+                repository.add(Product(str(code), "Product", 1))
+            deadline = time.monotonic() + 2
+            while len(self.backing.storage) < 11 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(self.backing.storage), 11)
+            repository.close()
+
+        def test_backpressure(self):
+            repository = WriteBehindRepository(
+                self.backing, flush_size=5, flush_interval=60, max_pending=5
+            )
+            for code in range(10, 40):
+                repository.add(Product(str(code), "Product", 1))
+                self.assertLessEqual(len(repository._pending), 5)
+            repository.close()
+            self.assertEqual(len(self.backing.storage), 31)
+
+        def test_refused_writes_are_dropped(self):
+            self.repository.update(Product("1", "Deleted", 1))
+            self.backing.delete("1")
+            self.repository.add(Product("2", "New", 1))
+            self.assertEqual(self.repository.flush(), 1)
+            self.assertEqual([code for code, _ in self.repository.errors], ["1"])
+            self.assertIsNone(self.backing.get("1"))
+            self.assertEqual(self.backing.get("2").name, "New")
+            self.assertFalse(self.repository._pending)
+
+        def test_unreachable_repository_keeps_the_writes(self):
+            self.repository.add(Product("2", "New", 1))
+
+            def fail():
+                raise ConnectionError("MySQL is down")
+
+            self.backing.before_write = fail
+            with self.assertRaises(ConnectionError):
+                self.repository.flush()
+            self.assertEqual(self.repository.get("2").name, "New")
+            self.backing.before_write = None
+            self.assertEqual(self.repository.flush(), 1)
+            self.assertEqual(self.backing.get("2").name, "New")
+
+        def test_writes_during_a_flush(self):
+            self.repository.add(Product("2", "New", 1, stock=1))
+
+            def write_meanwhile():
+                self.backing.before_write = None
+                self.repository.update(Product("2", "New", 1, stock=2))
+
+            self.backing.before_write = write_meanwhile
+            self.repository.flush()
+            self.assertEqual(self.backing.get("2").stock, 1)
+            self.assertEqual(self.repository.get("2").stock, 2)
+            self.assertEqual(self.repository.get("2").version, 1)
+            self.repository.flush()
+            self.assertEqual(self.backing.get("2").stock, 2)
+            self.assertEqual(self.backing.batches[-1][2][0][1], 1)
+
+        def test_close_flushes(self):
+            self.repository.add(Product("2", "New", 1))
+            self.repository.close()
+            self.assertEqual(self.backing.get("2").name, "New")
+
+        def test_reads_flush_first(self):
+            self.repository.add(Product("2", "Blue pen", 1))
+            self.assertIn("2", self.repository.search("pen"))
+            self.assertEqual(len(self.repository.list()), 2)
+
+    unittest.main()